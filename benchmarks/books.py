@@ -0,0 +1,158 @@
+""" Synthetic fb2 books for benchmarks. """
+
+import base64
+import random
+import zipfile
+
+
+header = """\
+<?xml version="1.0" encoding="utf-8"?>
+<FictionBook xmlns="http://www.gribuser.ru/xml/fictionbook/2.0" xmlns:l="http://www.w3.org/1999/xlink">
+<description>
+<title-info>
+    <genre>prose_classic</genre>
+    <author><first-name>Bench</first-name><last-name>Mark</last-name></author>
+    <book-title>{title}</book-title>
+    <annotation><p>Synthetic book.</p></annotation>
+    <date>2001</date>
+    <sequence name="Benchmarks" number="1"/>
+</title-info>
+</description>
+"""
+
+words = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do "
+    "eiusmod tempor incididunt ut labore et dolore magna aliqua").split()
+
+
+class BookGenerator:
+    """ Build fb2 text from sections of paragraphs. """
+
+    def __init__(self, seed=1):
+        self.random = random.Random(seed)
+        self.parts = []
+
+    def sentence(self, length=12):
+        text = " ".join(self.random.choice(words) for _ in range(length))
+        return text.capitalize() + "."
+
+    def paragraph(self):
+        text = " ".join(self.sentence() for _ in range(self.random.randint(2, 6)))
+        if self.random.random() < 0.2:
+            text += " <emphasis>" + self.sentence(3) + "</emphasis> tail."
+        self.parts.append(f"<p>{text}</p>\n")
+
+    def title(self, text):
+        self.parts.append(f"<title><p>{text}</p></title>\n")
+
+    def poem(self, stanzas=2, lines=4):
+        self.parts.append("<poem>\n")
+        for _ in range(stanzas):
+            verses = "".join(f"<v>{self.sentence(6)}</v>\n"
+                for _ in range(lines))
+            self.parts.append(f"<stanza>\n{verses}</stanza>\n")
+        self.parts.append("<text-author>Bench Mark</text-author>\n</poem>\n")
+
+    def table(self, rows=4, columns=3):
+        self.parts.append("<table>\n")
+        for _ in range(rows):
+            cells = "".join(f"<td>{self.sentence(2)}</td>"
+                for _ in range(columns))
+            self.parts.append(f"<tr>{cells}</tr>\n")
+        self.parts.append("</table>\n")
+
+    def image(self, name):
+        self.parts.append(f'<image l:href="#{name}"/>\n')
+
+    def binary(self, name, size):
+        data = base64.encodebytes(self.random.randbytes(size)).decode()
+        return f'<binary id="{name}" content-type="image/png">{data}</binary>\n'
+
+    def section(self, title, paragraphs):
+        self.parts.append("<section>\n")
+        self.title(title)
+        for _ in range(paragraphs):
+            self.paragraph()
+        self.parts.append("</section>\n")
+
+    def book(self, title, binaries=""):
+        return header.format(title=title) + "<body>\n" + "".join(self.parts) \
+            + "</body>\n" + binaries + "</FictionBook>\n"
+
+    def size(self):
+        return sum(len(part) for part in self.parts)
+
+
+def typical_book(chapters=60, paragraphs=150):
+    """ Flat novel: chapters of paragraphs. """
+    gen = BookGenerator()
+    for n in range(chapters):
+        gen.section(f"Chapter {n+1}", paragraphs)
+    return gen.book("Typical")
+
+
+def nested_book(depth=200, paragraphs=5):
+    """ Pathological: sections nested depth levels deep. """
+    gen = BookGenerator()
+    for n in range(depth):
+        gen.parts.append("<section>\n")
+        gen.title(f"Level {n+1}")
+        for _ in range(paragraphs):
+            gen.paragraph()
+    gen.parts.append("</section>\n" * depth)
+    return gen.book("Nested")
+
+
+def titles_book(titles=5000):
+    """ Pathological: a single section with many titles. """
+    gen = BookGenerator()
+    gen.parts.append("<section>\n")
+    for n in range(titles):
+        gen.title(f"Title {n+1}<emphasis>!</emphasis>")
+        gen.paragraph()
+    gen.parts.append("</section>\n")
+    return gen.book("Titles")
+
+
+def generate_book(size=1_000_000, depth=1, titles=1, poems=0, tables=0,
+        images=0, image_size=20_000, seed=1):
+    """ Book with about size bytes of body text.
+
+    Chapters are sections nested depth levels deep, the innermost one has
+    titles titles. poems and tables are shares of paragraphs replaced by
+    poems and tables. images binaries of image_size bytes are linked from
+    the first chapters.
+    """
+    gen = BookGenerator(seed)
+    chapter = 0
+    while gen.size() < size:
+        chapter += 1
+        for level in range(depth):
+            gen.parts.append("<section>\n")
+            gen.title(f"Chapter {chapter}.{level+1}")
+        if chapter <= images:
+            gen.image(f"image{chapter}.png")
+        for n in range(titles-1):
+            gen.paragraph()
+            gen.title(f"Part {n+2}")
+        for _ in range(20):
+            choice = gen.random.random()
+            if choice < poems:
+                gen.poem()
+            elif choice < poems + tables:
+                gen.table()
+            else:
+                gen.paragraph()
+        gen.parts.append("</section>\n" * depth)
+    binaries = "".join(gen.binary(f"image{n+1}.png", image_size)
+        for n in range(images))
+    return gen.book(f"Generated {size}", binaries)
+
+
+def write_book(path, text, zip=False):
+    """ Save book text as .fb2, or as .fb2.zip with a single member. """
+    if zip:
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr("book.fb2", text)
+    else:
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
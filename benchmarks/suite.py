@@ -0,0 +1,158 @@
+""" fb2book benchmark suite on generated books.
+
+Run: python -m benchmarks.suite [--repeat N] [--scale X] [--output FILE]
+    [--compare FILE]
+
+Every book is saved as .fb2 and .fb2.zip and goes through stages:
+parse (whole tree), metadata (description only), html and text (DocWriter
+on a parsed tree), stream (html without a tree). Results are JSON with
+the best time, throughput in MB/s of uncompressed book text and
+tracemalloc peak per stage. With --compare, time ratios to an earlier
+result file are printed too.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from webbooks.fb2book import (BookParser, BookMetadata, BookScanner,
+    StreamScanner, DocWriter)
+from . import books
+
+
+MB = 1024*1024
+
+cases = {
+    "typical": dict(size=3*MB),
+    "nested": dict(size=1*MB, depth=30),
+    "titles": dict(size=2*MB, titles=20),
+    "verse": dict(size=2*MB, poems=0.3, tables=0.1),
+    "images": dict(size=1*MB, images=40, image_size=50_000),
+}
+
+
+def parse(path):
+    return BookParser(file=path).tree
+
+
+def metadata(path):
+    meta = BookMetadata(BookParser(file=path, description_only=True).tree)
+    meta.collect()
+    return meta
+
+
+def render(tree, format):
+    writer = DocWriter(format)
+    BookScanner(tree, "img/{name}").scan(writer)
+    return writer.get_result()
+
+
+def stream(path):
+    writer = DocWriter("html")
+    StreamScanner(file=path, image_url="img/{name}").scan(writer)
+    return writer.get_result()
+
+
+def stages(path, zip):
+    """ Stage name and function to measure. """
+    yield "parse", lambda: parse(path)
+    yield "metadata", lambda: metadata(path)
+    if not zip:
+        tree = parse(path)
+        yield "html", lambda: render(tree, "html")
+        yield "text", lambda: render(tree, "text")
+    yield "stream", lambda: stream(path)
+
+
+def best_time(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def peak_memory(func):
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def measure(func, size, repeat):
+    seconds = best_time(func, repeat)
+    return {
+        "seconds": round(seconds, 5),
+        "mb_per_s": round(size / MB / seconds, 2),
+        "peak_mb": round(peak_memory(func) / MB, 2),
+    }
+
+
+def run(repeat=3, scale=1.0, selected=None):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, params in cases.items():
+            if selected and name not in selected:
+                continue
+            params = dict(params, size=int(params["size"]*scale))
+            text = books.generate_book(**params)
+            size = len(text.encode())
+            for zip in (False, True):
+                key = name + (".fb2.zip" if zip else ".fb2")
+                path = os.path.join(tmp, key)
+                books.write_book(path, text, zip)
+                result = {"size": size, "file_size": os.path.getsize(path)}
+                for stage, func in stages(path, zip):
+                    result[stage] = measure(func, size, repeat)
+                results[key] = result
+                print(key, "done", file=sys.stderr)
+    return results
+
+
+def compare(results, old):
+    """ Lines with time ratio new/old of every common stage. """
+    for key, result in results.items():
+        for stage, value in result.items():
+            try:
+                before = old[key][stage]["seconds"]
+            except (KeyError, TypeError):
+                continue
+            ratio = value["seconds"] / before
+            yield f"{key:20} {stage:9} {before:9.5f} -> " \
+                f"{value['seconds']:9.5f}  x{ratio:.2f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--scale", type=float, default=1.0,
+        help="Multiply book sizes.")
+    parser.add_argument("--case", action="append", choices=list(cases),
+        help="Run only these cases.")
+    parser.add_argument("--output", help="Save JSON to this file.")
+    parser.add_argument("--compare", help="Earlier JSON to compare with.")
+    args = parser.parse_args()
+    results = run(args.repeat, args.scale, args.case)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        for line in compare(results, old):
+            print(line, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
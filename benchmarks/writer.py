@@ -0,0 +1,53 @@
+""" DocWriter benchmark on pre-parsed synthetic books.
+
+Run: python -m benchmarks.writer [--repeat N]
+Prints JSON with the best time of html and text rendering per book.
+"""
+
+import argparse
+import json
+import time
+
+from webbooks.fb2book import BookParser, BookScanner, DocWriter
+from . import books
+
+
+samples = {
+    "typical": books.typical_book,
+    "nested": books.nested_book,
+    "titles": books.titles_book,
+}
+
+
+def best_time(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def render(tree, format):
+    writer = DocWriter(format)
+    BookScanner(tree, "img/{name}").scan(writer)
+    return writer.get_result(), writer.get_toc()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    results = {}
+    for name, make in samples.items():
+        text = make()
+        tree = BookParser(text).tree
+        results[name] = {"size": len(text.encode())}
+        for format in ("html", "text"):
+            seconds = best_time(lambda: render(tree, format), args.repeat)
+            results[name][format] = round(seconds, 4)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
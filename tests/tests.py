@@ -1,11 +1,36 @@
+from contextlib import ExitStack
+from datetime import timedelta
+from io import BytesIO, StringIO
+import hashlib
+import importlib.util
+import json
+import os
 from pathlib import Path
+import sys
 import tempfile
-from django.test import TestCase
+import unittest
+import zipfile
+from unittest.mock import Mock, patch
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import CommandError
+from django.contrib.auth.models import User
+from django.db import connections, transaction
+from django.db.models import Count, Sum
+from django.test import Client, TestCase, SimpleTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
 
-from webbooks import conf
+from webbooks import (catalog, conf, counts, fulltext, jobs, library,
+    neardupes, rendercache, uploads, urls)
 from webbooks.fb2book import BookProcessor
+from webbooks.inotify import Event, IN_Q_OVERFLOW
+from webbooks.management.commands.libwatch import LibraryWatcher
 from webbooks.models import *
 from webbooks.services import *
+from webbooks.views import DuplicatesView, IndexView
+from .tests_fb2book import sample_fb2, mixed_fb2
 
 
 def temp_file(content, mode="w+b"):
@@ -15,6 +40,23 @@ def temp_file(content, mode="w+b"):
     return file
 
 
+def temp_library(test, render_cache="", **settings):
+    """ Library root in a temporary directory for the test, as Path.
+
+    Uploads and the render cache directory are in it, the render cache
+    is disabled unless render_cache is given.
+    """
+    tempdir = tempfile.TemporaryDirectory()
+    test.addCleanup(tempdir.cleanup)
+    settings = override_settings(WEBBOOKS_ROOT=tempdir.name,
+        WEBBOOKS_UPLOAD=tempdir.name+"/_upload",
+        WEBBOOKS_RENDER_CACHE=render_cache,
+        WEBBOOKS_RENDER_CACHE_DIR=tempdir.name+"/_cache", **settings)
+    settings.enable()
+    test.addCleanup(settings.disable)
+    return Path(tempdir.name)
+
+
 class TestServices(TestCase):
     databases = "__all__"
 
@@ -129,6 +171,63 @@ class TestServices(TestCase):
             hash = Book.objects.values_list("hash", flat=True).get(id=book.id)
             self.assertNotEqual(hash, "123")
 
+    def test_read_book_file(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            plain = Path(dirname, "book.fb2")
+            plain.write_text(mixed_fb2)
+            zipped = Path(dirname, "book.fb2.zip")
+            with zipfile.ZipFile(zipped, "w") as archive:
+                archive.writestr("book.fb2", mixed_fb2)
+            for path in (plain, zipped):
+                with self.subTest(path=path.name):
+                    hash, metadata = read_book_file(path)
+                    self.assertEqual(hash, file_hash(path))
+                    expected = read_metadata(path)
+                    self.assertEqual(vars(metadata), vars(expected))
+                    Book.objects.create(title="Book", file=path.name,
+                        hash=hash)
+                    self.assertEqual(read_book_file(path), (hash, None))
+
+    def test_book_importer(self):
+        metadata = BookProcessor(self.fb2_example).get_metadata()
+        stat = os.stat(__file__)
+        Author.objects.create(name=metadata.authors[0])
+        with BookImporter() as importer:
+            for n in range(3):
+                importer.add(f"{conf.WEBBOOKS_ROOT}/new{n}.fb2", f"h{n}",
+                    metadata, stat)
+            self.assertFalse(Book.objects.filter(hash="h0").exists())
+        books = Book.objects.filter(file__startswith="new")
+        self.assertEqual(books.count(), 3)
+        self.assertEqual(Author.objects.filter(name__in=metadata.authors)
+            .count(), 1)
+        for book in books:
+            self.assertEqual(book.sequence.name, metadata.sequence)
+            self.assertEqual(book.file_size, stat.st_size)
+            authors = list(book.authors.values_list("name", flat=True))
+            self.assertEqual(authors, metadata.authors)
+            genres = list(book.genres.values_list("name", flat=True))
+            self.assertEqual(genres, metadata.genres)
+
+    def test_book_importer_fallback(self):
+        metadata = BookProcessor(self.fb2_example).get_metadata()
+        write_books = BookImporter.write_books
+        def failing_write_books(importer, pending):
+            if any(book.file.name == "bad.fb2" for _,book,_ in pending):
+                raise ValueError("bad")
+            write_books(importer, pending)
+        errors = []
+        with patch.object(BookImporter, "write_books", failing_write_books):
+            with BookImporter(on_error=lambda *a: errors.append(a)) as importer:
+                for name in ("good1.fb2", "bad.fb2", "good2.fb2"):
+                    importer.add(f"{conf.WEBBOOKS_ROOT}/{name}", name,
+                        metadata, os.stat(__file__))
+        self.assertEqual([str(path) for path,_ in errors],
+            [f"{conf.WEBBOOKS_ROOT}/bad.fb2"])
+        files = Book.objects.filter(file__in=["good1.fb2", "bad.fb2",
+            "good2.fb2"]).values_list("file", flat=True)
+        self.assertEqual(sorted(files), ["good1.fb2", "good2.fb2"])
+
     def test_add_book_file(self):
         full_path = self.find_some_book()
         book, status = add_book_file(full_path)
@@ -141,3 +240,1361 @@ class TestServices(TestCase):
             Book.objects.filter(id=book.id).update(hash="123")
             _, status = add_book_file(full_path)
             self.assertEqual(status, "exists")
+
+
+class TestReadViews(TestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.root = temp_library(self, render_cache="disk")
+        (self.root / "book.fb2").write_text(sample_fb2)
+        self.book = Book.objects.create(title="Title", file="book.fb2",
+            hash="hash1")
+        (self.root / "mixed.fb2").write_text(mixed_fb2)
+        self.mixed = Book.objects.create(title="Mixed", file="mixed.fb2",
+            hash="hash2")
+
+    def test_read_links_images(self):
+        response = self.client.get(reverse("webbooks:read", args=[self.book.id]))
+        self.assertContains(response, '<img src="img/i_127.png">')
+        self.assertNotContains(response, "base64")
+
+    def test_read_uses_render_cache(self):
+        url = reverse("webbooks:read", args=[self.book.id])
+        with patch.object(rendercache, "render",
+                wraps=rendercache.render) as render:
+            first = self.client.get(url).getvalue()
+            second = self.client.get(url).getvalue()
+        self.assertEqual(first, second)
+        render.assert_called_once()
+
+    def test_read_streams_big_books(self):
+        url = reverse("webbooks:read", args=[self.mixed.id])
+        cached = self.client.get(url).getvalue()
+        rendercache.invalidate(self.mixed.hash)
+        with self.settings(WEBBOOKS_STREAM_SIZE=0):
+            streamed = self.client.get(url).getvalue()
+        self.assertIn(b'<div id="late_toc">', streamed)
+        self.assertIsNone(rendercache.get_cached(self.mixed.hash,
+            image_url=rendercache.READER_IMAGES))
+        rendered = BookProcessor(mixed_fb2, image_url="img/{name}")
+        text, toc = rendered.get_content()
+        self.assertIn(text.encode(), streamed)
+        self.assertIn((toc+text).encode(), cached)
+
+    def test_read_missing_file(self):
+        url = reverse("webbooks:read", args=[self.mixed.id])
+        (self.root / "mixed.fb2").unlink()
+        for stream_size in (0, 10**9):
+            with self.subTest(stream_size=stream_size), \
+                    self.settings(WEBBOOKS_STREAM_SIZE=stream_size):
+                self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_read_zip(self):
+        with zipfile.ZipFile(self.root / "book.fb2.zip", "w") as archive:
+            archive.writestr("book.fb2", sample_fb2)
+        book = Book.objects.create(title="Zip", file="book.fb2.zip",
+            hash="hash3")
+        url = reverse("webbooks:read", args=[book.id])
+        for stream_size in (0, 10**9):
+            with self.subTest(stream_size=stream_size), \
+                    self.settings(WEBBOOKS_STREAM_SIZE=stream_size):
+                self.assertContains(self.client.get(url),
+                    '<img src="img/i_127.png">')
+
+    def test_read_big_zip(self):
+        path = self.root / "book.fb2.zip"
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr("book.fb2", sample_fb2)
+        book = Book.objects.create(title="Zip", file="book.fb2.zip",
+            hash="hash3")
+        url = reverse("webbooks:read", args=[book.id])
+        with self.settings(WEBBOOKS_STREAM_SIZE=path.stat().st_size):
+            streamed = self.client.get(url).getvalue()
+        self.assertIn(b'<div id="late_toc">', streamed)
+        self.assertIsNone(rendercache.get_cached(book.hash,
+            image_url=rendercache.READER_IMAGES))
+
+    def test_librender(self):
+        call_command("librender", "--jobs=1", stdout=StringIO())
+        cache = rendercache.get_cache()
+        variant = rendercache.variant_key("html", rendercache.READER_IMAGES)
+        self.assertTrue(cache.contains(self.book.hash, variant))
+
+    def test_read_chapter(self):
+        url = reverse("webbooks:read_chapter", args=[self.mixed.id, "toc3"])
+        response = self.client.get(url)
+        self.assertContains(response, "<h2 id='toc3'>")
+        self.assertContains(response, "<h2 id='toc5'>")
+        self.assertNotContains(response, "<h2 id='toc2'>")
+        self.assertContains(response, 'href="toc1#toc2"')
+
+    def test_read_chapter_redirect(self):
+        url = reverse("webbooks:read_chapter", args=[self.mixed.id, "toc5"])
+        response = self.client.get(url)
+        page_url = reverse("webbooks:read_chapter", args=[self.mixed.id, "toc3"])
+        self.assertRedirects(response, page_url+"#toc5",
+            fetch_redirect_response=False)
+
+    def test_read_chapter_json(self):
+        url = reverse("webbooks:read_chapter_json", args=[self.mixed.id, "toc6"])
+        self.assertTrue(url.endswith("/toc6.json"))
+        page = self.client.get(url).json()
+        self.assertEqual((page["prev"], page["next"]), ("toc3", "toc7"))
+        self.assertIn("<h2 id='toc6'>", page["html"])
+        missing = url.replace("toc6", "toc99")
+        self.assertEqual(self.client.get(missing).status_code, 404)
+
+    def test_read_chapter_cached_pages(self):
+        url = reverse("webbooks:read_chapter_json", args=[self.mixed.id, "toc6"])
+        with patch.object(rendercache, "render",
+                wraps=rendercache.render) as render:
+            first = self.client.get(url).json()
+            with patch.object(rendercache, "get_cached") as get_cached:
+                second = self.client.get(url).json()
+                other = self.client.get(url.replace("toc6", "toc2")).json()
+        self.assertEqual(first, second)
+        self.assertIn("<h2 id='toc2'>", other["html"])
+        render.assert_called_once()
+        get_cached.assert_not_called()
+
+    def test_read_chapter_big_book(self):
+        url = reverse("webbooks:read_chapter_json", args=[self.mixed.id, "toc6"])
+        with self.settings(WEBBOOKS_STREAM_SIZE=0), \
+                patch.object(rendercache, "render",
+                    wraps=rendercache.render) as render:
+            first = self.client.get(url).json()
+            second = self.client.get(url).json()
+        self.assertEqual(first, second)
+        self.assertEqual(render.call_count, 2)
+        self.assertIsNone(rendercache.get_cached_page(self.mixed.hash, "toc6",
+            2, rendercache.READER_IMAGES))
+        (self.root / "mixed.fb2").unlink()
+        with self.settings(WEBBOOKS_STREAM_SIZE=0):
+            self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_book_image(self):
+        url = reverse("webbooks:book_image", args=[self.book.id, "i_127.png"])
+        self.assertTrue(url.endswith(f"/read{self.book.id}/img/i_127.png"))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["content-type"], "image/png")
+        self.assertEqual(response.content, b"y\xf8!")
+        self.assertIn("max-age", response["cache-control"])
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response["etag"])
+        self.assertEqual(response.status_code, 304)
+
+    def test_image_types(self):
+        (self.root / "html.fb2").write_text(sample_fb2.replace(
+            'content-type="image/png"', 'content-type="text/html"'))
+        book = Book.objects.create(title="Html", file="html.fb2",
+            hash="hash3")
+        for name, content_type, disposition in (
+                ("i_127.png", "application/octet-stream", "attachment"),
+                ("cover.jpg", "image/jpeg", None)):
+            with self.subTest(name=name):
+                response = self.client.get(reverse("webbooks:book_image",
+                    args=[book.id, name]))
+                self.assertEqual(response["content-type"], content_type)
+                self.assertEqual(response.get("content-disposition"),
+                    disposition)
+                self.assertEqual(response["x-content-type-options"], "nosniff")
+
+    def test_missing_image(self):
+        url = reverse("webbooks:book_image", args=[self.book.id, "none.png"])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 404)
+
+
+class TestRenderCache(SimpleTestCase):
+
+    def check_cache(self, cache):
+        self.assertIsNone(cache.get("hash1", "v1"))
+        cache.set("hash1", "v1", ("content", "toc"))
+        cache.set("hash1", "v2", ("content2", "toc2"))
+        self.assertTrue(cache.contains("hash1", "v1"))
+        self.assertEqual(cache.get("hash1", "v1"), ("content", "toc"))
+        cache.invalidate("hash1")
+        self.assertIsNone(cache.get("hash1", "v1"))
+        self.assertIsNone(cache.get("hash1", "v2"))
+
+    def test_django_cache(self):
+        self.check_cache(rendercache.DjangoCache("default"))
+
+    def test_disk_cache(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            self.check_cache(rendercache.DiskCache(dirname, 10**6))
+
+    def test_disk_cache_eviction(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            cache = rendercache.DiskCache(dirname, 3500)
+            for n in range(3):
+                cache.set(f"hash{n}", "v", "x"*1000)
+                os.utime(cache.entry_path(f"hash{n}", "v"), (n, n))
+            cache.get("hash0", "v")
+            cache.set("hash3", "v", "x"*1000)
+            self.assertTrue(cache.contains("hash0", "v"))
+            self.assertFalse(cache.contains("hash1", "v"))
+            self.assertTrue(cache.contains("hash3", "v"))
+
+    def test_disk_cache_scans(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            cache = rendercache.DiskCache(dirname, 10**6)
+            with patch.object(cache, "entries",
+                    wraps=cache.entries) as entries:
+                for n in range(10):
+                    cache.set(f"hash{n}", "v", "x"*1000)
+                cache.invalidate("hash0")
+            entries.assert_called_once()
+            sizes = sum(size for _, size, _ in cache.entries())
+            self.assertEqual(cache.size, sizes)
+            cache.max_size = sizes
+            cache.set("hash10", "v", "x"*1000)
+            self.assertFalse(cache.contains("hash1", "v"))
+            self.assertEqual(cache.size,
+                sum(size for _, size, _ in cache.entries()))
+
+    def test_full_disk_cache_scans(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            cache = rendercache.DiskCache(dirname, 10**6)
+            cache.set("first", "v", "x"*1000)
+            cache.max_size = cache.size * 100
+            with patch.object(cache, "entries",
+                    wraps=cache.entries) as entries:
+                for n in range(300):
+                    cache.set(f"hash{n}", "v", "x"*1000)
+            self.assertLessEqual(entries.call_count, 30)
+            self.assertLessEqual(cache.size, cache.max_size)
+            self.assertEqual(cache.size,
+                sum(size for _, size, _ in cache.entries()))
+
+
+class TestRenderedBook(SimpleTestCase):
+
+    def setUp(self):
+        book = BookProcessor(mixed_fb2, image_url="img/{name}")
+        content, toc = book.get_content()
+        self.rendered = rendercache.RenderedBook(content, toc,
+            book.get_chapters())
+
+    def test_pages(self):
+        labels = [label for label,_ in self.rendered.pages(2)]
+        self.assertEqual(labels, ["toc1", "toc3", "toc6", "toc7"])
+        labels = [label for label,_ in self.rendered.pages(1)]
+        self.assertEqual(labels, ["toc1", "toc7"])
+
+    def test_pages_cover_content(self):
+        pages = [self.rendered.page(label, 2)["html"]
+            for label,_ in self.rendered.pages(2)]
+        self.assertEqual("".join(pages), self.rendered.content)
+
+    def test_page_texts(self):
+        texts = self.rendered.page_texts(2)
+        self.assertEqual([label for label,_ in texts],
+            ["toc1", "toc3", "toc6", "toc7"])
+        self.assertEqual("".join(html for _,html in texts),
+            self.rendered.content)
+        chapters = self.rendered.without_content()
+        page = chapters.page("toc5", 2, texts[1][1])
+        self.assertEqual(page, self.rendered.page("toc5", 2))
+
+    def test_toc_pages(self):
+        toc = {label: page for label,_,_,page in self.rendered.toc_pages(2)}
+        self.assertEqual(toc["toc2"], "toc1")
+        self.assertEqual(toc["toc5"], "toc3")
+        self.assertEqual(toc["toc8"], "toc7")
+
+
+class TestLibscan(TestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.root = temp_library(self)
+        for name, text in (("a.fb2", sample_fb2), ("sub/b.fb2", mixed_fb2),
+                ("sub/deep/c.fb2", TestServices.fb2_example.decode()),
+                ("sub/copy.fb2", sample_fb2), ("_upload/d.fb2", sample_fb2),
+                ("notes.txt", "")):
+            path = self.root / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(text)
+        Book.objects.create(title="Moved", file="old/a.fb2",
+            hash=file_hash(self.root / "a.fb2"))
+        Book.objects.create(title="Changed", file="sub/b.fb2", hash="old")
+        Book.objects.create(title="Gone", file="gone.fb2", hash="gone")
+
+    def scan(self, *args):
+        output = StringIO()
+        call_command("libscan", *args, stdout=output)
+        lines = sorted(line for line in output.getvalue().splitlines()
+            if not line.startswith(("Searching", "Clear", "Checked", "Updating",
+                "indexed")))
+        books = sorted(Book.objects.values_list("file", "hash", "title"))
+        return lines, books
+
+    def test_scan(self):
+        lines, books = self.scan()
+        self.assertIn("moved: " + str(self.root / "a.fb2"), lines)
+        self.assertIn("updated: " + str(self.root / "sub/b.fb2"), lines)
+        self.assertIn("Deleting gone.fb2", lines)
+        files = [file for file,_,_ in books]
+        self.assertEqual(files,
+            ["a.fb2", "sub/b.fb2", "sub/copy.fb2", "sub/deep/c.fb2"])
+
+    def test_parallel_scan_matches_serial(self):
+        with transaction.atomic():
+            serial = self.scan()
+            transaction.set_rollback(True)
+        self.assertEqual(self.scan("--jobs=2"), serial)
+
+    def test_moved_books_are_not_parsed(self):
+        (self.root / "a.fb2").write_text("<FictionBook><description>")
+        Book.objects.filter(title="Moved").update(
+            hash=file_hash(self.root / "a.fb2"))
+        for args in ((), ("--jobs=2",)):
+            with self.subTest(args=args), transaction.atomic():
+                lines, books = self.scan(*args)
+                self.assertIn("moved: " + str(self.root / "a.fb2"), lines)
+                self.assertFalse(any(line.startswith("error")
+                    for line in lines))
+                transaction.set_rollback(True)
+
+    def checked_files(self, *args):
+        with patch("webbooks.library.check_book_file",
+                wraps=check_book_file) as check:
+            call_command("libscan", *args, stdout=StringIO())
+        return sorted(str(get_book_path(c.args[0])) for c in check.call_args_list)
+
+    def test_rescan_reads_changed_files(self):
+        self.scan()
+        self.assertEqual(self.checked_files(), [])
+        (self.root / "sub/b.fb2").write_text(sample_fb2)
+        self.assertEqual(self.checked_files(), ["sub/b.fb2"])
+        self.assertEqual(len(self.checked_files("--full")), 4)
+
+    def test_prune_dirs(self):
+        self.scan()
+        deep = self.root / "sub/deep"
+        mtime = deep.stat().st_mtime_ns
+        (deep / "c.fb2").write_text(sample_fb2)
+        os.utime(deep, ns=(mtime, mtime))
+        self.assertEqual(self.checked_files("--prune-dirs"), [])
+        (deep / "new.fb2").write_text(mixed_fb2)
+        self.assertEqual(self.checked_files("--prune-dirs"),
+            ["sub/deep/c.fb2", "sub/deep/new.fb2"])
+
+    def test_max_delete(self):
+        Book.objects.create(title="Gone2", file="gone2.fb2", hash="gone2")
+        with self.assertRaises(CommandError):
+            call_command("libscan", "--max-delete=1", stdout=StringIO())
+        self.assertTrue(Book.objects.filter(file="gone.fb2").exists())
+        call_command("libscan", "--max-delete=2", stdout=StringIO())
+        self.assertFalse(Book.objects.filter(file__startswith="gone").exists())
+
+    def test_prune_dirs_keeps_books(self):
+        self.scan()
+        lines, books = self.scan("--prune-dirs")
+        self.assertEqual(lines, [])
+        self.assertEqual(len(books), 4)
+
+    def test_report(self):
+        (self.root / "broken.fb2").write_text("<FictionBook><description>")
+        report_path = self.root / "_upload/report.jsonl"
+        lines, books = self.scan("--report", str(report_path))
+        self.assertIn("sub/copy.fb2", [file for file,_,_ in books])
+        self.assertTrue(any(line.startswith(f"error: {self.root}/broken.fb2")
+            for line in lines))
+        events = [json.loads(line)
+            for line in report_path.read_text().splitlines()]
+        self.assertEqual(events[0]["event"], "start")
+        summary = events[-1]
+        self.assertEqual(summary["event"], "summary")
+        self.assertEqual(summary["walked"], 5)
+        self.assertEqual(summary["errors"], 1)
+        self.assertEqual(summary["error_files"][0]["path"],
+            str(self.root / "broken.fb2"))
+        self.assertEqual(summary["statuses"],
+            {"moved": 1, "updated": 1, "created": 2, "deleted": 1})
+        self.assertLessEqual({"walk", "hash", "parse", "db", "clear"},
+            summary["phases"].keys())
+        statuses = {e["status"] for e in events if e["event"] == "file"}
+        self.assertEqual(statuses, {"moved", "updated", "created", "deleted"})
+
+
+class TestLibwatch(TestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.root = temp_library(self)
+        (self.root / "_upload").mkdir()
+        (self.root / "sub").mkdir()
+        (self.root / "sub/a.fb2").write_text(sample_fb2)
+        Book.objects.create(title="Gone", file="gone.fb2", hash="gone")
+        self.watcher = LibraryWatcher(StringIO(), delay=0.05, max_delay=1)
+        self.watcher.start()
+        self.addCleanup(self.watcher.stop)
+
+    def step(self):
+        self.assertTrue(self.watcher.collect(timeout=1))
+        self.watcher.apply()
+
+    def files(self):
+        return sorted(Book.objects.values_list("file", flat=True))
+
+    def test_start(self):
+        self.assertEqual(self.files(), ["sub/a.fb2"])
+
+    def test_changes(self):
+        (self.root / "b.fb2").write_text(mixed_fb2)
+        (self.root / "_upload/c.fb2").write_text(mixed_fb2)
+        self.step()
+        self.assertEqual(self.files(), ["b.fb2", "sub/a.fb2"])
+        indexed = ChapterText.objects.filter(
+            hash=Book.objects.get(file="b.fb2").hash)
+        self.assertTrue(indexed.exists())
+        book = Book.objects.get(file="sub/a.fb2")
+        (self.root / "sub/a.fb2").rename(self.root / "a.fb2")
+        self.step()
+        self.assertEqual(Book.objects.get(id=book.id).file, "a.fb2")
+        (self.root / "b.fb2").unlink()
+        self.step()
+        self.assertEqual(self.files(), ["a.fb2"])
+        self.assertFalse(indexed.exists())
+
+    def test_directories(self):
+        (self.root / "sub").rename(self.root / "moved")
+        self.step()
+        self.assertEqual(self.files(), ["moved/a.fb2"])
+        (self.root / "moved/new").mkdir()
+        (self.root / "moved/new/b.fb2").write_text(mixed_fb2)
+        self.step()
+        self.assertEqual(self.files(), ["moved/a.fb2", "moved/new/b.fb2"])
+        (self.root / "moved/new/b.fb2").unlink()
+        (self.root / "moved/new").rmdir()
+        self.step()
+        self.assertEqual(self.files(), ["moved/a.fb2"])
+
+    def test_overflow(self):
+        Book.objects.filter(file="sub/a.fb2").delete()
+        self.watcher.handle(Event(-1, IN_Q_OVERFLOW, 0, ""))
+        self.watcher.apply()
+        self.assertEqual(self.files(), ["sub/a.fb2"])
+
+
+class TestUpload(TestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.root = temp_library(self)
+
+    def upload(self, name, content):
+        file = SimpleUploadedFile(name, content)
+        return self.client.post(reverse("webbooks:upload_book"),
+            {"book_file": file})
+
+    def zipped(self, name, content):
+        data = BytesIO()
+        with zipfile.ZipFile(data, "w") as archive:
+            archive.writestr(name, content)
+        return data.getvalue()
+
+    def test_upload(self):
+        content = sample_fb2.encode()
+        response = self.upload("book.fb2", content)
+        book = Book.objects.get(file="book.fb2")
+        self.assertRedirects(response, reverse("webbooks:book", args=[book.id]))
+        self.assertEqual(book.hash, hashlib.md5(content).hexdigest())
+        self.assertEqual((self.root / "book.fb2").read_bytes(), content)
+        self.assertEqual(list((self.root / "_upload").iterdir()), [])
+
+    def test_upload_zip(self):
+        content = self.zipped("inner.fb2", sample_fb2)
+        self.upload("book.fb2.zip", content)
+        book = Book.objects.get(file="book.fb2.zip")
+        self.assertEqual(book.hash, hashlib.md5(content).hexdigest())
+
+    def test_duplicate(self):
+        self.upload("book.fb2", sample_fb2.encode())
+        book = Book.objects.get(file="book.fb2")
+        with patch("webbooks.views.add_uploaded_book") as add_book_file:
+            response = self.upload("copy.fb2", sample_fb2.encode())
+        add_book_file.assert_not_called()
+        self.assertRedirects(response,
+            reverse("webbooks:book_exists", args=[book.id]))
+        self.assertEqual(list((self.root / "_upload").iterdir()), [])
+
+    def test_rejected(self):
+        for name, content, error in (
+                ("book.fb2", b"PK\x03\x04", "not an fb2 book"),
+                ("book.fb2.zip", sample_fb2.encode(), "not a zip archive"),
+                ("book.fb2.zip", self.zipped("a.txt", "text"),
+                    "No .fb2 file"),
+                ("book.txt", b"<FictionBook/>", "should end with"),
+                ("book.fb2", b"", "empty")):
+            with self.subTest(name=name, error=error):
+                response = self.upload(name, content)
+                self.assertContains(response, error)
+                self.assertEqual(list((self.root / "_upload").iterdir()), [])
+        self.assertEqual(Book.objects.count(), 0)
+
+    def test_failed_request(self):
+        client = Client(enforce_csrf_checks=True)
+        # The page sets the CSRF cookie, so the form is read for the token
+        client.get(reverse("webbooks:upload_book"))
+        response = client.post(reverse("webbooks:upload_book"),
+            {"book_file": SimpleUploadedFile("book.fb2", sample_fb2.encode())})
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(list((self.root / "_upload").iterdir()), [])
+        with patch("webbooks.views.add_uploaded_book",
+                side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                self.upload("book.fb2", sample_fb2.encode())
+        self.assertEqual(list((self.root / "_upload").iterdir()), [])
+        self.assertEqual(Book.objects.count(), 0)
+
+    def test_zip_members(self):
+        data = self.zipped("a.txt", "text")
+        self.assertEqual(uploads.zip_members(data), (["a.txt"], True))
+        self.assertEqual(uploads.zip_members(data[:40]), (["a.txt"], False))
+
+
+class TestJobs(TestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.root = temp_library(self, WEBBOOKS_BACKGROUND_UPLOADS=True)
+
+    def upload(self, name, content):
+        file = SimpleUploadedFile(name, content)
+        return self.client.post(reverse("webbooks:upload_book"),
+            {"book_file": file})
+
+    def work(self, *args):
+        out = StringIO()
+        call_command("libworker", "--once", *args, stdout=out)
+        return out.getvalue()
+
+    def test_upload(self):
+        response = self.upload("book.fb2", sample_fb2.encode())
+        job = Job.objects.get()
+        job_url = reverse("webbooks:job", args=[job.id])
+        self.assertRedirects(response, job_url)
+        self.assertEqual(Book.objects.count(), 0)
+        self.assertContains(self.client.get(job_url), "being processed")
+        status_url = reverse("webbooks:job_status", args=[job.id])
+        self.assertEqual(self.client.get(status_url).json(),
+            {"status": "queued", "url": None})
+        self.work()
+        book = Book.objects.get(file="book.fb2")
+        book_url = reverse("webbooks:book", args=[book.id])
+        self.assertEqual(self.client.get(status_url).json(),
+            {"status": "done", "url": book_url})
+        self.assertRedirects(self.client.get(job_url), book_url)
+        self.assertEqual(list((self.root / "_upload").iterdir()), [])
+
+    def test_upload_exists(self):
+        (self.root / "book.fb2").write_text(sample_fb2)
+        book = add_book(self.root / "book.fb2")
+        path = self.root / "_upload"
+        path.mkdir()
+        (path / ".upload-1").write_text(sample_fb2)
+        job = jobs.enqueue_upload(path / ".upload-1", book.hash, "book.fb2")
+        self.work()
+        job.refresh_from_db()
+        self.assertEqual(job.result_url(),
+            reverse("webbooks:book_exists", args=[book.id]))
+        self.assertEqual(list(path.iterdir()), [])
+
+    def test_retry(self):
+        path = self.root / "_upload"
+        path.mkdir()
+        (path / ".upload-1").write_text("<FictionBook>")
+        job = jobs.enqueue_upload(path / ".upload-1", "", "bad.fb2")
+        self.work("--retry-delay=0", "--max-attempts=2")
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ("failed", 2))
+        self.assertFalse((path / ".upload-1").exists())
+        response = self.client.get(reverse("webbooks:job_status",
+            args=[job.id]))
+        self.assertIn("error", response.json())
+
+    def test_retry_delay(self):
+        job = jobs.enqueue_upload(self.root / "missing.fb2", "", "a.fb2")
+        self.work()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ("queued", 1))
+        self.assertGreater(job.run_after, job.started)
+
+    def test_claim(self):
+        first = jobs.enqueue_rescan()
+        second = jobs.enqueue_upload("a.fb2", "", "a.fb2")
+        self.assertEqual(jobs.claim_job(["upload"]), second)
+        self.assertIsNone(jobs.claim_job(["upload"]))
+        claimed = jobs.claim_job(["upload", "rescan"])
+        self.assertEqual((claimed, claimed.status), (first, "running"))
+
+    def test_rescan(self):
+        (self.root / "a").mkdir()
+        (self.root / "a" / "book.fb2").write_text(sample_fb2)
+        (self.root / "b.fb2").write_text(mixed_fb2)
+        self.work("--rescan", "a")
+        self.work()
+        self.assertEqual(list(Book.objects.values_list("file", flat=True)),
+            [os.path.join("a", "book.fb2")])
+        self.work("--rescan")
+        self.work()
+        self.assertEqual(Book.objects.count(), 2)
+        job = Job.objects.last()
+        self.assertEqual(job.status, "done")
+        self.assertIn("Checked", job.message)
+
+
+
+class TestFulltext(TestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.root = temp_library(self)
+        (self.root / "a.fb2").write_text(
+            sample_fb2.replace("Beginning.", "Зелёная ёлка &amp; &lt;co&gt;."))
+        (self.root / "b.fb2").write_text(mixed_fb2)
+        call_command("libscan", stdout=StringIO())
+
+    def test_book_chapters(self):
+        chapters = list(fulltext.book_chapters(self.root / "a.fb2"))
+        self.assertEqual([c[:3] for c in chapters],
+            [("toc2", "1.1", "First title.")])
+        self.assertIn("poem1", chapters[0][3])
+        self.assertNotIn("i_127.png", chapters[0][3])
+
+    def test_search(self):
+        book = Book.objects.get(file="a.fb2")
+        hits = fulltext.search("ЗЕЛЕНАЯ елка")
+        self.assertEqual([(h.book, h.chapter.label) for h in hits],
+            [(book, "toc2")])
+        self.assertEqual(hits[0].url,
+            reverse("webbooks:read", args=[book.id]) + "#toc2")
+        self.assertIn("<mark>Зеленая</mark> <mark>елка</mark> &amp; &lt;co",
+            hits[0].snippet)
+        self.assertEqual(fulltext.search('"title" OR'), [])
+        self.assertEqual(fulltext.search("*"), [])
+
+    def test_incremental(self):
+        (self.root / "copy.fb2").write_bytes((self.root / "a.fb2").read_bytes())
+        (self.root / "a.fb2").unlink()
+        with patch("webbooks.fulltext.book_chapters") as book_chapters:
+            call_command("libscan", stdout=StringIO())
+        book_chapters.assert_not_called()
+        hits = fulltext.search("елка")
+        self.assertEqual([h.book.file for h in hits], ["copy.fb2"])
+        (self.root / "copy.fb2").unlink()
+        call_command("libscan", stdout=StringIO())
+        self.assertEqual(fulltext.search("елка"), [])
+        self.assertEqual(ChapterText.objects.count(),
+            len(list(fulltext.book_chapters(self.root / "b.fb2"))))
+
+    def test_update_hashes(self):
+        a, b = Book.objects.order_by("file")
+        Book.objects.filter(id=b.id).delete()
+        (self.root / "c.fb2").write_text(sample_fb2)
+        c, _ = check_book_file(self.root / "c.fb2")
+        with patch.object(fulltext, "chapters_task",
+                wraps=fulltext.chapters_task) as chapters_task:
+            counts = fulltext.update_index(hashes=[a.hash, c.hash])
+        self.assertEqual(counts, {"indexed": 1, "removed": 0, "errors": 0})
+        chapters_task.assert_called_once_with((c.hash, self.root / "c.fb2"))
+        self.assertTrue(ChapterText.objects.filter(hash=b.hash).exists())
+        counts = fulltext.update_index(hashes=[b.hash])
+        self.assertEqual(counts, {"indexed": 0, "removed": 1, "errors": 0})
+        self.assertFalse(ChapterText.objects.filter(hash=b.hash).exists())
+        (self.root / "a.fb2").write_text(sample_fb2)
+        call_command("libscan", stdout=StringIO())
+        self.assertFalse(ChapterText.objects.filter(hash=a.hash).exists())
+
+    def test_rebuild(self):
+        count = ChapterText.objects.count()
+        out = StringIO()
+        call_command("libindex", "--rebuild", "--jobs=2", stdout=out)
+        self.assertIn("indexed: 2, removed: 0, errors: 0", out.getvalue())
+        self.assertEqual(ChapterText.objects.count(), count)
+        self.assertEqual(len(fulltext.search("елка")), 1)
+
+    def test_views(self):
+        response = self.client.get(reverse("webbooks:search_text"),
+            {"q": "ёлка"})
+        self.assertContains(response, "<mark>елка</mark>")
+        self.assertContains(response, "#toc2")
+        response = self.client.get(reverse("webbooks:textsearch-list"),
+            {"q": "ёлка"})
+        self.assertEqual([h["chapter"] for h in response.json()], ["toc2"])
+        self.assertGreater(len(fulltext.search("title")), 1)
+        response = self.client.get(reverse("webbooks:textsearch-list"),
+            {"q": "title", "limit": -1})
+        self.assertEqual(len(response.json()), 1)
+
+
+class TestCatalogSearch(TestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.war = Book.objects.create(title="Война и Мир", file="a.fb2")
+        self.trees = Book.objects.create(title="Ёлки", file="b.fb2")
+        self.author = Author.objects.create(name="Лев Толстой")
+        self.mirror = Sequence.objects.create(name="Мировые ёлки")
+
+    def test_search_key(self):
+        self.assertEqual(search_key("Ёлки-Палки"), "елки-палки")
+        self.assertEqual(self.trees.search_key, "елки")
+        metadata = BookProcessor(sample_fb2).get_metadata()
+        with BookImporter() as importer:
+            importer.add(f"{conf.WEBBOOKS_ROOT}/c.fb2", "hash", metadata,
+                os.stat(__file__))
+        self.assertEqual(Book.objects.get(hash="hash").search_key, "title")
+        ids = NameCache(Author).get_ids(["ЁЖ"])
+        self.assertEqual(Author.objects.get(id=ids[0]).search_key, "еж")
+
+    def test_search(self):
+        self.assertEqual(catalog.search("мир", "book"), [self.war])
+        self.assertEqual(catalog.search("ми", "sequence"), [self.mirror])
+        self.assertEqual(catalog.search("ЕЛК", "book"), [self.trees])
+        self.assertEqual(catalog.search("толстой лев", "author"),
+            [self.author])
+        self.assertEqual(catalog.search("лев пушкин", "author"), [])
+        self.assertEqual(catalog.search('"*', "book"), [])
+
+    def test_index_sync(self):
+        Book.objects.filter(id=self.war.id).delete()
+        self.assertEqual(catalog.search("мир", "book"), [])
+        self.trees.title = "Мир"
+        self.trees.save()
+        self.assertEqual(catalog.search("мир", "book"), [self.trees])
+        Book.objects.bulk_create([Book(title="Мир", search_key="мир")])
+        self.assertEqual(len(catalog.search("мир", "book")), 2)
+
+    def test_suggest(self):
+        Book.objects.create(title="Мирный атом", file="c.fb2")
+        found = catalog.suggest("мир", limit=2)
+        # Whole title prefix comes first
+        self.assertEqual([b.title for b in found["book"]],
+            ["Мирный атом", "Война и Мир"])
+        self.assertEqual(found["sequence"], [self.mirror])
+        self.assertEqual(found["author"], [])
+        response = self.client.get(reverse("webbooks:search_suggest"),
+            {"q": "лев"})
+        self.assertEqual(response.json()["authors"], [{"id": self.author.id,
+            "name": "Лев Толстой",
+            "url": reverse("webbooks:author", args=[self.author.id])}])
+
+    def test_views(self):
+        response = self.client.get(reverse("webbooks:search"), {"q": "ёлки"})
+        self.assertContains(response, "Ёлки</a>")
+        self.assertContains(response, "Мировые ёлки")
+        response = self.client.get(reverse("webbooks:search-list"),
+            {"q": "мир", "kind": "sequence"})
+        self.assertEqual([s["name"] for s in response.json()],
+            ["Мировые ёлки"])
+        Book.objects.create(title="Мирный атом", file="c.fb2")
+        response = self.client.get(reverse("webbooks:search-list"),
+            {"q": "мир", "limit": -1})
+        self.assertEqual(len(response.json()), 1)
+        with patch.object(catalog, "is_available", return_value=False):
+            response = self.client.get(reverse("webbooks:search-list"),
+                {"q": "мир", "limit": -1})
+        self.assertEqual(len(response.json()), 1)
+
+    def test_rebuild(self):
+        Book.objects.update(search_key="")
+        call_command("libindex", "--catalog", stdout=StringIO())
+        self.assertEqual(catalog.search("мир", "book"), [self.war])
+
+
+class TestAuthorIndex(TestCase):
+    databases = "__all__"
+
+    def letter_counts(self):
+        return dict(AuthorLetter.objects.filter(count__gt=0)
+            .values_list("letter", "count"))
+
+    def test_letter_counts(self):
+        author = Author.objects.create(name="ёжиков")
+        Author.objects.create(name="Ежов")
+        Author.objects.create(name="1984")
+        NameCache(Author).get_ids(["Арсеньев", "ежи"])
+        self.assertEqual(author.letter, "Е")
+        self.assertEqual(self.letter_counts(), {"Е": 3, "А": 1, "#": 1})
+        author.name = "Зайцев"
+        author.save()
+        Author.objects.filter(name="1984").delete()
+        expected = {"Е": 2, "А": 1, "З": 1}
+        self.assertEqual(self.letter_counts(), expected)
+        AuthorLetter.objects.all().delete()
+        counts.recount_letters()
+        self.assertEqual(self.letter_counts(), expected)
+
+    def test_pages(self):
+        names = ["Б2", "а3", "А1", "б1", "в1"]
+        authors = {name: Author.objects.create(name=name) for name in names}
+        book = Book.objects.create(title="Book", file="a.fb2")
+        book.authors.add(authors["а3"])
+        url = reverse("webbooks:authors")
+        with patch.object(IndexView, "page_size", 2):
+            response = self.client.get(url)
+            page = response.context["author_list"]
+            self.assertEqual([a.name for a in page], ["А1", "а3"])
+            self.assertEqual([a.book_count for a in page], [0, 1])
+            self.assertEqual(response.context["total"], 5)
+            response = self.client.get(url,
+                {"after": response.context["next_after"]})
+            self.assertEqual([a.name for a in response.context["author_list"]],
+                ["б1", "Б2"])
+            response = self.client.get(url,
+                {"after": response.context["next_after"]})
+            self.assertEqual([a.name for a in response.context["author_list"]],
+                ["в1"])
+            self.assertNotIn("next_after", response.context)
+            response = self.client.get(url, {"letter": "Б"})
+            self.assertEqual([a.name for a in response.context["author_list"]],
+                ["б1", "Б2"])
+            self.assertEqual(response.context["total"], 2)
+            self.assertNotIn("next_after", response.context)
+            response = self.client.get(url, {"letter": "б"})
+            self.assertEqual(response.context["letter"], "Б")
+            self.assertEqual([a.name for a in response.context["author_list"]],
+                ["б1", "Б2"])
+        self.assertContains(response, "?letter=%D0%90")
+
+
+class TestBookCounts(TestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.root = temp_library(self)
+
+    def counts(self):
+        return {model.__name__: dict(model.objects.filter(book_count__gt=0)
+            .values_list("name", "book_count"))
+            for model in (Author, Genre, Sequence)}
+
+    def actual_counts(self):
+        return {model.__name__: dict(model.objects
+            .annotate(count=Count("book")).filter(count__gt=0)
+            .values_list("name", "count"))
+            for model in (Author, Genre, Sequence)}
+
+    def test_signals(self):
+        (self.root / "a.fb2").write_text(sample_fb2)
+        book = add_book(self.root / "a.fb2")
+        expected = {"Author": {"Doe Bob Jr Tester": 1}, "Genre": {"prose_classic": 1},
+            "Sequence": {"Sequence.": 1}}
+        self.assertEqual(self.counts(), expected)
+        other = Author.objects.create(name="Other")
+        book.authors.add(other)
+        other.book_set.add(Book.objects.create(title="B", file="b.fb2"))
+        self.assertEqual(self.counts()["Author"],
+            {"Doe Bob Jr Tester": 1, "Other": 2})
+        book.authors.remove(other, Author.objects.create(name="Unlinked"))
+        other.book_set.clear()
+        book.genres.clear()
+        book.sequence = None
+        book.save()
+        self.assertEqual(self.counts(), {"Author": {"Doe Bob Jr Tester": 1},
+            "Genre": {}, "Sequence": {}})
+        self.assertEqual(self.counts(), self.actual_counts())
+        Book.objects.all().delete()
+        self.assertEqual(self.counts(), {"Author": {}, "Genre": {},
+            "Sequence": {}})
+
+    def test_libscan(self):
+        for name in ("a.fb2", "b.fb2", "sub/c.fb2"):
+            path = self.root / name
+            path.parent.mkdir(exist_ok=True)
+            path.write_text(sample_fb2.replace("Title", name))
+        (self.root / "d.fb2").write_text(mixed_fb2)
+        call_command("libscan", "--no-fulltext", stdout=StringIO())
+        self.assertEqual(self.counts()["Author"]["Doe Bob Jr Tester"], 3)
+        self.assertEqual(self.counts(), self.actual_counts())
+        (self.root / "sub/c.fb2").unlink()
+        (self.root / "b.fb2").write_text(mixed_fb2.replace("<p>", "<p>b", 1))
+        call_command("libscan", "--no-fulltext", stdout=StringIO())
+        self.assertEqual(self.counts()["Author"]["Doe Bob Jr Tester"], 1)
+        self.assertEqual(self.counts(), self.actual_counts())
+
+    def test_delete_batch(self):
+        authors = [Author.objects.create(name=f"Author {i}") for i in range(3)]
+        genre = Genre.objects.create(name="genre")
+        sequence = Sequence.objects.create(name="Sequence")
+        books = []
+        for i in range(50):
+            book = Book.objects.create(title=f"Title {i}", file=f"{i}.fb2",
+                hash=f"hash{i % 25}", sequence=sequence)
+            book.authors.set(authors)
+            book.genres.add(genre)
+            Comment.objects.create(book=book, text="Comment")
+            books.append(book)
+        self.assertEqual(DuplicateGroup.objects.count(), 25)
+        kept = books.pop()
+        job = Job.objects.create(kind="upload", book=books[0])
+        with self.assertNumQueries(21):
+            library.delete_books(Mock(),
+                [(book.id, book.file) for book in books])
+        self.assertEqual(list(Book.objects.all()), [kept])
+        self.assertEqual(self.counts(), self.actual_counts())
+        self.assertEqual(Comment.objects.count(), 1)
+        self.assertEqual(DuplicateGroup.objects.count(), 0)
+        job.refresh_from_db()
+        self.assertIsNone(job.book)
+
+    def test_librecount(self):
+        (self.root / "a.fb2").write_text(sample_fb2)
+        add_book(self.root / "a.fb2")
+        Author.objects.update(book_count=5)
+        Genre.objects.update(book_count=0)
+        out = StringIO()
+        call_command("librecount", stdout=out)
+        self.assertIn("authors: 1, genres: 1, sequences: 0", out.getvalue())
+        self.assertEqual(self.counts(), self.actual_counts())
+
+    def test_merge_names(self):
+        # Names are unique now, duplicates of older databases are rows
+        # with other names here
+        authors = [Author.objects.create(name=f"Author {i}") for i in range(3)]
+        genres = [Genre.objects.create(name=f"genre{i}") for i in range(2)]
+        sequences = [Sequence.objects.create(name=f"S{i}") for i in range(2)]
+        books = [Book.objects.create(title=f"T{i}", file=f"{i}.fb2",
+            sequence=sequences[i % 2]) for i in range(3)]
+        books[0].authors.set(authors)
+        books[1].authors.set(authors[1:])
+        books[2].authors.set(authors[:1])
+        books[0].genres.set(genres[1:])
+        merge_names(Author, [a.id for a in authors])
+        merge_names(Genre, [g.id for g in genres])
+        merge_names(Sequence, [s.id for s in sequences])
+        self.assertEqual(list(Author.objects.all()), authors[:1])
+        self.assertEqual(list(Genre.objects.all()), genres[:1])
+        self.assertEqual(list(Sequence.objects.all()), sequences[:1])
+        for book in books:
+            self.assertEqual(list(book.authors.all()), authors[:1])
+            book.refresh_from_db()
+            self.assertEqual(book.sequence, sequences[0])
+        self.assertEqual(list(books[0].genres.all()), genres[:1])
+        out = StringIO()
+        call_command("libmergenames", stdout=out)
+        self.assertIn("Merged 0 duplicate authors", out.getvalue())
+
+
+class TestQueryBudget(TestCase):
+    """ Every page runs a fixed number of queries, whatever the data size. """
+    databases = "__all__"
+
+    # url name: largest number of queries
+    budgets = {
+        "index": 0,
+        "authors": 2,
+        "duplicates": 5,
+        "near_duplicates": 4,
+        "author": 2,
+        "book": 3,
+        "read": 2,
+        "book_image": 2,
+        "read_chapter": 2,
+        "read_chapter_json": 1,
+        "user_comments": 2,
+        "comment": 3,
+        "comments_json": 2,
+        "download_book": 1,
+        "upload_book": 0,
+        "book_exists": 1,
+        "search": 4,
+        "search_suggest": 6,
+        "search_text": 4,
+        "job": 1,
+        "job_status": 1,
+        "api-root": 0,
+        "author-list": 2,
+        "author-detail": 1,
+        "genre-list": 2,
+        "genre-detail": 1,
+        "sequence-list": 2,
+        "sequence-detail": 1,
+        "book-list": 4,
+        "book-detail": 3,
+        "fullbook-list": 4,
+        "fullbook-detail": 3,
+        "search-list": 4,
+        "textsearch-list": 4,
+        "duplicategroup-list": 4,
+        "duplicategroup-detail": 3,
+    }
+
+    def setUp(self):
+        self.root = temp_library(self)
+        (self.root / "book.fb2").write_text(sample_fb2)
+        self.user = User.objects.create_user("reader")
+        self.books = []
+
+    def add_books(self, count):
+        """ Add books with shared authors, genres, and comments. """
+        size = len(self.books)
+        authors = [Author.objects.create(name=f"Author {size+i}")
+            for i in range(count)]
+        genres = [Genre.objects.create(name=f"genre{size+i}")
+            for i in range(count)]
+        for i in range(count):
+            book = Book.objects.create(title=f"Title {size+i}",
+                file="book.fb2", hash="hash",
+                sequence=Sequence.objects.get_or_create(name="Sequence")[0],
+                sequence_number=size+i)
+            book.authors.set(Author.objects.all())
+            book.genres.set(genres)
+            self.books.append(book)
+        for book in self.books:
+            for i in range(count):
+                Comment.objects.create(book=book, text=f"Comment {i}",
+                    username=self.user.username, userid=self.user.pk)
+        fulltext.update_index()
+
+    def requests(self):
+        book = self.books[0]
+        author = Author.objects.order_by("id").first()
+        genre = Genre.objects.order_by("id").first()
+        job = Job.objects.create(kind="upload", name="a.fb2")
+        text = {"q": "image"}
+        yield "index", [], {}
+        yield "authors", [], {}
+        yield "duplicates", [], {}
+        yield "near_duplicates", [], {}
+        yield "author", [author.id], {}
+        yield "book", [book.id], {}
+        yield "read", [book.id], {}
+        yield "book_image", [book.id, "i_127.png"], {}
+        yield "read_chapter", [book.id, "toc1"], {}
+        yield "read_chapter_json", [book.id, "toc1"], {}
+        yield "user_comments", [self.user.id], {}
+        yield "comment", [book.id], {"text": "Text", "userid": self.user.id}
+        yield "comments_json", [book.id], {}
+        yield "download_book", [book.id], {}
+        yield "upload_book", [], {}
+        yield "book_exists", [book.id], {}
+        yield "search", [], {"q": "title"}
+        yield "search_suggest", [], {"q": "t", "limit": 1}
+        yield "search_text", [], text
+        yield "job", [job.id], {}
+        yield "job_status", [job.id], {}
+        api = {"format": "json"}
+        yield "api-root", [], api
+        for name, id in [("author", author.id), ("genre", genre.id),
+                ("sequence", book.sequence_id), ("book", book.id),
+                ("fullbook", book.id),
+                ("duplicategroup", DuplicateGroup.objects.get().id)]:
+            yield f"{name}-list", [], api
+            yield f"{name}-detail", [id], api
+        yield "search-list", [], {"q": "title", **api}
+        yield "textsearch-list", [], {**text, **api}
+
+    def count_queries(self):
+        """ Numbers of queries by url name. """
+        counts = {}
+        for name, args, params in self.requests():
+            url = reverse("webbooks:" + name, args=args)
+            contexts = [CaptureQueriesContext(connections[alias])
+                for alias in connections]
+            with ExitStack() as stack:
+                for context in contexts:
+                    stack.enter_context(context)
+                if name == "comment":
+                    response = self.client.post(url, params)
+                else:
+                    response = self.client.get(url, params)
+                if response.streaming:
+                    b"".join(response.streaming_content)
+            self.assertLess(response.status_code, 400, name)
+            counts[name] = sum(len(context) for context in contexts)
+        return counts
+
+    def test_all_views(self):
+        names = {pattern.name for pattern in urls.urlpatterns
+            if hasattr(pattern, "name")}
+        names |= {pattern.name for pattern in urls.router.urls}
+        names.discard("api-root.format")
+        self.assertEqual(names - self.budgets.keys(), set())
+
+    def test_budgets(self):
+        self.add_books(2)
+        small = self.count_queries()
+        self.add_books(8)
+        self.maxDiff = None
+        self.assertEqual(self.count_queries(), small)
+        for name, count in small.items():
+            self.assertLessEqual(count, self.budgets[name], name)
+
+
+@override_settings(WEBBOOKS_COMMENTS_PAGE=2)
+class TestComments(TestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.user = User.objects.create_user("reader")
+        self.book = Book.objects.create(title="Title", file="book.fb2")
+        other = Book.objects.create(title="Other", file="other.fb2")
+        now = timezone.now()
+        # Comments 0 and 1 have the same time, ordered by id
+        times = [now - timedelta(days) for days in (4, 4, 3, 2, 1)]
+        self.comments = [Comment.objects.create(book=self.book,
+            text=f"Comment {i}", username="reader", userid=self.user.pk,
+            time=time) for i, time in enumerate(times)]
+        Comment.objects.create(book=other, text="Other", username="reader",
+            userid=self.user.pk, time=now - timedelta(5))
+
+    def test_comments_json(self):
+        url = reverse("webbooks:comments_json", args=[self.book.id])
+        texts = []
+        while url:
+            data = self.client.get(url).json()
+            self.assertLessEqual(len(data["comments"]), 2)
+            texts += [comment["text"] for comment in data["comments"]]
+            url = data["next"]
+        self.assertEqual(texts, [f"Comment {i}" for i in range(4, -1, -1)])
+        comment = self.comments[3]
+        self.assertEqual(data["comments"][0]["url"],
+            self.comments[0].link())
+        url = reverse("webbooks:comments_json", args=[self.book.id])
+        data = self.client.get(url, {"start": comment.id}).json()
+        self.assertEqual([c["id"] for c in data["comments"]],
+            [comment.id, self.comments[2].id])
+
+    def test_book_page(self):
+        comment = self.comments[1]
+        response = self.client.get(comment.link())
+        self.assertNotContains(response, "Comment 1")
+        url = reverse("webbooks:comments_json", args=[self.book.id])
+        self.assertContains(response, f'data-url="{url}?start={comment.id}"')
+
+    def test_user_comments(self):
+        url = reverse("webbooks:user_comments", args=[self.user.id])
+        response = self.client.get(url)
+        self.assertContains(response, "Comment 4")
+        self.assertContains(response, "Comment 3")
+        self.assertNotContains(response, "Comment 2")
+        self.assertContains(response, f"?start={self.comments[2].id}")
+        response = self.client.get(self.comments[0].user_link())
+        self.assertContains(response, "Comment 0")
+        self.assertContains(response, "Other")
+        self.assertNotContains(response, "Comment 1")
+        self.assertNotContains(response, "Next")
+
+    def test_post_comment(self):
+        url = reverse("webbooks:comment", args=[self.book.id])
+        response = self.client.post(url, {"text": "New",
+            "userid": self.user.id})
+        comment = Comment.objects.get(text="New")
+        book_url = reverse("webbooks:book", args=[self.book.id])
+        self.assertRedirects(response, f"{book_url}#{comment.anchor()}",
+            fetch_redirect_response=False)
+        url = reverse("webbooks:comments_json", args=[self.book.id])
+        data = self.client.get(url).json()
+        self.assertEqual(data["comments"][0]["id"], comment.id)
+
+
+class TestDuplicates(TestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.root = temp_library(self)
+
+    def write(self, name, content):
+        path = self.root / name
+        path.parent.mkdir(exist_ok=True)
+        path.write_text(content)
+        return path
+
+    def groups(self):
+        self.assertEqual(self.totals(), self.actual_totals())
+        return {(group.count, group.wasted)
+            for group in DuplicateGroup.objects.all()}
+
+    def totals(self):
+        totals = DuplicateTotals.objects.first() or DuplicateTotals()
+        return (totals.groups, totals.books, totals.wasted)
+
+    def actual_totals(self):
+        totals = DuplicateGroup.objects.aggregate(groups=Count("id"),
+            books=Sum("count"), wasted=Sum("wasted"))
+        return (totals["groups"], totals["books"] or 0, totals["wasted"] or 0)
+
+    def test_libscan(self):
+        size = len(sample_fb2.encode())
+        for name in ("a.fb2", "b.fb2", "sub/c.fb2"):
+            self.write(name, sample_fb2)
+        self.write("d.fb2", mixed_fb2)
+        call_command("libscan", "--no-fulltext", stdout=StringIO())
+        self.assertEqual(self.groups(), {(3, 2*size)})
+        self.write("b.fb2", mixed_fb2)
+        self.write("e.fb2", mixed_fb2)
+        call_command("libscan", "--no-fulltext", stdout=StringIO())
+        mixed = len(mixed_fb2.encode())
+        self.assertEqual(self.groups(), {(2, size), (3, 2*mixed)})
+        (self.root / "sub/c.fb2").unlink()
+        call_command("libscan", "--no-fulltext", stdout=StringIO())
+        self.assertEqual(self.groups(), {(3, 2*mixed)})
+        Book.objects.filter(hash=DuplicateGroup.objects.get().hash).delete()
+        self.assertEqual(self.groups(), set())
+
+    def test_save(self):
+        books = [add_book(self.write(name, sample_fb2))
+            for name in ("a.fb2", "b.fb2")]
+        for book in books:
+            book.save()
+        self.assertEqual(self.groups(), {(2, len(sample_fb2.encode()))})
+        books[1].hash = "other"
+        books[1].save()
+        self.assertEqual(self.groups(), set())
+        DuplicateGroup.objects.create(hash="wrong", count=2)
+        self.assertNotEqual(self.totals(), self.actual_totals())
+        out = StringIO()
+        call_command("librecount", stdout=out)
+        self.assertIn("Found 0 groups", out.getvalue())
+        self.assertEqual(self.totals(), (0, 0, 0))
+        books[1].hash = books[0].hash
+        books[1].save()
+        self.assertEqual(len(self.groups()), 1)
+
+    @patch.object(DuplicatesView, "page_size", 2)
+    def test_pages(self):
+        for i in range(5):
+            for name in ("a", "b"):
+                Book.objects.create(title=f"{name}{i}", file=f"{name}{i}.fb2",
+                    hash=f"hash{i}", file_size=i)
+        url = reverse("webbooks:duplicates")
+        hashes = []
+        params = {}
+        while True:
+            with patch.object(DuplicateGroup.objects, "aggregate") as aggregate:
+                response = self.client.get(url, params)
+            aggregate.assert_not_called()
+            self.assertContains(response, "5 groups, 10 books")
+            self.assertContains(response, "10\xa0bytes wasted.")
+            groups = response.context["group_list"]
+            hashes += [group.hash for group in groups]
+            self.assertEqual([len(group.books) for group in groups],
+                [2]*len(groups))
+            if "next_after" not in response.context:
+                break
+            params = {"after": response.context["next_after"]}
+        self.assertEqual(hashes, [f"hash{i}" for i in range(4, -1, -1)])
+        response = self.client.get(reverse("webbooks:duplicategroup-list"))
+        data = response.json()["results"]
+        self.assertEqual([group["wasted"] for group in data], [4, 3, 2, 1, 0])
+        self.assertEqual([book["title"] for book in data[0]["books"]],
+            ["a4", "b4"])
+
+
+def words_fb2(words):
+    """ Sample book with text of the words. """
+    return sample_fb2.replace("<p>Beginning.</p>",
+        f"<p>{' '.join(words)}</p>")
+
+
+@unittest.skipUnless(importlib.util.find_spec("numpy"), "needs NumPy")
+class TestNearDuplicates(TestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.root = temp_library(self)
+        self.words = [f"w{i}" for i in range(1000)]
+
+    def add(self, name, words):
+        path = self.root / name
+        path.write_text(words_fb2(words))
+        book = add_book(path)
+        book.save()
+        return book
+
+    def libdupes(self, *args):
+        out = StringIO()
+        call_command("libdupes", "--jobs=1", *args, stdout=out)
+        return out.getvalue()
+
+    def test_similarity(self):
+        signatures = [neardupes.minhash(neardupes.shingles(" ".join(words)))
+            for words in (self.words, self.words[:990], self.words[500:])]
+        self.assertEqual(len(signatures[0]), neardupes.num_perm)
+        self.assertGreater(neardupes.similarity(*signatures[:2]), 0.9)
+        self.assertLess(neardupes.similarity(signatures[0], signatures[2]),
+            0.7)
+
+    def test_libdupes(self):
+        edited = self.words.copy()
+        edited[500] = "typo"
+        books = [self.add("a.fb2", self.words), self.add("b.fb2", edited),
+            self.add("c.fb2", [f"x{i}" for i in range(1000)])]
+        self.add("copy.fb2", self.words)
+        output = self.libdupes()
+        self.assertIn("signed: 3, removed: 0, similar: 1", output)
+        self.assertIn("a.fb2", output)
+        self.assertNotIn("c.fb2", output)
+        cluster = TextSignature.objects.get(hash=books[0].hash).cluster
+        self.assertEqual(set(TextSignature.objects.filter(cluster=cluster)
+            .values_list("hash", flat=True)), {books[0].hash, books[1].hash})
+        output = self.libdupes()
+        self.assertIn("signed: 0", output)
+        self.assertNotIn("Cluster", output)
+        self.assertIn("a.fb2", self.libdupes("--all"))
+        self.add("d.fb2", self.words[:995])
+        with patch.object(neardupes, "update_clusters") as update_clusters:
+            output = self.libdupes()
+        update_clusters.assert_not_called()
+        self.assertIn("signed: 1, removed: 0, similar: 2", output)
+        self.assertIn("d.fb2", output)
+        Book.objects.filter(file__in=["b.fb2", "d.fb2"]).delete()
+        output = self.libdupes()
+        self.assertIn("removed: 2", output)
+        self.assertFalse(TextSignature.objects.filter(cluster__isnull=False)
+            .exists())
+
+    def test_merge_clusters(self):
+        using = neardupes.index_db()
+        ids = [TextSignature.objects.create(hash=f"hash{i}").id
+            for i in range(6)]
+        def pairs(*values):
+            return SimilarPair.objects.bulk_create(
+                SimilarPair(first_id=ids[first], second_id=ids[second],
+                    similarity=value) for first, second, value in values)
+        neardupes.merge_clusters(pairs((0, 1, 0.9), (2, 3, 0.85)), using)
+        changed = neardupes.merge_clusters(pairs((3, 4, 0.82), (1, 4, 0.95),
+            (2, 5, 0.8)), using)
+        self.assertEqual(changed, {ids[0]})
+        self.assertEqual(neardupes.current_clusters([ids[2], ids[5]], using),
+            {ids[0]})
+        merged = list(TextSignature.objects.order_by("id")
+            .values_list("cluster", "similarity"))
+        self.assertEqual(merged, [(ids[0], 0.9), (ids[0], 0.95),
+            (ids[0], 0.85), (ids[0], 0.85), (ids[0], 0.95), (ids[0], 0.8)])
+        neardupes.update_clusters(using)
+        self.assertEqual(list(TextSignature.objects.order_by("id")
+            .values_list("cluster", "similarity")), merged)
+
+    def test_unreadable_books(self):
+        book = self.add("a.fb2", self.words)
+        with patch.object(neardupes, "book_text",
+                side_effect=PermissionError("denied")):
+            output = self.libdupes()
+        self.assertIn("signed: 0, removed: 0, similar: 0, errors: 1", output)
+        self.assertFalse(TextSignature.objects.exists())
+        with patch.object(neardupes, "book_text", return_value=""):
+            output = self.libdupes()
+        self.assertIn("signed: 1, removed: 0, similar: 0, errors: 0", output)
+        self.assertEqual(TextSignature.objects.get().hash, book.hash)
+
+    def test_view(self):
+        self.add("a.fb2", self.words)
+        self.add("b.fb2", self.words[1:])
+        self.libdupes()
+        response = self.client.get(reverse("webbooks:near_duplicates"))
+        cluster, = response.context["cluster_list"]
+        self.assertEqual([book.file for book in cluster.books],
+            ["a.fb2", "b.fb2"])
+        self.assertContains(response, "a.fb2")
+
+    def test_no_numpy(self):
+        with patch.dict(sys.modules, {"numpy": None}):
+            with self.assertRaises(CommandError):
+                self.libdupes()
@@ -1,12 +1,12 @@
 from pathlib import Path
 import tempfile
 import unittest
-from unittest.mock import Mock,call
+from unittest.mock import Mock,call,patch
 import xml.etree.ElementTree as ET
 import zipfile
 
 from webbooks.fb2book import (Chapter,TableOfChapters,ImageProcessor,
-    BookScanner,DocWriter,BookProcessor)
+    BookScanner,DocWriter,BookProcessor,BookParser,BinaryIndex)
 
 
 sample_fb2 = """\
@@ -194,6 +194,35 @@ class ImageProcessorTest(unittest.TestCase):
         self.assertEqual(data, "123")
         self.assertEqual(type, "image/png")
 
+    def test_extracted_link(self):
+        ip = ImageProcessor(embed=False, link_template="img/{name}")
+        ip.actor = Mock()
+        ip.add_internal_image("#a b.png")
+        ip.actor.link_image.assert_called_once_with("img/a%20b.png")
+
+
+class BinaryIndexTest(unittest.TestCase):
+
+    def check_index(self, path):
+        index = BinaryIndex(path)
+        self.assertEqual(sorted(index.binaries), ["cover.jpg", "i_127.png"])
+        data, content_type = index.read("i_127.png")
+        self.assertEqual(data, b"y\xf8!")
+        self.assertEqual(content_type, "image/png")
+        self.assertEqual(index.read("missing"), (None, None))
+
+    def test_index(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            path = Path(dirname, "book.fb2")
+            declaration = '<?xml version="1.0" encoding="windows-1251"?>\n'
+            text = declaration + sample_fb2.replace("Title", "Заглавие")
+            path.write_text(text, encoding="cp1251")
+            self.check_index(path)
+            zippath = Path(dirname, "book.fb2.zip")
+            with zipfile.ZipFile(zippath, "w") as archive:
+                archive.writestr("book.fb2", sample_fb2)
+            self.check_index(zippath)
+
 
 @unittest.skip
 class FB2BookTest(unittest.TestCase):
@@ -237,6 +266,15 @@ class FB2BookTest(unittest.TestCase):
             book = FB2Book(file=zippath)
         self.check_description(book)
 
+    def test_content_size(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            zippath = Path(dirname, "book.fb2.zip")
+            with zipfile.ZipFile(zippath, "w", zipfile.ZIP_DEFLATED) as archive:
+                archive.writestr("book.fb2", self.fb2)
+            size = len(self.fb2.encode())
+            self.assertEqual(BookParser.content_size(zippath), size)
+            self.assertLess(zippath.stat().st_size, size)
+
     def test_external_image_link(self):
         book = FB2Book(self.fb2)
         images = book.root.findall(".//image")
@@ -345,6 +383,159 @@ poem2<br>
 """
 
 
+class MetadataOnlyTest(unittest.TestCase):
+
+    fields = ("title", "authors", "genres", "date", "annotation",
+        "sequence", "sequence_number")
+
+    def check_metadata(self, text=None, file=None):
+        full = BookProcessor(sample_fb2).get_metadata()
+        book = BookProcessor(text, file, mode="metadata")
+        self.assertIsNone(book.scanner)
+        metadata = book.get_metadata()
+        for field in self.fields:
+            with self.subTest(field=field):
+                self.assertEqual(getattr(metadata, field), getattr(full, field))
+
+    def test_metadata_only(self):
+        self.check_metadata(sample_fb2)
+
+    @patch.object(BookParser, "chunk_size", 16)
+    def test_stops_after_description(self):
+        head = sample_fb2.partition("<body>")[0]
+        self.check_metadata(head + "<body></broken>")
+
+    @patch.object(BookParser, "chunk_size", 16)
+    def test_description_root(self):
+        parser = BookParser(sample_fb2, description_only=True)
+        self.assertEqual([e.tag for e in parser.tree], ["description"])
+
+    def test_zip(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            zippath = Path(dirname, "book.fb2.zip")
+            with zipfile.ZipFile(zippath, "w") as archive:
+                archive.writestr("book.fb2", sample_fb2)
+            self.check_metadata(file=zippath)
+
+    def test_no_sequence(self):
+        fb2 = sample_fb2.replace('<sequence name="Sequence." number="2"/>', '')
+        metadata = BookProcessor(fb2, mode="metadata").get_metadata()
+        self.assertEqual(metadata.sequence, "")
+
+
+mixed_fb2 = """\
+<?xml version="1.0" encoding="utf-8"?>
+<fb:FictionBook xmlns:fb="http://www.gribuser.ru/xml/fictionbook/2.0" xmlns:l="http://www.w3.org/1999/xlink">
+<fb:description><fb:title-info>
+    <fb:book-title>Mixed</fb:book-title>
+    <fb:coverpage><fb:image l:href="#missing.jpg"/><fb:image l:href="#b.png"/></fb:coverpage>
+</fb:title-info></fb:description>
+text outside of bodies
+<fb:body>
+<fb:title><fb:p>Book <fb:emphasis>title</fb:emphasis></fb:p><fb:empty-line/><fb:p>second line</fb:p></fb:title>
+<fb:epigraph><fb:p>Epigraph</fb:p><fb:text-author>Someone</fb:text-author></fb:epigraph>
+<fb:section>
+    <fb:title><fb:p>Image <fb:image l:href="#b.png"/> in title</fb:p></fb:title>
+    <fb:p>  Spaces  &amp; entities &lt;kept&gt;  </fb:p>
+    <fb:title><fb:p>Extra title</fb:p></fb:title>
+    <fb:section><fb:section><fb:p>Deep<fb:strong>strong</fb:strong>tail</fb:p></fb:section></fb:section>
+    <fb:subtitle>Sub</fb:subtitle>
+    <fb:table><fb:tr><fb:th>h</fb:th><fb:td>d</fb:td></fb:tr></fb:table>
+    <fb:image l:href="#b.png">ignored</fb:image> image tail
+    <fb:cite><fb:p>Cite</fb:p></fb:cite>
+</fb:section>
+<fb:section><fb:title><fb:p>Last</fb:p></fb:title><fb:p>x<fb:sup>2</fb:sup></fb:p></fb:section>
+</fb:body>
+<fb:body name="notes"><fb:section><fb:p>Note</fb:p></fb:section></fb:body>
+<fb:binary id="b.png" content-type="image/png">ab
+cd</fb:binary>
+<fb:binary id="b.png" content-type="image/png">duplicate</fb:binary>
+</fb:FictionBook>
+"""
+
+
+structured_fb2 = """\
+<FictionBook>
+<body>
+[first_text]
+<section>
+[section1_text]
+    <section>
+    [section1_1_text]
+    </section>
+[section1_end]
+</section>
+[last_text]
+</body>
+</FictionBook>
+"""
+
+
+class StreamScannerTest(unittest.TestCase):
+
+    samples = {
+        "sample": sample_fb2,
+        "structured": structured_fb2,
+        "mixed": mixed_fb2,
+        "empty": "<FictionBook><body></body></FictionBook>",
+    }
+
+    def check_same_output(self, text=None, file=None):
+        for format in ("html", "text"):
+            with self.subTest(format=format):
+                tree = BookProcessor(text, file).get_content(format)
+                stream = BookProcessor(text, file, mode="stream")
+                self.assertEqual(stream.get_content(format), tree)
+
+    def test_same_output(self):
+        for name, text in self.samples.items():
+            with self.subTest(sample=name):
+                self.check_same_output(text)
+
+    @patch.object(BookParser, "chunk_size", 7)
+    def test_same_output_split_chunks(self):
+        for name, text in self.samples.items():
+            with self.subTest(sample=name):
+                self.check_same_output(text)
+
+    def test_same_output_files(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            for name, text in self.samples.items():
+                path = Path(dirname, name+".fb2")
+                path.write_text(text)
+                zippath = Path(dirname, name+".fb2.zip")
+                with zipfile.ZipFile(zippath, "w") as archive:
+                    archive.writestr(name+".fb2", text)
+                with self.subTest(sample=name):
+                    self.check_same_output(file=path)
+                    self.check_same_output(file=zippath)
+
+    def test_linked_images(self):
+        for mode in ("full", "stream"):
+            with self.subTest(mode=mode):
+                book = BookProcessor(sample_fb2, mode=mode,
+                    image_url="img/{name}")
+                text, toc = book.get_content()
+                self.assertIn('<img src="img/i_127.png">', text)
+                self.assertIn('<img src="img/cover.jpg">', toc+text)
+                self.assertNotIn("base64", text)
+
+    @patch.object(BookParser, "chunk_size", 20)
+    def test_iter_content(self):
+        for name, text in self.samples.items():
+            with self.subTest(sample=name):
+                expected = BookProcessor(text, image_url="img/{name}") \
+                    .get_content()
+                book = BookProcessor(text, mode="stream",
+                    image_url="img/{name}")
+                pieces = list(book.iter_content())
+                self.assertEqual(("".join(pieces), book.get_toc()), expected)
+
+    def test_stream_metadata(self):
+        book = BookProcessor(mixed_fb2, mode="stream")
+        self.assertEqual(book.get_metadata().title, "Mixed")
+
+
 class BookProcessorTest(unittest.TestCase):
 
     def test_book_processor_creation(self):
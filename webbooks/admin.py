@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import Book,Author,Sequence,Genre,Comment
+from .models import Book,Author,Sequence,Genre,Comment,Job
 
 class BookToAuthorInline(admin.TabularInline):
     model = Book.authors.through
@@ -24,7 +24,12 @@ class AuthorAdmin(admin.ModelAdmin):
         text = ",".join(b["title"] for b in author.book_set.values("title").all())
         return text
 
+class JobAdmin(admin.ModelAdmin):
+    list_display = ["id", "kind", "status", "name", "path", "attempts", "created"]
+    list_filter = ["status", "kind"]
+
 admin.site.register(Book, BookAdmin)
 admin.site.register(Author, AuthorAdmin)
 admin.site.register(Sequence)
 admin.site.register(Genre)
+admin.site.register(Job, JobAdmin)
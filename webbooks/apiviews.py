@@ -1,7 +1,11 @@
+from django.db.models import prefetch_related_objects
 from rest_framework import viewsets
+from rest_framework.response import Response
 
 import webbooks.models as m
 import webbooks.serializers as s
+from webbooks import catalog, fulltext
+from webbooks.services import group_books
 
 
 
@@ -18,9 +22,71 @@ class SequenceViewSet(viewsets.ModelViewSet):
     serializer_class = s.SequenceSerializer
 
 class BookViewSet(viewsets.ModelViewSet):
-    queryset = m.Book.objects.order_by("id")
+    queryset = m.Book.objects.order_by("id") \
+        .prefetch_related("authors", "genres")
     serializer_class = s.BookSerializer
 
 class FullBookViewSet(viewsets.ModelViewSet):
-    queryset = m.Book.objects.order_by("id").prefetch_related()
+    queryset = m.Book.objects.order_by("id").select_related("sequence") \
+        .prefetch_related("authors", "genres")
     serializer_class = s.FullBookSerializer
+
+class DuplicateGroupViewSet(viewsets.ReadOnlyModelViewSet):
+    """Groups of books with the same hash, most wasted bytes first."""
+    queryset = m.DuplicateGroup.objects.order_by("-wasted", "id")
+    serializer_class = s.DuplicateGroupSerializer
+
+    def paginate_queryset(self, queryset):
+        page = super().paginate_queryset(queryset)
+        return page if page is None else group_books(page)
+
+    def get_object(self):
+        return group_books([super().get_object()])[0]
+
+class SearchViewSet(viewsets.ViewSet):
+    """Search of books, authors and sequences by words of their names:
+    ?q=words&kind=book|author|sequence&limit=50"""
+    serializers = {
+        "book": s.BookSerializer,
+        "author": s.AuthorSerializer,
+        "sequence": s.SequenceSerializer,
+    }
+
+    def list(self, request):
+        query = request.query_params.get("q", "")
+        kind = request.query_params.get("kind", "book")
+        if kind not in self.serializers:
+            kind = "book"
+        try:
+            limit = max(min(int(request.query_params.get("limit", 50)), 200),
+                1)
+        except ValueError:
+            limit = 50
+        rows = catalog.search(query, kind, limit)
+        if kind == "book":
+            prefetch_related_objects(rows, "authors", "genres")
+        serializer = self.serializers[kind](rows, many=True,
+            context={"request": request})
+        return Response(serializer.data)
+
+class TextSearchViewSet(viewsets.ViewSet):
+    """Full-text search in book contents: ?q=words&limit=20&offset=0"""
+    def list(self, request):
+        query = request.query_params.get("q", "")
+        try:
+            limit = max(min(int(request.query_params.get("limit", 20)), 100),
+                1)
+            offset = max(int(request.query_params.get("offset", 0)), 0)
+        except ValueError:
+            limit, offset = 20, 0
+        hits = fulltext.search(query, limit, offset)
+        return Response([{
+            "book": hit.book.id,
+            "title": hit.book.title,
+            "chapter": hit.chapter.label,
+            "number": hit.chapter.number,
+            "chapter_title": hit.chapter.title,
+            "snippet": hit.snippet,
+            "url": request.build_absolute_uri(hit.url),
+        } for hit in hits])
+
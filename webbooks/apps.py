@@ -1,6 +1,25 @@
 from django.apps import AppConfig
+from django.db import router
+from django.db.models.signals import post_migrate
+
+
+def create_fulltext_tables(sender, using, **kwargs):
+    """ FTS5 tables are not models, they are created after migrations. """
+    from . import catalog, fulltext
+    from .models import Book, ChapterText
+    if fulltext.is_available(using) and \
+            router.allow_migrate_model(using, ChapterText):
+        fulltext.create_table(using)
+    if catalog.is_available(using) and \
+            router.allow_migrate_model(using, Book):
+        catalog.create_tables(using)
 
 
 class WebBooksConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'webbooks'
+
+    def ready(self):
+        # Signal receivers of the stored counts
+        from . import counts
+        post_migrate.connect(create_fulltext_tables, sender=self)
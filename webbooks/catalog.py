@@ -0,0 +1,153 @@
+""" Search of book titles, author and sequence names.
+
+Lookups use the folded search_key columns: a prefix of the whole key is
+found by its B-tree index, a prefix of any word by an SQLite FTS5 table
+per model, kept in sync with the key column by triggers, so bulk inserts
+and queryset deletes update it too. Other database backends have only
+the whole key prefix search.
+"""
+
+import re
+
+from django.db import connections, router, transaction
+
+from . import counts
+from .models import *
+
+
+models = {"book": Book, "author": Author, "sequence": Sequence}
+
+# Largest code point, every key with a prefix is less than prefix + it
+key_end = "\U0010ffff"
+
+
+def index_db():
+    return router.db_for_write(Book)
+
+
+def is_available(using=None):
+    return connections[using or index_db()].vendor == "sqlite"
+
+
+def fts_table(model):
+    return model._meta.db_table + "_fts"
+
+
+def table_statements(model):
+    table = model._meta.db_table
+    fts = fts_table(model)
+    yield (f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING"
+        " fts5(search_key, tokenize='unicode61', prefix='1 2 3')")
+    yield (f"CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {table}"
+        f" BEGIN INSERT INTO {fts}(rowid, search_key)"
+        " VALUES (new.id, new.search_key); END")
+    yield (f"CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {table}"
+        f" BEGIN DELETE FROM {fts} WHERE rowid = old.id; END")
+    yield (f"CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF"
+        f" search_key ON {table} BEGIN UPDATE {fts}"
+        " SET search_key = new.search_key WHERE rowid = old.id; END")
+
+
+def create_tables(using):
+    """ Create the word indexes and fill the new ones from the keys. """
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        existing = set(connection.introspection.table_names(cursor))
+        for model in models.values():
+            for statement in table_statements(model):
+                cursor.execute(statement)
+            if fts_table(model) not in existing:
+                fill_table(cursor, model)
+
+
+def fill_table(cursor, model):
+    fts = fts_table(model)
+    cursor.execute(f"DELETE FROM {fts}")
+    cursor.execute(f"INSERT INTO {fts}(rowid, search_key)"
+        f" SELECT id, search_key FROM {model._meta.db_table}")
+
+
+def rebuild(batch_size=1000):
+    """ Fill search keys of all rows and rebuild the word indexes.
+
+    Author letter counts are recounted too.
+    """
+    using = index_db()
+    for model in models.values():
+        field = "title" if model is Book else "name"
+        with transaction.atomic(using=using):
+            rows = []
+            for row in model.objects.using(using).only("id", field) \
+                    .iterator(chunk_size=batch_size):
+                row.update_keys()
+                rows.append(row)
+                if len(rows) >= batch_size:
+                    model.objects.using(using).bulk_update(rows,
+                        model.key_fields)
+                    rows = []
+            model.objects.using(using).bulk_update(rows, model.key_fields)
+            if is_available(using):
+                with connections[using].cursor() as cursor:
+                    fill_table(cursor, model)
+    counts.recount_letters()
+
+
+def query_words(text):
+    return re.findall(r"\w+", search_key(text))
+
+
+def word_query(words):
+    """ FTS5 query for rows with words starting with all the words. """
+    return " ".join(f'"{word}"*' for word in words)
+
+
+def word_matches(model, words, limit, ranked=True):
+    """ Ids of rows with word prefixes, best first if ranked. """
+    fts = fts_table(model)
+    order = "ORDER BY rank" if ranked else ""
+    with connections[index_db()].cursor() as cursor:
+        cursor.execute(f"SELECT rowid FROM {fts} WHERE {fts} MATCH %s"
+            f" {order} LIMIT %s", [word_query(words), limit])
+        return [id for id, in cursor.fetchall()]
+
+
+def prefix_matches(model, key, limit):
+    """ Rows with search key starting with key, by the key index. """
+    return list(model.objects.filter(search_key__gte=key,
+        search_key__lt=key + key_end).order_by("search_key")[:limit])
+
+
+def ordered_rows(model, ids):
+    rows = model.objects.in_bulk(ids)
+    return [rows[id] for id in ids if id in rows]
+
+
+def search(text, kind, limit=50):
+    """ Rows of the kind with all words of the text, best first. """
+    model = models[kind]
+    words = query_words(text)
+    if not words:
+        return []
+    if not is_available():
+        return prefix_matches(model, " ".join(words), limit)
+    return ordered_rows(model, word_matches(model, words, limit))
+
+
+def suggest(text, limit=10):
+    """ Up to limit rows of every kind for typeahead.
+
+    Rows starting with the text come first, alphabetically, then rows
+    with words starting with it, unranked, which is fast for any prefix.
+    """
+    key = search_key(text).strip()
+    words = query_words(text)
+    result = {}
+    for kind, model in models.items():
+        rows = prefix_matches(model, key, limit) if key else []
+        if len(rows) < limit and words and is_available():
+            found = {row.id for row in rows}
+            ids = [id for id in word_matches(model, words, limit*2, False)
+                if id not in found]
+            rows += ordered_rows(model, ids[:limit - len(rows)])
+        result[kind] = rows
+    return result
@@ -5,6 +5,19 @@ from django.conf import settings
 class default:
     WEBBOOKS_ROOT = str(Path.home() / "webbooks")
     WEBBOOKS_UPLOAD = str( Path(WEBBOOKS_ROOT, "_upload") )
+    # Rendered books cache: "disk", "django" or "" to disable
+    WEBBOOKS_RENDER_CACHE = "disk"
+    WEBBOOKS_RENDER_CACHE_DIR = str(Path.home() / ".cache" / "webbooks")
+    WEBBOOKS_RENDER_CACHE_SIZE = 2*1024**3
+    WEBBOOKS_RENDER_CACHE_ALIAS = "default"
+    # Bigger books are not cached on reading, but streamed while rendered
+    WEBBOOKS_STREAM_SIZE = 4*1024**2
+    # Paged reader splits books at chapters up to this depth
+    WEBBOOKS_CHAPTER_DEPTH = 2
+    # Queue uploaded books for libworker instead of adding them in request
+    WEBBOOKS_BACKGROUND_UPLOADS = False
+    # Comments on a page of user comments or loaded on a book page at once
+    WEBBOOKS_COMMENTS_PAGE = 50
 
 
 def __getattr__(name):
@@ -0,0 +1,317 @@
+""" Stored counts, kept up to date by model signals and bulk changes.
+
+Book counts of authors, genres and sequences, and groups of books with
+the same hash with their totals change with book saves, deletes and
+links. Bulk inserts send no signals, so their code calls
+books_inserted(). librecount repairs counts changed in other ways.
+"""
+
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+import threading
+
+from django.db import router, transaction
+from django.db.models import Count, F, Min, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.db.models.signals import (pre_save, post_save, pre_delete,
+    post_delete, m2m_changed)
+from django.dispatch import receiver
+
+from .models import *
+
+
+# Per thread flags of the receivers
+state = threading.local()
+
+# Book link: (model, link field, through model)
+book_links = {
+    "authors": (Author, "author_id", Book.authors.through),
+    "genres": (Genre, "genre_id", Book.genres.through),
+}
+
+
+def change_letter_counts(changes):
+    """ Add Counter of letter: change to the author letter counts. """
+    for letter, change in changes.items():
+        if not change:
+            continue
+        updated = AuthorLetter.objects.filter(letter=letter).update(
+            count=F("count") + change)
+        if not updated:
+            AuthorLetter.objects.get_or_create(letter=letter)
+            AuthorLetter.objects.filter(letter=letter).update(
+                count=F("count") + change)
+
+
+def authors_added(authors):
+    """ Count authors created by a bulk insert, which sends no signals. """
+    change_letter_counts(Counter(author.letter for author in authors))
+
+
+def recount_letters():
+    """ Count authors by letter again. """
+    with transaction.atomic(using=router.db_for_write(AuthorLetter)):
+        AuthorLetter.objects.all().delete()
+        AuthorLetter.objects.bulk_create(
+            AuthorLetter(letter=row["letter"], count=row["count"])
+            for row in Author.objects.values("letter")
+                .annotate(count=Count("id")).order_by())
+
+
+@receiver(pre_save, sender=Author)
+def remember_letter(sender, instance, raw=False, **kwargs):
+    instance.saved_letter = None
+    if instance.pk is not None and not raw:
+        instance.saved_letter = Author.objects.filter(pk=instance.pk) \
+            .values_list("letter", flat=True).first()
+
+
+@receiver(post_save, sender=Author)
+def count_saved_author(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    changes = Counter()
+    if created or instance.saved_letter is None:
+        changes[instance.letter] += 1
+    elif instance.saved_letter != instance.letter:
+        changes[instance.saved_letter] -= 1
+        changes[instance.letter] += 1
+    change_letter_counts(changes)
+
+
+@receiver(post_delete, sender=Author)
+def count_deleted_author(sender, instance, **kwargs):
+    change_letter_counts(Counter({instance.letter: -1}))
+
+
+def change_book_counts(model, changes, batch_size=500):
+    """ Add Counter of id: change to book_count, a query per change. """
+    by_change = defaultdict(list)
+    for id, change in changes.items():
+        if change and id is not None:
+            by_change[change].append(id)
+    for change, ids in by_change.items():
+        for start in range(0, len(ids), batch_size):
+            model.objects.filter(id__in=ids[start:start+batch_size]) \
+                .update(book_count=F("book_count") + change)
+
+
+def linked_counts(book_ids, sign=1):
+    """ Changes of book counts by the links and sequences of books. """
+    book_ids = list(book_ids)
+    changes = []
+    for model, field, through in book_links.values():
+        rows = through.objects.filter(book_id__in=book_ids).values(field) \
+            .annotate(count=Count("id")).values_list(field, "count") \
+            .order_by()
+        changes.append((model, Counter({id: sign*n for id, n in rows})))
+    rows = Book.objects.filter(id__in=book_ids).values("sequence_id") \
+        .annotate(count=Count("id")).values_list("sequence_id", "count") \
+        .order_by()
+    changes.append((Sequence, Counter({id: sign*n for id, n in rows})))
+    return changes
+
+
+def books_inserted(book_ids, batch_size=500):
+    """ Count books with links added by bulk inserts. """
+    book_ids = list(book_ids)
+    for start in range(0, len(book_ids), batch_size):
+        batch = book_ids[start:start+batch_size]
+        for model, changes in linked_counts(batch):
+            change_book_counts(model, changes)
+        update_groups(Book.objects.filter(id__in=batch)
+            .values_list("hash", flat=True))
+
+
+@contextmanager
+def book_deletes_counted():
+    """ Receivers of book deletes do nothing, the caller counts them. """
+    state.deletes_counted = True
+    try:
+        yield
+    finally:
+        state.deletes_counted = False
+
+
+def delete_books(book_ids):
+    """ Delete books, their links and comments with a few queries.
+
+    Receivers of book deletes would change counts of every book
+    separately, so they are muted and counts are changed here at once.
+    Returns the hashes of the deleted books.
+    """
+    book_ids = list(book_ids)
+    books = Book.objects.filter(id__in=book_ids)
+    with transaction.atomic(using=router.db_for_write(Book)):
+        hashes = set(books.values_list("hash", flat=True))
+        for model, changes in linked_counts(book_ids, -1):
+            change_book_counts(model, changes)
+        with book_deletes_counted():
+            books.delete()
+        update_groups(hashes)
+    return hashes
+
+
+def hash_groups(books):
+    """ Values of duplicate groups for the books, by hash. """
+    size = Coalesce("file_size", Value(0))
+    return books.values("hash").order_by().annotate(count=Count("id"),
+        wasted=Sum(size) - Min(size)).filter(count__gt=1)
+
+
+def group_totals(groups):
+    """ Counter of DuplicateTotals fields for DuplicateGroup rows. """
+    return Counter(groups=len(groups),
+        books=sum(group.count for group in groups),
+        wasted=sum(group.wasted for group in groups))
+
+
+def change_duplicate_totals(changes):
+    """ Add Counter of field: change to the duplicate group totals. """
+    changes = {field: F(field) + change
+        for field, change in changes.items() if change}
+    if not changes:
+        return
+    updated = DuplicateTotals.objects.update(**changes)
+    if not updated:
+        DuplicateTotals.objects.get_or_create(id=1)
+        DuplicateTotals.objects.update(**changes)
+
+
+def update_groups(hashes, batch_size=500):
+    """ Update duplicate groups of the hashes from their books. """
+    hashes = list({hash for hash in hashes if hash})
+    for start in range(0, len(hashes), batch_size):
+        batch = hashes[start:start+batch_size]
+        groups = [DuplicateGroup(**row)
+            for row in hash_groups(Book.objects.filter(hash__in=batch))]
+        with transaction.atomic(using=router.db_for_write(DuplicateGroup)):
+            old = list(DuplicateGroup.objects.filter(hash__in=batch)
+                .only("hash", "count", "wasted"))
+            kept = {group.hash for group in groups}
+            gone = [group.id for group in old if group.hash not in kept]
+            if gone:
+                DuplicateGroup.objects.filter(id__in=gone).delete()
+            DuplicateGroup.objects.bulk_create(groups, update_conflicts=True,
+                unique_fields=["hash"], update_fields=["count", "wasted"])
+            changes = group_totals(groups)
+            changes.subtract(group_totals(old))
+            change_duplicate_totals(changes)
+
+
+def regroup_duplicates(batch_size=1000):
+    """ Find all duplicate groups again, returns the number of groups. """
+    with transaction.atomic(using=router.db_for_write(DuplicateGroup)):
+        DuplicateGroup.objects.all().delete()
+        groups = DuplicateGroup.objects.bulk_create(
+            (DuplicateGroup(**row) for row in hash_groups(Book.objects)),
+            batch_size=batch_size)
+        DuplicateTotals.objects.all().delete()
+        DuplicateTotals.objects.create(id=1, **group_totals(groups))
+    return len(groups)
+
+
+def recount_books():
+    """ Count books of all authors, genres and sequences again.
+
+    Returns numbers of rows with wrong counts by model name.
+    """
+    fixed = {}
+    for name, (model, field, through) in book_links.items():
+        counted = through.objects.filter(**{field: OuterRef("id")}) \
+            .values(field).annotate(count=Count("id")).values("count")
+        fixed[name] = recount(model, counted)
+    counted = Book.objects.filter(sequence_id=OuterRef("id")) \
+        .values("sequence_id").annotate(count=Count("id")).values("count")
+    fixed["sequences"] = recount(Sequence, counted)
+    return fixed
+
+
+def recount(model, counted):
+    actual = Coalesce(Subquery(counted), Value(0))
+    with transaction.atomic(using=router.db_for_write(model)):
+        wrong = model.objects.annotate(actual=actual) \
+            .exclude(book_count=F("actual")).count()
+        if wrong:
+            model.objects.update(book_count=actual)
+    return wrong
+
+
+@receiver(pre_save, sender=Book)
+def remember_saved_book(sender, instance, raw=False, **kwargs):
+    instance.saved_sequence_id = instance.saved_hash = None
+    if instance.pk is not None and not raw:
+        saved = Book.objects.filter(pk=instance.pk) \
+            .values_list("sequence_id", "hash").first()
+        if saved:
+            instance.saved_sequence_id, instance.saved_hash = saved
+
+
+@receiver(post_save, sender=Book)
+def count_saved_book(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    changes = Counter()
+    if not created:
+        changes[instance.saved_sequence_id] -= 1
+    changes[instance.sequence_id] += 1
+    change_book_counts(Sequence, changes)
+    update_groups([instance.hash, instance.saved_hash])
+
+
+@receiver(pre_delete, sender=Book)
+def count_deleted_book(sender, instance, **kwargs):
+    if getattr(state, "deletes_counted", False):
+        return
+    # Links are deleted without m2m_changed signals
+    for model, changes in linked_counts([instance.pk], -1):
+        change_book_counts(model, changes)
+
+
+@receiver(post_delete, sender=Book)
+def group_deleted_book(sender, instance, **kwargs):
+    if getattr(state, "deletes_counted", False):
+        return
+    update_groups([instance.hash])
+
+
+def count_links(linked, field, through, instance, action, reverse, pk_set,
+        **kwargs):
+    """ Update book counts of linked model rows, linked to books by field.
+
+    Removed and cleared links are found before the change, as pk_set
+    of removed ones may have ids which are not linked.
+    """
+    if reverse:
+        # instance is an author or a genre, pk_set are book ids
+        links = through.objects.filter(**{field: instance.pk})
+        target = "book_id"
+    else:
+        links = through.objects.filter(book_id=instance.pk)
+        target = field
+    if action == "pre_remove":
+        links = links.filter(**{target + "__in": pk_set})
+    if action in ("pre_remove", "pre_clear"):
+        instance.removed_links = list(links.values_list(target, flat=True))
+        return
+    if action == "post_add":
+        ids, sign = pk_set, 1
+    elif action in ("post_remove", "post_clear"):
+        ids, sign = instance.removed_links, -1
+    else:
+        return
+    if reverse:
+        changes = Counter({instance.pk: sign*len(ids)})
+    else:
+        changes = Counter({id: sign for id in ids})
+    change_book_counts(linked, changes)
+
+
+@receiver(m2m_changed, sender=Book.authors.through)
+def count_author_links(sender, **kwargs):
+    count_links(Author, "author_id", sender, **kwargs)
+
+
+@receiver(m2m_changed, sender=Book.genres.through)
+def count_genre_links(sender, **kwargs):
+    count_links(Genre, "genre_id", sender, **kwargs)
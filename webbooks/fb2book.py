@@ -6,15 +6,26 @@
 # http://www.fictionbook.org/index.php/Eng:XML_Schema_Fictionbook_2.1
 
 import xml.etree.ElementTree as ET
+import base64
 import re
 import os
 import zipfile
+from urllib.parse import quote
+from xml.parsers import expat
+
+
+# Change when rendered output changes, to drop cached renders
+RENDERER_VERSION = 2
 
 
 class BookParser:
 
-    def __init__(self, text=None, file=None):
-        if text is None:
+    chunk_size = 64*1024
+
+    def __init__(self, text=None, file=None, description_only=False):
+        if description_only:
+            self.tree = self.parse_description(text, file)
+        elif text is None:
             self.tree = self.parse_file(file)
         else:
             self.tree = ET.fromstring(text)
@@ -22,32 +33,82 @@ class BookParser:
 
     def parse_file(self, file):
         handle = self.open(file)
-        root = ET.parse(handle).getroot()
+        try:
+            root = ET.parse(handle).getroot()
+        finally:
+            if handle is not file:
+                handle.close()
         return root
 
-    def open_zip(self, file):
-        with zipfile.ZipFile(file) as container:
-            names = container.namelist()
-            for name in names:
-                if name.endswith(".fb2"):
-                    return container.open(name)
-            raise NameError("Unable to find .fb2 file inside .fb2.zip")
+    def parse_description(self, text=None, file=None):
+        """ Parse only the root and <description>, stop after it is closed. """
+        parser = ET.XMLPullParser(events=("start", "end"))
+        root = None
+        for chunk in self.read_chunks(text, file):
+            parser.feed(chunk)
+            for event, element in parser.read_events():
+                if root is None:
+                    root = element
+                elif event == "end" and self.strip_tag(element.tag) == "description":
+                    return root
+        parser.close()
+        return root
 
-    def open(self, file):
+    @classmethod
+    def read_chunks(cls, text=None, file=None):
+        if text is not None:
+            for start in range(0, len(text), cls.chunk_size):
+                yield text[start:start+cls.chunk_size]
+            return
+        handle = cls.open(file)
+        if handle is file:
+            handle.seek(0)
+        try:
+            yield from iter(lambda: handle.read(cls.chunk_size), b"")
+        finally:
+            if handle is not file:
+                handle.close()
+
+    @staticmethod
+    def zip_member(container):
+        for info in container.infolist():
+            if info.filename.endswith(".fb2"):
+                return info
+        raise NameError("Unable to find .fb2 file inside .fb2.zip")
+
+    @classmethod
+    def open_zip(cls, file):
+        with zipfile.ZipFile(file) as container:
+            return container.open(cls.zip_member(container))
+
+    @classmethod
+    def content_size(cls, file):
+        """ Size of the book xml, uncompressed for .fb2.zip files. """
+        if str(file).endswith(".fb2.zip"):
+            with zipfile.ZipFile(file) as container:
+                return cls.zip_member(container).file_size
+        return os.stat(file).st_size
+
+    @classmethod
+    def open(cls, file):
         is_file_like = all(hasattr(file, attr)
             for attr in ('seek', 'close', 'read', 'write'))
         if is_file_like:
             handle = file
         elif str(file).endswith(".fb2.zip"):
-            handle = self.open_zip(file)
+            handle = cls.open_zip(file)
         else:
             handle = open(file, "rb")
         return handle
 
+    @staticmethod
+    def strip_tag(tag):
+        return tag[tag.rfind('}')+1:]
+
     def strip_namespaces(self):
         """ Hack to not bother with namespaces """
         for element in self.tree.iter():
-            element.tag = element.tag[element.tag.rfind('}')+1:]
+            element.tag = self.strip_tag(element.tag)
 
 
 class BookMetadata:
@@ -57,7 +118,7 @@ class BookMetadata:
         self.title_info = None
         self.authors = []
         self.genres = []
-        self.sequence_name = ""
+        self.sequence = ""
         self.sequence_number = 1
 
     def collect(self):
@@ -80,7 +141,7 @@ class BookMetadata:
             elif child.tag == "sequence":
                 self.collect_sequence_info(child)
             elif child.tag != "coverpage":
-                metadata[child.tag] = child.text.strip()
+                metadata[child.tag] = (child.text or "").strip()
         return metadata
 
     def annotation_to_text(self):
@@ -167,11 +228,18 @@ class TableOfChapters:
 
 
 class ImageProcessor:
+    """ Embed internal images or link them by link_template.
+
+    The template gets url-quoted binary id as {name}.
+    """
 
-    def __init__(self, root=None, actor=None, embed=True):
+    def __init__(self, root=None, actor=None, embed=True,
+            link_template="{name}"):
         self.root = root
         self.actor = actor
         self.embed = embed
+        self.link_template = link_template
+        self.binaries = None
 
     def add_image(self, image_node):
         link = self.get_image_link(image_node)
@@ -190,6 +258,9 @@ class ImageProcessor:
             new_link = self.extracted_link(name)
             self.link_image(new_link)
 
+    def extracted_link(self, name):
+        return self.link_template.format(name=quote(name))
+
     def embed_image(self, name):
         data, content_type  = self.get_image_data(name)
         if data:
@@ -205,19 +276,31 @@ class ImageProcessor:
             if k.endswith("href"):
                 return v
 
+    def get_binaries(self):
+        """ Index <binary> elements by id, first one wins. """
+        if self.binaries is None:
+            self.binaries = {}
+            for binary in self.root.findall("binary"):
+                self.binaries.setdefault(binary.attrib.get('id'), binary)
+        return self.binaries
+
     def get_image_data(self, link):
         name = link.removeprefix('#')
-        for binary in self.root.findall("binary"):
-            if binary.attrib['id'] == name:
-                content_type = binary.attrib.get("content-type", "image/jpg")
-                return binary.text, content_type
-        return None, None
+        binary = self.get_binaries().get(name)
+        if binary is None:
+            return None, None
+        content_type = binary.attrib.get("content-type", "image/jpg")
+        return binary.text, content_type
 
 
 class BookScanner:
 
-    def __init__(self, tree):
+    chapter_tags = ("body", "section")
+
+    def __init__(self, tree, image_url=None):
+        """ Images are embedded, or linked by image_url template if given. """
         self.tree = tree
+        self.image_url = image_url
         self.actor = None
 
     def scan_inner(self, tree):
@@ -238,25 +321,27 @@ class BookScanner:
         if chapter.is_named():
             self.add_chapter_for_extra_title()
 
-    def wrap_chapter(self, tree):
-        is_chapter = tree.tag in ("body","section")
-        if is_chapter:
+    def open_tag(self, tag):
+        if tag == "title":
+            self.handle_new_title()
+        self.actor.add_tag(tag)
+        if tag in self.chapter_tags:
             chapter = self.toc.add_chapter()
             self.actor.add_chapter(chapter)
-        self.scan_inner(tree)
-        if is_chapter:
+
+    def close_tag(self, tag):
+        if tag in self.chapter_tags:
             chapter = self.toc.end_chapter()
             self.actor.end_chapter(chapter)
-
-    def text_tag(self, tree):
-        if tree.tag == "title":
-            self.handle_new_title()
-        self.actor.add_tag(tree.tag)
-        self.wrap_chapter(tree)
-        if tree.tag == "title":
+        if tag == "title":
             text = self.actor.fragments.copy_tag_text()
             self.toc.add_chapter_title(text)
-        self.actor.end_tag(tree.tag)
+        self.actor.end_tag(tag)
+
+    def text_tag(self, tree):
+        self.open_tag(tree.tag)
+        self.scan_inner(tree)
+        self.close_tag(tree.tag)
 
     def scan_tree(self, tree):
         if tree.tag == "image":
@@ -267,6 +352,7 @@ class BookScanner:
     def scan(self, actor):
         self.actor = actor
         self.toc = TableOfChapters()
+        self.images = self.image_processor(actor)
         parts = self.add_coverpage()
         for body in self.tree.findall('body'):
             self.scan_tree(body)
@@ -277,8 +363,220 @@ class BookScanner:
         if cover is not None:
             return self.add_image(cover)
 
+    def image_processor(self, actor):
+        if self.image_url is None:
+            return ImageProcessor(self.tree, actor)
+        return ImageProcessor(self.tree, actor, False, self.image_url)
+
     def add_image(self, image_node):
-        ImageProcessor(self.tree, self.actor).add_image(image_node)
+        self.images.add_image(image_node)
+
+
+class StreamImageProcessor(ImageProcessor):
+    """ Images for StreamScanner.
+
+    Binaries follow the bodies, so embedded images are written as
+    placeholders and filled in by resolve() after the whole book is read.
+    """
+
+    placeholder = re.compile("\0(\\d+)\0")
+
+    def __init__(self, actor=None, embed=True, link_template="{name}"):
+        super().__init__(None, actor, embed, link_template)
+        self.binaries = {}
+        self.pending = []
+
+    def embed_image(self, name):
+        self.actor.fragments.append(f"\0{len(self.pending)}\0")
+        self.pending.append(name)
+
+    def add_binary(self, name, data, content_type):
+        if name not in self.binaries:
+            self.binaries[name] = (data, content_type)
+
+    def get_image_data(self, link):
+        name = link.removeprefix('#')
+        return self.binaries.get(name, (None, None))
+
+    def image_code(self, match):
+        name = self.pending[int(match[1])]
+        data, content_type = self.get_image_data(name)
+        if not data:
+            return ""
+        return self.actor.embedded_image_code(data, content_type)
+
+    def resolve(self):
+        if not self.pending:
+            return
+        for keeper in (self.actor.fragments, self.actor.toc_fragments):
+            keeper.data[:] = [self.placeholder.sub(self.image_code, text)
+                if "\0" in text else text for text in keeper.data]
+
+
+class StreamScanner(BookScanner):
+    """ BookScanner driven by parser events instead of an element tree.
+
+    Produces the same output, but keeps no elements: text is passed
+    to the actor as soon as it is parsed, namespaces are stripped
+    on the fly.
+    """
+
+    cover_path = ["description", "title-info", "coverpage", "image"]
+
+    def __init__(self, text=None, file=None, image_url=None):
+        self.text = text
+        self.file = file
+        self.image_url = image_url
+        self.actor = None
+
+    def image_processor(self, actor):
+        if self.image_url is None:
+            return StreamImageProcessor(actor)
+        return StreamImageProcessor(actor, False, self.image_url)
+
+    def scan(self, actor):
+        for _ in self.scan_chunks(actor):
+            pass
+
+    def scan_chunks(self, actor):
+        """ Scan the book, yield after every parsed chunk of the file. """
+        self.actor = actor
+        self.toc = TableOfChapters()
+        self.images = self.image_processor(actor)
+        self.path = []
+        self.modes = []
+        self.pieces = []
+        self.binary = None
+        self.cover_added = False
+        parser = ET.XMLParser(target=self)
+        for chunk in BookParser.read_chunks(self.text, self.file):
+            parser.feed(chunk)
+            yield
+        parser.close()
+        self.toc.scan(self.actor)
+        self.images.resolve()
+        yield
+
+    def element_mode(self, tag, attrib):
+        parent = self.modes[-1] if self.modes else None
+        if parent is None:
+            return "root"
+        if parent == "text":
+            if tag == "image":
+                self.add_image(tag, attrib)
+                return "skip"
+            self.open_tag(tag)
+            return "text"
+        if parent == "root":
+            if tag == "body":
+                self.open_tag(tag)
+                return "text"
+            if tag == "binary" and self.images.embed:
+                self.binary = attrib
+                return "binary"
+        if (tag == "image" and not self.cover_added
+                and self.path[1:] == self.cover_path):
+            self.cover_added = True
+            self.add_image(tag, attrib)
+        return "skip"
+
+    def start(self, tag, attrib):
+        self.flush_text()
+        tag = BookParser.strip_tag(tag)
+        self.path.append(tag)
+        self.modes.append(self.element_mode(tag, attrib))
+
+    def end(self, tag):
+        self.flush_text()
+        tag = self.path.pop()
+        mode = self.modes.pop()
+        if mode == "text":
+            self.close_tag(tag)
+        elif mode == "binary":
+            self.end_binary()
+
+    def data(self, text):
+        self.pieces.append(text)
+
+    def close(self):
+        pass
+
+    def flush_text(self):
+        if not self.pieces:
+            return
+        text = "".join(self.pieces)
+        self.pieces.clear()
+        mode = self.modes[-1]
+        if mode == "text":
+            self.actor.add_text(text)
+        elif mode == "binary":
+            self.pieces.append(text)
+
+    def end_binary(self):
+        data = "".join(self.pieces)
+        self.pieces.clear()
+        content_type = self.binary.get("content-type", "image/jpg")
+        self.images.add_binary(self.binary.get("id"), data, content_type)
+        self.binary = None
+
+    def add_image(self, tag, attrib):
+        self.images.add_image(ET.Element(tag, attrib))
+
+
+class BinaryIndex:
+    """ Byte ranges of root <binary> contents in a book file.
+
+    The book is parsed once to build the index, then single images
+    are read and decoded without parsing.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.binaries = {}
+        self.depth = 0
+        self.current = None
+        self.parser = expat.ParserCreate(namespace_separator="}")
+        self.parser.StartElementHandler = self.start
+        self.parser.EndElementHandler = self.end
+        for chunk in BookParser.read_chunks(file=file):
+            self.parser.Parse(chunk, False)
+        self.parser.Parse(b"", True)
+        del self.parser
+
+    def start(self, tag, attrib):
+        self.depth += 1
+        if self.depth == 2 and BookParser.strip_tag(tag) == "binary":
+            content_type = attrib.get("content-type", "image/jpg")
+            self.current = [attrib.get("id"), content_type, None]
+            self.parser.CharacterDataHandler = self.data
+
+    def data(self, text):
+        if self.current[2] is None:
+            self.current[2] = self.parser.CurrentByteIndex
+
+    def end(self, tag):
+        self.depth -= 1
+        if self.depth == 1 and self.current:
+            name, content_type, start = self.current
+            if start is not None and name not in self.binaries:
+                end = self.parser.CurrentByteIndex
+                self.binaries[name] = (content_type, start, end)
+            self.current = None
+            self.parser.CharacterDataHandler = None
+
+    def read(self, name):
+        """ Return decoded image data and content type. """
+        if name not in self.binaries:
+            return None, None
+        content_type, start, end = self.binaries[name]
+        handle = BookParser.open(self.file)
+        try:
+            handle.seek(start)
+            raw = handle.read(end-start)
+        finally:
+            if handle is not self.file:
+                handle.close()
+        return base64.b64decode(raw), content_type
 
 
 class FragmentKeeper:
@@ -286,15 +584,14 @@ class FragmentKeeper:
     def __init__(self):
         self.data = []
         self.positions = []
-
-    def append(self, text):
-        self.data.append(text)
+        # The most frequent call, so data list is never replaced
+        self.append = self.data.append
 
     def position(self):
         return len(self.data)
 
     def push_tag_position(self):
-        position = self.position()
+        position = len(self.data)
         self.positions.append(position)
         return position
 
@@ -307,9 +604,14 @@ class FragmentKeeper:
         return "".join(pieces)
 
     def copy_from(self, position):
-        pieces = self.data[position:]
-        text = "".join(pieces)
-        self.data[position:] = (text,)
+        return "".join(self.data[position:])
+
+    def flush(self):
+        """ Remove and return all text, tag positions become relative. """
+        text = "".join(self.data)
+        shift = len(self.data)
+        self.data.clear()
+        self.positions = [max(p-shift, 0) for p in self.positions]
         return text
 
     def cut_tag_text(self):
@@ -320,8 +622,19 @@ class FragmentKeeper:
         tag_position = self.positions[-1]
         return self.copy_from(tag_position)
 
+    def offsets(self, positions):
+        """ Text offsets of ascending fragment positions. """
+        result = []
+        size = 0
+        start = 0
+        for position in positions:
+            size += sum(map(len, self.data[start:position]))
+            start = position
+            result.append(size)
+        return result
+
     def get_result(self):
-        self.data = [ "".join(self.data) ]
+        self.data[:] = [ "".join(self.data) ]
         return self.data[0]
 
 
@@ -390,19 +703,56 @@ decorations = {
 class DocWriter:
 
     no_strip_tags = ("p", "title", "subtitle", "v")
+    tag_tables = {}
+    title_breaks = re.compile("\n|<br>|</p>")
 
     def __init__(self, output="html"):
         self.decorations = decorations[output]
+        self.tags = self.tag_table(output)
         self.fragments = FragmentKeeper()
         self.toc_fragments = FragmentKeeper()
         self.strip_areas = [True]
+        self.chapter_positions = {}
+        self.toc_entries = []
+        self.chapters = None
+        self.open_titles = 0
 
     def get_result(self):
+        if self.chapters is None:
+            self.chapters = self.collect_chapters()
         return self.fragments.get_result()
 
     def get_toc(self):
         return self.toc_fragments.get_result()
 
+    def flush(self):
+        """ Take out the text written so far, if it can't change anymore.
+
+        Title text is copied to the toc when the title ends, so nothing
+        is taken inside of titles. Chapter offsets are lost after flush.
+        """
+        if self.open_titles:
+            return ""
+        return self.fragments.flush()
+
+    def add_title(self):
+        self.open_titles += 1
+
+    def end_title(self):
+        self.open_titles -= 1
+
+    def get_chapters(self):
+        """ List of (label, number, title, offset in the result) """
+        self.get_result()
+        return self.chapters
+
+    def collect_chapters(self):
+        positions = [self.chapter_positions[label]
+            for label,_,_ in self.toc_entries]
+        offsets = self.fragments.offsets(positions)
+        return [(*entry, offset)
+            for entry,offset in zip(self.toc_entries, offsets)]
+
     def toc_chapter(self, chapter):
         template = self.decorations["toc_chapter"][0]
         title = self.simplify_title(chapter.title)
@@ -412,48 +762,60 @@ class DocWriter:
             title=title,
         )
         self.toc_fragments.append(text)
+        self.toc_entries.append( (chapter.label, chapter.number, title) )
+
+    @classmethod
+    def tag_table(cls, output):
+        """ Precompiled tag: (prefix, suffix, add hook, end hook, strip).
+
+        Hooks are add_<tag> and end_<tag> methods, if defined.
+        """
+        key = (cls, output)
+        if key not in cls.tag_tables:
+            cls.tag_tables[key] = {
+                tag: (decoration[0], decoration[1],
+                    getattr(cls, "add_"+tag, None),
+                    getattr(cls, "end_"+tag, None),
+                    tag not in cls.no_strip_tags)
+                for tag,decoration in decorations[output].items()
+            }
+        return cls.tag_tables[key]
 
     def simplify_title(self, title):
         title = title.strip()
-        title = title.replace("\n", " ").replace("<br>", " ")
-        title = title.replace("</p>", "").replace("<p>", "")
-        return title
-
-    def strip_needed(self):
-        return self.strip_areas[-1]
+        title = self.title_breaks.sub(self.title_break, title)
+        return title.replace("<p>", "")
 
-    def add_strip_area(self, mode):
-        self.strip_areas.append(mode)
-
-    def end_strip_area(self):
-        self.strip_areas.pop()
+    @staticmethod
+    def title_break(match):
+        return "" if match[0] == "</p>" else " "
 
     def add_text(self, text):
-        if self.strip_needed():
+        if self.strip_areas[-1]:
             text = text.strip()
-        self.fragments.append(text)
-
-    def call_if_exists(self, method):
-        call = getattr(self, method, None)
-        if call:
-            call()
+        if text:
+            self.fragments.append(text)
 
     def add_tag(self, tag):
-        prefix = self.decorations[tag][0]
-        self.fragments.append(prefix)
-        self.call_if_exists("add_"+tag)
+        prefix, _, add_hook, _, strip = self.tags[tag]
+        if prefix:
+            self.fragments.append(prefix)
+        if add_hook:
+            add_hook(self)
         self.fragments.push_tag_position()
-        if tag in self.no_strip_tags:
-            self.add_strip_area(False)
+        self.strip_areas.append(strip and self.strip_areas[-1])
 
     def end_tag(self, tag):
-        if tag in self.no_strip_tags:
-            self.end_strip_area()
+        _, suffix, _, end_hook, _ = self.tags[tag]
+        self.strip_areas.pop()
         self.fragments.pop_tag_position()
-        self.call_if_exists("end_"+tag)
-        self.fragments.append( self.decorations[tag][1] )
+        if end_hook:
+            end_hook(self)
+        if suffix:
+            self.fragments.append(suffix)
 
     def add_chapter(self, chapter):
+        self.chapter_positions[chapter.label] = self.fragments.position()
         template = self.decorations['chapter'][0]
         text = template.format(label=chapter.label, number=chapter.number)
         self.fragments.append(text)
@@ -463,28 +825,46 @@ class DocWriter:
         text = template.format(label=chapter.label, number=chapter.number)
         self.fragments.append(text)
 
-    def embed_image(self, name, data, content_type):
+    def embedded_image_code(self, data, content_type):
         single_line = "".join( data.split() )
         url = "data:{0};base64, {1}".format(content_type, single_line)
-        self.link_image(url)
+        return self.image_code(url)
 
-    def link_image(self, url):
+    def image_code(self, url):
         template = self.decorations['image'][2]
-        text = template.format(url=url)
-        self.fragments.append(text)
+        return template.format(url=url)
+
+    def embed_image(self, name, data, content_type):
+        self.fragments.append( self.embedded_image_code(data, content_type) )
+
+    def link_image(self, url):
+        self.fragments.append( self.image_code(url) )
 
 
 class BookProcessor:
+    """ Book content and metadata.
+
+    Modes: "full" parses the whole book into a tree, "stream" renders
+    content straight from parser events without building a tree,
+    "metadata" parses only the <description> and can't render content.
+    Internal images are embedded, or linked by image_url template
+    like "img/{name}" if given.
+    """
 
-    def __init__(self, text=None, file=None):
+    def __init__(self, text=None, file=None, mode="full", image_url=None):
         if text or file:
-            self.load(text, file)
+            self.load(text, file, mode, image_url)
 
-    def load(self, text=None, file=None):
-        parser = BookParser(text, file)
+    def load(self, text=None, file=None, mode="full", image_url=None):
+        parser = BookParser(text, file, description_only=(mode != "full"))
         tree = parser.tree
         self.metadata = BookMetadata(tree)
-        self.scanner = BookScanner(tree)
+        if mode == "full":
+            self.scanner = BookScanner(tree, image_url)
+        elif mode == "stream":
+            self.scanner = StreamScanner(text, file, image_url)
+        else:
+            self.scanner = None
         self.content = dict()
 
     def get_format_writer(self, format):
@@ -501,6 +881,25 @@ class BookProcessor:
         toc = writer.get_toc()
         return content, toc
 
+    def get_chapters(self, format="html"):
+        return self.get_format_writer(format).get_chapters()
+
+    def get_toc(self, format="html"):
+        return self.get_format_writer(format).get_toc()
+
+    def iter_content(self, format="html"):
+        """ Yield content while it is rendered, in "stream" mode.
+
+        Table of contents is known at the end, from get_toc().
+        Internal images should be linked, embedding needs the whole book.
+        """
+        writer = DocWriter(format)
+        for _ in self.scanner.scan_chunks(writer):
+            text = writer.flush()
+            if text:
+                yield text
+        self.content[format] = writer
+
     def get_metadata(self):
         self.metadata.collect()
         return self.metadata
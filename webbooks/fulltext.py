@@ -0,0 +1,268 @@
+""" Full-text index of book content in an SQLite FTS5 table.
+
+Book text is indexed by chapters, once for every content hash. Rows of
+the FTS5 table have the ids of ChapterText rows with chapter labels.
+Other database backends have no full-text index.
+"""
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import html
+from pathlib import Path
+import re
+
+import django
+from django.db import connections, router, transaction
+from django.db.models import Exists, OuterRef
+from django.urls import reverse
+
+from . import conf
+from .fb2book import DocWriter, StreamScanner
+from .library import ordered_map
+from .models import *
+
+
+table = "webbooks_chaptertext_fts"
+
+Hit = namedtuple("Hit", "book chapter snippet url")
+
+
+def fold(text):
+    """ Text as it is indexed and searched: ё is found as е. """
+    return text.replace("ё", "е").replace("Ё", "Е")
+
+
+def index_db():
+    return router.db_for_write(ChapterText)
+
+
+def is_available(using=None):
+    return connections[using or index_db()].vendor == "sqlite"
+
+
+def create_table(using):
+    with connections[using].cursor() as cursor:
+        cursor.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {table}"
+            " USING fts5(title, text, tokenize='unicode61 remove_diacritics 2')")
+
+
+class ChapterTextWriter(DocWriter):
+    """ Text DocWriter without images. """
+
+    def __init__(self):
+        super().__init__("text")
+
+    def embed_image(self, name, data, content_type):
+        pass
+
+    def link_image(self, url):
+        pass
+
+
+def book_chapters(full_path):
+    """ (label, number, title, text) of chapters in the book file.
+
+    Text of a chapter ends where its first subchapter starts. The text
+    before the first chapter has empty label. Empty chapters are skipped.
+    """
+    writer = ChapterTextWriter()
+    StreamScanner(file=str(full_path), image_url="{name}").scan(writer)
+    text = writer.get_result()
+    chapters = writer.get_chapters()
+    template = writer.decorations["chapter"][0]
+    starts = [("", "", "", 0)] + chapters
+    ends = [offset for *_, offset in chapters] + [len(text)]
+    for (label, number, title, start), end in zip(starts, ends):
+        header = template.format(label=label, number=number)
+        if label and text.startswith(header, start):
+            start += len(header)
+        chapter_text = text[start:end].strip()
+        # Chapters with nothing but separator lines are left out
+        if title or chapter_text.strip("-\n "):
+            yield label, number, title, chapter_text
+
+
+def chapters_task(item):
+    """ Parse book chapters in a worker. """
+    hash, full_path = item
+    try:
+        return hash, full_path, list(book_chapters(full_path)), None
+    except Exception as e:
+        return hash, full_path, None, e
+
+
+def write_chapters(hash, chapters, using):
+    """ Add chapters of the content with hash to the index.
+
+    Content which can't be parsed gets one empty row, so it isn't parsed
+    again on every update.
+    """
+    chapters = chapters or [("", "", "", "")]
+    rows = ChapterText.objects.using(using).bulk_create(
+        ChapterText(hash=hash, label=label, number=number, title=title)
+        for label, number, title, _ in chapters)
+    with connections[using].cursor() as cursor:
+        cursor.executemany(f"INSERT INTO {table}(rowid, title, text)"
+            " VALUES (%s, %s, %s)", [(row.id, fold(title), fold(text))
+            for row, (_, _, title, text) in zip(rows, chapters)])
+
+
+def remove_hashes(hashes, using, batch_size=500):
+    """ Remove the indexed content with given hashes. """
+    hashes = list(hashes)
+    with connections[using].cursor() as cursor:
+        for start in range(0, len(hashes), batch_size):
+            rows = ChapterText.objects.using(using).filter(
+                hash__in=hashes[start:start+batch_size])
+            ids = list(rows.values_list("id", flat=True))
+            if ids:
+                cursor.execute(f"DELETE FROM {table} WHERE rowid IN"
+                    f" ({','.join(['%s']*len(ids))})", ids)
+            rows.delete()
+
+
+def by_hashes(rows, hashes, batch_size=500):
+    """ Querysets of the rows with the hashes by batches, or all rows. """
+    if hashes is None:
+        yield rows
+        return
+    hashes = sorted(hashes)
+    for start in range(0, len(hashes), batch_size):
+        yield rows.filter(hash__in=hashes[start:start+batch_size])
+
+
+def missing_books(using, hashes=None):
+    """ (hash, full path) of a book for every content not indexed yet.
+
+    Only books with the hashes are checked if given.
+    """
+    indexed = ChapterText.objects.using(using).filter(hash=OuterRef("hash"))
+    books = Book.objects.using(using).filter(~Exists(indexed))
+    seen = set()
+    for batch in by_hashes(books, hashes):
+        for hash, file in batch.order_by("id").values_list("hash", "file") \
+                .iterator():
+            if hash not in seen:
+                seen.add(hash)
+                yield hash, Path(conf.WEBBOOKS_ROOT, file)
+
+
+def stale_hashes(using, hashes=None):
+    """ Indexed content hashes of deleted books, of the hashes if given. """
+    books = Book.objects.using(using).filter(hash=OuterRef("hash"))
+    rows = ChapterText.objects.using(using).filter(~Exists(books))
+    return {hash for batch in by_hashes(rows, hashes)
+        for hash in batch.values_list("hash", flat=True)}
+
+
+def index_book(book):
+    """ Add book content to the index, if it is not there yet. """
+    using = index_db()
+    if not is_available(using) or \
+            ChapterText.objects.using(using).filter(hash=book.hash).exists():
+        return
+    _, _, chapters, _ = chapters_task((book.hash, book.full_path()))
+    with transaction.atomic(using=using):
+        write_chapters(book.hash, chapters, using)
+
+
+def update_index(output=None, jobs=1, batch_size=50, hashes=None):
+    """ Index books which are not indexed, remove content of deleted ones.
+
+    If hashes are given, only content with them is checked, so updates
+    after a few changed files don't go through the whole library.
+    Books are parsed by jobs worker processes if jobs > 1, the index is
+    written in batches. Returns counts of indexed, removed and failed.
+    """
+    using = index_db()
+    counts = {"indexed": 0, "removed": 0, "errors": 0}
+    if not is_available(using):
+        return counts
+    stale = stale_hashes(using, hashes)
+    with transaction.atomic(using=using):
+        remove_hashes(stale, using)
+    counts["removed"] = len(stale)
+    books = missing_books(using, hashes)
+    pool = None
+    if jobs > 1:
+        connections.close_all()
+        pool = ProcessPoolExecutor(jobs, initializer=django.setup)
+        results = ordered_map(pool, chapters_task, books, jobs*4)
+    else:
+        results = map(chapters_task, books)
+    try:
+        while True:
+            batch = [result for _, result in zip(range(batch_size), results)]
+            if not batch:
+                break
+            with transaction.atomic(using=using):
+                for hash, full_path, chapters, error in batch:
+                    if error is not None:
+                        counts["errors"] += 1
+                        if output:
+                            output.write(f"error: {full_path}: {error!r}")
+                    write_chapters(hash, chapters, using)
+            counts["indexed"] += len(batch)
+    finally:
+        if pool:
+            pool.shutdown(cancel_futures=True)
+    return counts
+
+
+def clear_index(using=None):
+    using = using or index_db()
+    with connections[using].cursor() as cursor:
+        cursor.execute(f"DELETE FROM {table}")
+    ChapterText.objects.using(using).all().delete()
+
+
+def match_query(text):
+    """ FTS5 query for all words of the text, without its syntax. """
+    words = re.findall(r"\w+", fold(text))
+    return " ".join(f'"{word}"' for word in words)
+
+
+def snippet_html(snippet):
+    text = html.escape(snippet)
+    return text.replace("\x02", "<mark>").replace("\x03", "</mark>")
+
+
+def search(text, limit=20, offset=0):
+    """ List of Hit, best first, with html snippets of matched text.
+
+    Hits of removed books, which are still in the index, are skipped.
+    """
+    using = index_db()
+    query = match_query(text)
+    if not query or not is_available(using):
+        return []
+    with connections[using].cursor() as cursor:
+        # Titles weigh more. Snippets are made only for the taken rows.
+        cursor.execute(f"SELECT rowid FROM {table} WHERE {table} MATCH %s"
+            f" ORDER BY bm25({table}, 5.0, 1.0) LIMIT %s OFFSET %s",
+            [query, limit, offset])
+        ids = [id for id, in cursor.fetchall()]
+        if not ids:
+            return []
+        cursor.execute(f"SELECT rowid, snippet({table}, 1, char(2), char(3),"
+            f" '…', 16) FROM {table} WHERE {table} MATCH %s AND rowid IN"
+            f" ({','.join(['%s']*len(ids))})", [query, *ids])
+        snippets = dict(cursor.fetchall())
+    chapters = ChapterText.objects.using(using).in_bulk(ids)
+    books = {}
+    hashes = {chapter.hash for chapter in chapters.values()}
+    for book in Book.objects.using(using).filter(hash__in=hashes) \
+            .order_by("-id"):
+        books[book.hash] = book
+    hits = []
+    for id in ids:
+        chapter = chapters[id]
+        book = books.get(chapter.hash)
+        if book is None:
+            continue
+        url = reverse("webbooks:read", args=[book.id])
+        if chapter.label:
+            url += "#" + chapter.label
+        hits.append(Hit(book, chapter, snippet_html(snippets.get(id, "")),
+            url))
+    return hits
@@ -0,0 +1,96 @@
+""" Minimal Linux inotify binding with ctypes. """
+
+from collections import namedtuple
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+Event = namedtuple("Event", "wd mask cookie name")
+
+event_header = struct.Struct("iIII")
+
+
+class Inotify:
+    """ Inotify instance, watched paths are kept by watch descriptor. """
+
+    buffer_size = 256*1024
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        try:
+            self.add = libc.inotify_add_watch
+            self.remove = libc.inotify_rm_watch
+            init = libc.inotify_init1
+        except AttributeError:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.add.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self.remove.argtypes = (ctypes.c_int, ctypes.c_int)
+        self.fd = init(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            self.raise_errno()
+        self.paths = {}
+
+    def close(self):
+        os.close(self.fd)
+
+    @staticmethod
+    def raise_errno(path=None):
+        code = ctypes.get_errno()
+        message = os.strerror(code)
+        if code == errno.ENOSPC:
+            message += ", raise fs.inotify.max_user_watches"
+        raise OSError(code, message, path)
+
+    def add_watch(self, path, mask):
+        """ Watch descriptor, None if the path is gone. """
+        wd = self.add(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            if ctypes.get_errno() in (errno.ENOENT, errno.ENOTDIR):
+                return None
+            self.raise_errno(path)
+        self.paths[wd] = path
+        return wd
+
+    def remove_watch(self, wd):
+        self.paths.pop(wd, None)
+        self.remove(self.fd, wd)
+
+    def read(self, timeout=None):
+        """ List of events, empty if none came in timeout seconds. """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, self.buffer_size)
+        except BlockingIOError:
+            return []
+        events = []
+        position = 0
+        while position < len(data):
+            wd, mask, cookie, size = event_header.unpack_from(data, position)
+            position += event_header.size
+            name = data[position:position+size].rstrip(b"\0")
+            position += size
+            events.append(Event(wd, mask, cookie, os.fsdecode(name)))
+        return events
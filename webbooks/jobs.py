@@ -0,0 +1,124 @@
+""" Database job queue for uploads and rescans, run by libworker. """
+
+from datetime import timedelta
+import io
+import os
+from pathlib import Path
+
+from django.core.management.base import OutputWrapper
+from django.db.models import F
+from django.utils import timezone
+
+from . import conf, fulltext
+from .models import *
+from .library import (LibraryWalk, library_walk, changed_files, save_dirs,
+    scan_lib_dir, clear_missing, ScanReport)
+from .services import BookImporter, add_uploaded_book
+
+
+# Rescan jobs don't delete more missing books, like libscan by default
+rescan_max_delete = 1000
+
+
+def enqueue_upload(full_path, hash, name):
+    return Job.objects.create(kind="upload", path=str(full_path), hash=hash or "",
+        name=name)
+
+
+def enqueue_rescan(path=""):
+    """ Queue a rescan of the library subtree, the whole library by default. """
+    return Job.objects.create(kind="rescan", path=path)
+
+
+def claim_job(kinds, limit=10):
+    """ Mark the next due job of given kinds running and return it.
+
+    The job is taken by a conditional update, so workers running at the
+    same time don't get the same job. None if there are no due jobs.
+    """
+    now = timezone.now()
+    due = Job.objects.filter(status="queued", run_after__lte=now,
+        kind__in=kinds).order_by("run_after", "id")
+    for id in due.values_list("id", flat=True)[:limit]:
+        taken = Job.objects.filter(id=id, status="queued").update(
+            status="running", started=now, attempts=F("attempts")+1)
+        if taken:
+            return Job.objects.get(id=id)
+    return None
+
+
+def requeue_stale(timeout, max_attempts):
+    """ Queue again jobs left running longer than timeout by a dead worker. """
+    stale = Job.objects.filter(status="running",
+        started__lt=timezone.now() - timedelta(seconds=timeout))
+    for job in stale:
+        fail_job(job, "Worker stopped while running the job", max_attempts, 0)
+
+
+def run_upload(job):
+    book, result = add_uploaded_book(job.path, job.hash or None, job.name)
+    if result == "created":
+        fulltext.index_book(book)
+    job.book = book
+    job.message = result
+
+
+def run_rescan(job):
+    output = io.StringIO()
+    report = ScanReport(OutputWrapper(output))
+    if job.path:
+        walk = LibraryWalk(conf.WEBBOOKS_ROOT, conf.WEBBOOKS_UPLOAD,
+            top=os.path.join(conf.WEBBOOKS_ROOT, job.path))
+    else:
+        walk = library_walk()
+    with BookImporter(on_error=report.error) as importer:
+        scan_lib_dir(changed_files(report.walk(walk), prefix=walk.prefix),
+            importer, report)
+    if not job.path:
+        save_dirs(walk.dirs)
+    clear_missing(report, walk, rescan_max_delete)
+    fulltext.update_index(report.output, hashes=report.hashes)
+    report.finish()
+    job.message = output.getvalue()
+
+
+runners = {
+    "upload": run_upload,
+    "rescan": run_rescan,
+}
+
+
+def fail_job(job, error, max_attempts, retry_delay):
+    """ Queue the job again after a delay, doubled every attempt.
+
+    After max_attempts the job fails, and the uploaded file is removed.
+    """
+    job.message = str(error)
+    if job.attempts < max_attempts:
+        job.status = "queued"
+        delay = retry_delay * 2**max(job.attempts - 1, 0)
+        job.run_after = timezone.now() + timedelta(seconds=delay)
+    else:
+        job.status = "failed"
+        job.finished = timezone.now()
+        if job.kind == "upload":
+            Path(job.path).unlink(missing_ok=True)
+    job.save()
+
+
+def run_job(job, max_attempts=3, retry_delay=60):
+    """ Run the claimed job and save the result. """
+    try:
+        runners[job.kind](job)
+    except Exception as e:
+        fail_job(job, repr(e), max_attempts, retry_delay)
+    else:
+        job.status = "done"
+        job.finished = timezone.now()
+        job.save()
+    return job.status
+
+
+def run_job_id(id, max_attempts=3, retry_delay=60):
+    """ run_job for worker processes. """
+    return run_job(Job.objects.get(id=id), max_attempts, retry_delay)
@@ -0,0 +1,393 @@
+""" Library directory scanning, shared by libscan and libwatch. """
+
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import json
+import os
+from pathlib import Path
+import time
+
+import django
+from django.db import connections, router, transaction
+
+from . import conf, counts
+from .models import *
+from .services import (check_book_file, file_hash, get_book_path,
+    new_metadata, read_metadata, stat_signature)
+
+
+class TooManyMissing(Exception):
+    pass
+
+
+class LibraryWalk:
+    """ Book files under root as (path, stat), skipping exclude directory.
+
+    Paths relative to root are collected: of seen files in files, and
+    directory mtimes in dirs.
+    With known_dirs from the last scan given, a directory with unchanged
+    mtime is pruned: it has the same entries, so it is not listed, and
+    only its known subdirectories are walked. Files changed in place
+    don't change the directory mtime, they are not noticed in that case.
+    Only the top subtree is walked if given, it may be missing.
+    """
+
+    def __init__(self, root, exclude=None, known_dirs=None, top=None):
+        self.root = os.path.normpath(root)
+        self.exclude = exclude and os.path.normpath(exclude)
+        self.top = os.path.normpath(top) if top else self.root
+        # Library paths in the walked subtree start with prefix
+        self.prefix = ""
+        if self.top != self.root:
+            self.prefix = os.path.relpath(self.top, self.root) + os.sep
+        self.known_dirs = known_dirs
+        self.subdirs = {}
+        for path in known_dirs or ():
+            if path != ".":
+                parent = os.path.dirname(path) or "."
+                self.subdirs.setdefault(parent, []).append(path)
+        self.files = set()
+        self.dirs = {}
+        self.pruned = set()
+
+    def __iter__(self):
+        return self.walk(self.top)
+
+    def visit_dir(self, path):
+        """ Called for every walked directory. """
+
+    def walk(self, path):
+        # Mtime is taken before listing, to not miss entries added meanwhile
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            if path == self.root:
+                raise
+            return
+        self.visit_dir(path)
+        relative = os.path.relpath(path, self.root)
+        self.dirs[relative] = mtime
+        if self.known_dirs and self.known_dirs.get(relative) == mtime:
+            self.pruned.add(relative)
+            for subdir in self.subdirs.get(relative, ()):
+                yield from self.walk(os.path.join(self.root, subdir))
+            return
+        with os.scandir(path) as it:
+            entries = list(it)
+        for entry in entries:
+            if entry.is_dir():
+                if entry.path != self.exclude:
+                    yield from self.walk(entry.path)
+            elif entry.name.endswith((".fb2", ".fb2.zip")):
+                self.files.add(os.path.relpath(entry.path, self.root))
+                yield Path(entry.path), entry.stat()
+
+    def has_seen(self, file):
+        """ If the library file was found, or is in a pruned directory. """
+        return file in self.files or \
+            (os.path.dirname(file) or ".") in self.pruned
+
+
+def library_walk(prune=False):
+    known_dirs = None
+    if prune:
+        known_dirs = dict(LibraryDir.objects.values_list("path", "mtime_ns"))
+    return LibraryWalk(conf.WEBBOOKS_ROOT, conf.WEBBOOKS_UPLOAD, known_dirs)
+
+
+def save_dirs(dirs):
+    """ Replace saved directory mtimes after a complete scan. """
+    with transaction.atomic(using=router.db_for_write(LibraryDir)):
+        LibraryDir.objects.all().delete()
+        LibraryDir.objects.bulk_create(
+            (LibraryDir(path=p, mtime_ns=m) for p,m in dirs.items()),
+            batch_size=500)
+
+
+def books_under(prefix, *fields):
+    """ Values of books with library path starting with prefix. """
+    books = Book.objects.values_list(*fields)
+    if prefix:
+        books = books.filter(file__startswith=prefix)
+    # LIKE can be case insensitive
+    return (values for values in books.iterator()
+        if values[0].startswith(prefix))
+
+
+def changed_files(files, full=False, prefix=""):
+    """ Files with stat different from the one saved in the database.
+
+    Only books with library path starting with prefix are compared.
+    """
+    known = {}
+    if not full:
+        fields = ("file", "file_size", "file_mtime_ns", "file_inode")
+        known = {file: tuple(signature) for file, *signature
+            in books_under(prefix, *fields)}
+    for file, stat in files:
+        signature = tuple(stat_signature(stat).values())
+        if known.get(str(get_book_path(file))) != signature:
+            yield file, stat
+
+
+class ScanReport:
+    """ Scan results, timings and progress.
+
+    Changes and errors are written to output. If a report file is given,
+    they are also written there as JSON lines events, with progress
+    events every interval seconds and a summary event at the end.
+    Progress has ETA if the expected number of files is known.
+    Hashes of added, replaced and deleted content are kept in hashes.
+    """
+
+    def __init__(self, output, file=None, interval=10.0, expected=None):
+        self.output = output
+        self.file = file
+        self.interval = interval
+        self.expected = expected
+        self.start = self.last_progress = time.perf_counter()
+        self.phases = defaultdict(float)
+        self.statuses = Counter()
+        self.walked = 0
+        self.checked = 0
+        self.bytes = 0
+        self.errors = []
+        self.hashes = set()
+
+    def event(self, kind, **fields):
+        if self.file:
+            fields = {"event": kind, "time": round(time.time(), 3), **fields}
+            self.file.write(json.dumps(fields) + "\n")
+            self.file.flush()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.perf_counter() - start
+
+    def walk(self, files):
+        """ Count and time walked files. """
+        files = iter(files)
+        while True:
+            with self.phase("walk"):
+                item = next(files, None)
+            if item is None:
+                return
+            self.walked += 1
+            self.progress()
+            yield item
+
+    def file_checked(self, path, status, size, hashes=()):
+        self.checked += 1
+        self.hashes.update(hashes)
+        self.bytes += size
+        self.statuses[status] += 1
+        if status != "exists":
+            self.output.write(f"{status}: {path}")
+            self.event("file", path=str(path), status=status)
+
+    def file_deleted(self, file):
+        self.statuses["deleted"] += 1
+        self.output.write(f"Deleting {file}")
+        self.event("file", path=str(file), status="deleted")
+
+    def error(self, path, error):
+        self.errors.append({"path": str(path), "error": repr(error)})
+        self.output.write(f"error: {path}: {error!r}")
+        self.event("error", **self.errors[-1])
+
+    def counters(self):
+        elapsed = time.perf_counter() - self.start
+        return {
+            "elapsed": round(elapsed, 3),
+            "walked": self.walked,
+            "checked": self.checked,
+            "bytes": self.bytes,
+            "files_per_s": round(self.walked / elapsed, 1) if elapsed else 0,
+            "mb_per_s": round(self.bytes / 2**20 / elapsed, 2)
+                if elapsed else 0,
+            "errors": len(self.errors),
+        }
+
+    def progress(self):
+        now = time.perf_counter()
+        if now - self.last_progress < self.interval:
+            return
+        self.last_progress = now
+        counters = self.counters()
+        eta = None
+        if self.expected and counters["files_per_s"]:
+            left = max(self.expected - self.walked, 0)
+            eta = round(left / counters["files_per_s"])
+        self.event("progress", eta=eta, **counters)
+
+    def summary(self):
+        return {
+            **self.counters(),
+            "statuses": dict(self.statuses),
+            "phases": {k: round(v, 3) for k,v in self.phases.items()},
+            "error_files": self.errors,
+        }
+
+    def finish(self):
+        """ Write and return the summary. """
+        summary = self.summary()
+        self.event("summary", **summary)
+        statuses = ", ".join(f"{k}: {v}" for k,v in summary["statuses"].items())
+        self.output.write(f"Checked {self.checked} of {self.walked} files"
+            f" ({summary['mb_per_s']} MB/s), {statuses or 'no changes'},"
+            f" errors: {len(self.errors)}. Elapsed {summary['elapsed']}s")
+        return summary
+
+
+def check_file(file, stat, hash, metadata, importer, report):
+    """ Update database by the read file, errors are reported. """
+    try:
+        with report.phase("db"), \
+                transaction.atomic(using=router.db_for_write(Book)):
+            book, status = check_book_file(file, hash, metadata, stat,
+                importer)
+    except Exception as e:
+        report.error(file, e)
+    else:
+        hashes = ()
+        if status == "created":
+            hashes = [hash]
+        elif status == "updated":
+            hashes = [hash, book.replaced_hash]
+        report.file_checked(file, status, stat.st_size, hashes)
+
+
+def scan_lib_dir(files, importer, report):
+    for file, stat in files:
+        try:
+            with report.phase("hash"):
+                hash = file_hash(file)
+            with report.phase("parse"):
+                metadata = new_metadata(file, hash)
+        except Exception as e:
+            report.error(file, e)
+            continue
+        check_file(file, stat, hash, metadata, importer, report)
+    with report.phase("db"):
+        importer.flush()
+
+
+def hash_file_task(item):
+    """ Hash file in a worker, with the hash time. """
+    file, stat = item
+    try:
+        start = time.perf_counter()
+        hash = file_hash(file)
+        return file, stat, hash, time.perf_counter() - start, None
+    except Exception as e:
+        return file, stat, None, None, e
+
+
+def parse_file_task(file):
+    """ Read metadata in a worker, with the parse time. """
+    try:
+        start = time.perf_counter()
+        metadata = read_metadata(file)
+        return metadata, time.perf_counter() - start, None
+    except Exception as e:
+        return None, None, e
+
+
+def ordered_map(pool, func, items, window):
+    """ Like pool.map, but with at most window tasks submitted ahead. """
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(pool.submit(func, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def write_batch(batch, importer, report):
+    """ Update database by read files, in one transaction. """
+    with transaction.atomic(using=router.db_for_write(Book)):
+        for file, stat, (hash, metadata) in batch:
+            check_file(file, stat, hash, metadata, importer, report)
+        with report.phase("db"):
+            importer.flush()
+
+
+def scan_lib_dir_parallel(files, importer, report, jobs, batch_size=100):
+    """ Files are hashed and parsed by worker processes.
+
+    Hashes of a batch are looked up at once, and only files with new
+    content are parsed, as by scan_lib_dir(). Database is updated in the
+    walk order. Hash and parse times are summed over workers.
+    """
+    connections.close_all()
+    with ProcessPoolExecutor(jobs, initializer=django.setup) as pool:
+        hashed = ordered_map(pool, hash_file_task, files, jobs*16)
+        try:
+            while True:
+                chunk = [item for _, item in zip(range(batch_size), hashed)]
+                if not chunk:
+                    break
+                batch = []
+                for file, stat, hash, seconds, error in chunk:
+                    if error is not None:
+                        report.error(file, error)
+                        continue
+                    report.phases["hash"] += seconds
+                    batch.append((file, stat, hash))
+                write_batch(parse_batch(pool, batch, report), importer,
+                    report)
+        finally:
+            hashed.close()
+
+
+def parse_batch(pool, batch, report):
+    """ (file, stat, (hash, metadata)) of hashed files, new ones parsed. """
+    with report.phase("db"):
+        known = set(Book.objects.filter(hash__in={hash for _, _, hash
+            in batch}).values_list("hash", flat=True))
+    new = [file for file, _, hash in batch if hash not in known]
+    parsed = dict(zip(new, pool.map(parse_file_task, new)))
+    result = []
+    for file, stat, hash in batch:
+        metadata = None
+        if file in parsed:
+            metadata, seconds, error = parsed[file]
+            if error is not None:
+                report.error(file, error)
+                continue
+            report.phases["parse"] += seconds
+        result.append((file, stat, (hash, metadata)))
+    return result
+
+
+def clear_missing(report, walk, max_delete=None):
+    """ Delete books in the walked subtree which were not seen.
+
+    Raise TooManyMissing if there are more than max_delete such books.
+    """
+    books = books_under(walk.prefix, "file", "id")
+    missing = [(id, file) for file,id in books if not walk.has_seen(file)]
+    if max_delete is not None and len(missing) > max_delete:
+        raise TooManyMissing(f"{len(missing)} books are missing, more than"
+            f" {max_delete} allowed. Is the library root mounted?")
+    delete_books(report, missing)
+
+
+def delete_books(report, books, batch_size=500):
+    """ Delete books given as (id, file), with a few queries per batch. """
+    missing = list(books)
+    for start in range(0, len(missing), batch_size):
+        chunk = missing[start:start+batch_size]
+        for _, file in chunk:
+            report.file_deleted(file)
+        report.hashes.update(counts.delete_books(id for id,_ in chunk))
@@ -0,0 +1,56 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from webbooks import neardupes
+from webbooks.models import *
+
+
+class Command(BaseCommand):
+    help = ("Finds books with similar text: signs new books and reports"
+        " clusters of similar ones")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--jobs", type=int, default=os.cpu_count(),
+            help="Number of processes reading books")
+        parser.add_argument("--threshold", type=float, default=0.8,
+            help="Smallest estimated similarity of texts, 0 to 1."
+            " Use --rebuild after changing it")
+        parser.add_argument("--rebuild", action="store_true",
+            help="Clear the signatures and sign all books again")
+        parser.add_argument("--all", action="store_true",
+            help="Report all clusters, not only new and changed ones")
+
+    def handle(self, *args, **options):
+        try:
+            import numpy
+        except ImportError:
+            raise CommandError("libdupes needs NumPy: pip install numpy")
+        if options["jobs"] < 1:
+            raise CommandError("--jobs should be at least 1.")
+        if not 0 < options["threshold"] <= 1:
+            raise CommandError("--threshold should be between 0 and 1.")
+        start = time.perf_counter()
+        if options["rebuild"]:
+            self.stdout.write("Clearing the signatures")
+            with transaction.atomic(using=neardupes.index_db()):
+                neardupes.clear()
+        counts, changed = neardupes.update(self.stdout, options["jobs"],
+            options["threshold"])
+        if options["all"]:
+            changed = TextSignature.objects.filter(cluster__isnull=False) \
+                .values_list("cluster", flat=True).distinct()
+        self.report(sorted(changed))
+        elapsed = time.perf_counter() - start
+        summary = ", ".join(f"{k}: {v}" for k,v in counts.items())
+        self.stdout.write(f"{summary}. Elapsed {elapsed:.2f}s")
+
+    def report(self, ids, batch_size=100):
+        for start in range(0, len(ids), batch_size):
+            for cluster in neardupes.cluster_books(ids[start:start+batch_size]):
+                self.stdout.write(f"Cluster {cluster.id}:")
+                for book in cluster.books:
+                    self.stdout.write(f"  {book.similarity:.2f} {book.title}"
+                        f" / {book.file}")
@@ -0,0 +1,41 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from webbooks import catalog, fulltext
+
+
+class Command(BaseCommand):
+    help = "Updates the full-text index of book contents, or the catalog"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rebuild", action="store_true",
+            help="Clear the index and index all books again")
+        parser.add_argument("--jobs", type=int, default=os.cpu_count(),
+            help="Number of processes parsing books")
+        parser.add_argument("--catalog", action="store_true",
+            help="Rebuild search keys and word indexes of book titles,"
+            " authors and sequences instead")
+
+    def handle(self, *args, **options):
+        if options["catalog"]:
+            start = time.perf_counter()
+            catalog.rebuild()
+            elapsed = time.perf_counter() - start
+            self.stdout.write(f"Catalog rebuilt. Elapsed {elapsed:.2f}s")
+            return
+        if not fulltext.is_available():
+            raise CommandError("Full-text index needs an SQLite database.")
+        if options["jobs"] < 1:
+            raise CommandError("--jobs should be at least 1.")
+        start = time.perf_counter()
+        if options["rebuild"]:
+            self.stdout.write("Clearing the index")
+            with transaction.atomic(using=fulltext.index_db()):
+                fulltext.clear_index()
+        counts = fulltext.update_index(self.stdout, options["jobs"])
+        elapsed = time.perf_counter() - start
+        summary = ", ".join(f"{k}: {v}" for k,v in counts.items())
+        self.stdout.write(f"{summary}. Elapsed {elapsed:.2f}s")
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from webbooks import services
+from webbooks.models import Author, Genre, Sequence
+
+
+class Command(BaseCommand):
+    help = ("Merges authors, genres and sequences with the same name, run"
+        " it before migrate when upgrading to unique names")
+
+    def handle(self, *args, **options):
+        for model in (Author, Genre, Sequence):
+            merged = services.merge_duplicate_names(model)
+            name = model._meta.verbose_name_plural
+            self.stdout.write(f"Merged {merged} duplicate {name}")
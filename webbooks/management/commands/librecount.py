@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from webbooks import counts
+
+
+class Command(BaseCommand):
+    help = ("Counts books of authors, genres and sequences again and finds"
+        " groups of duplicate books")
+
+    def handle(self, *args, **options):
+        fixed = counts.recount_books()
+        counts.recount_letters()
+        summary = ", ".join(f"{k}: {v}" for k,v in fixed.items())
+        self.stdout.write(f"Fixed book counts of {summary}")
+        groups = counts.regroup_duplicates()
+        self.stdout.write(f"Found {groups} groups of duplicate books")
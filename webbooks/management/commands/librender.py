@@ -0,0 +1,71 @@
+from concurrent.futures import ProcessPoolExecutor
+import os
+from pathlib import Path
+import time
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from webbooks import conf, rendercache
+from webbooks.models import *
+
+
+def render_book(task):
+    full_path, hash, format, force = task
+    try:
+        rendered = rendercache.prerender(full_path, hash, format,
+            rendercache.READER_IMAGES, force)
+    except Exception as e:
+        return full_path, f"error: {e!r}"
+    return full_path, "rendered" if rendered else "cached"
+
+
+def select_books(ids, authors):
+    books = Book.objects.all()
+    if ids:
+        books = books.filter(id__in=ids)
+    if authors:
+        books = books.filter(authors__in=authors).distinct()
+    # Books with the same file content are rendered once.
+    tasks = {}
+    for file, hash in books.order_by("id").values_list("file", "hash"):
+        tasks.setdefault(hash, str(Path(conf.WEBBOOKS_ROOT, file)))
+    return tasks
+
+
+class Command(BaseCommand):
+    help = "Renders books into the render cache"
+
+    def add_arguments(self, parser):
+        parser.add_argument("books", nargs="*", type=int,
+            help="Book ids, all books by default")
+        parser.add_argument("--author", action="append", type=int, default=[],
+            help="Render books of the author id, can be repeated")
+        parser.add_argument("--format", choices=("html", "text"),
+            default="html")
+        parser.add_argument("--force", action="store_true",
+            help="Render books which are already cached")
+        parser.add_argument("--jobs", type=int, default=os.cpu_count(),
+            help="Number of rendering processes")
+
+    def handle(self, *args, **options):
+        if not conf.WEBBOOKS_RENDER_CACHE:
+            raise CommandError("Render cache is disabled.")
+        start = time.perf_counter()
+        tasks = select_books(options["books"], options["author"])
+        self.stdout.write(f"Rendering {len(tasks)} books")
+        tasks = [(path, hash, options["format"], options["force"])
+            for hash, path in tasks.items()]
+        connections.close_all()
+        counts = {"rendered": 0, "cached": 0, "error": 0}
+        with ProcessPoolExecutor(options["jobs"],
+                initializer=django.setup) as pool:
+            for path, status in pool.map(render_book, tasks, chunksize=4):
+                if status.startswith("error"):
+                    self.stderr.write(f"{status}: {path}")
+                    status = "error"
+                counts[status] += 1
+        elapsed = time.perf_counter() - start
+        summary = ", ".join(f"{k}: {v}" for k,v in counts.items())
+        self.stdout.write(f"{summary}. Elapsed {elapsed:.2f}s")
@@ -1,61 +1,83 @@
-from pathlib import Path
-import time
 from django.core.management.base import BaseCommand, CommandError
 
 import webbooks.conf
+from webbooks import fulltext
 from webbooks.models import *
-from webbooks.services import check_book_file
+from webbooks.library import (library_walk, changed_files, save_dirs,
+    scan_lib_dir, scan_lib_dir_parallel, clear_missing, TooManyMissing,
+    ScanReport)
+from webbooks.services import BookImporter
 
 
 
 #raise CommandError('Poll "%s" does not exist' % poll_id)
 
 
-def recurse_path(path):
-    for file in path.iterdir():
-        if file.is_dir():
-            yield from recurse_path(file)
-        else:
-            yield file
-
-
-def scan_lib_dir(output):
-    for file in recurse_path( Path(conf.WEBBOOKS_ROOT) ):
-        if file.is_relative_to(conf.WEBBOOKS_UPLOAD):
-            continue
-        try:
-            if file.name.endswith((".fb2", ".fb2.zip")):
-                book, status = check_book_file(file)
-        except:
-            output.write(f"error: {file}")
-            raise
-        else:
-            if status != "exists":
-                output.write(f"{status}: {file}")
-
-
-def clear_missing(output):
-    for book in Book.objects.all():
-        if not book.full_path().exists():
-            output.write(f"Deleting {book.file}")
-            book.delete()
-
-
-def stopwatch(start=None):
-    now = time.perf_counter()
-    if start is None:
-        return now
-    print(f"Elapsed {now-start:.2}s")
-    return now
-
-
 class Command(BaseCommand):
     help = "Scans filesystem for new books"
 
+    def add_arguments(self, parser):
+        parser.add_argument("--jobs", type=int, default=1,
+            help="Number of processes reading book files")
+        parser.add_argument("--full", action="store_true",
+            help="Read all files, even if their size and mtime are unchanged,"
+            " and check the full-text index of all books")
+        parser.add_argument("--prune-dirs", action="store_true",
+            help="Skip directories with unchanged mtime. Faster, but files"
+            " changed in place there are not noticed")
+        parser.add_argument("--max-delete", type=int, default=1000,
+            help="Don't delete missing books if there are more of them,"
+            " negative for no limit (default 1000)")
+        parser.add_argument("--report", metavar="PATH",
+            help="Write JSON lines events: changes, errors, progress and"
+            " the final summary")
+        parser.add_argument("--progress", type=float, default=10.0,
+            metavar="SECONDS", help="Progress events interval")
+        parser.add_argument("--no-fulltext", action="store_true",
+            help="Don't update the full-text index of book contents")
+
     def handle(self, *args, **options):
-        start = stopwatch()
+        if options["jobs"] < 1:
+            raise CommandError("--jobs should be at least 1.")
+        if options["report"]:
+            with open(options["report"], "w") as file:
+                return self.scan(file, options)
+        self.scan(None, options)
+
+    def scan(self, file, options):
+        report = ScanReport(self.stdout, file, options["progress"],
+            Book.objects.count())
+        report.event("start", root=conf.WEBBOOKS_ROOT, jobs=options["jobs"],
+            full=options["full"], prune_dirs=options["prune_dirs"])
         self.stdout.write(f"Searching new books in {conf.WEBBOOKS_ROOT}")
-        scan_lib_dir(self.stdout)
+        walk = library_walk(options["prune_dirs"] and not options["full"])
+        files = changed_files(report.walk(walk), options["full"])
+        with BookImporter(on_error=report.error) as importer:
+            if options["jobs"] > 1:
+                scan_lib_dir_parallel(files, importer, report,
+                    options["jobs"])
+            else:
+                scan_lib_dir(files, importer, report)
+        save_dirs(walk.dirs)
         self.stdout.write(f"Clear missing books")
-        clear_missing(self.stdout)
-        stopwatch(start)
+        max_delete = options["max_delete"]
+        try:
+            with report.phase("clear"):
+                clear_missing(report, walk,
+                    None if max_delete < 0 else max_delete)
+        except TooManyMissing as e:
+            report.event("error", error=str(e))
+            raise CommandError(f"{e} See --max-delete.")
+        else:
+            if not options["no_fulltext"]:
+                self.update_fulltext(report, options["jobs"],
+                    None if options["full"] else report.hashes)
+        finally:
+            report.finish()
+
+    def update_fulltext(self, report, jobs, hashes):
+        self.stdout.write("Updating full-text index")
+        with report.phase("fulltext"):
+            counts = fulltext.update_index(self.stdout, jobs, hashes=hashes)
+        report.event("fulltext", **counts)
+        self.stdout.write(", ".join(f"{k}: {v}" for k,v in counts.items()))
@@ -0,0 +1,204 @@
+import os
+from pathlib import Path
+import stat
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, router, transaction
+
+from webbooks import fulltext
+from webbooks.models import *
+from webbooks.inotify import *
+from webbooks.library import (LibraryWalk, changed_files, save_dirs,
+    scan_lib_dir, clear_missing, delete_books, TooManyMissing, ScanReport)
+from webbooks.services import BookImporter, get_book_path
+
+
+dir_mask = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+    | IN_DELETE | IN_ONLYDIR)
+
+
+def is_under(path, top):
+    return path == top or path.startswith(top + os.sep)
+
+
+def outermost(paths):
+    """ Paths which are not inside other ones. """
+    result = []
+    for path in sorted(paths):
+        if not result or not is_under(path, result[-1]):
+            result.append(path)
+    return result
+
+
+def existing_files(paths):
+    for path in paths:
+        try:
+            file_stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        if stat.S_ISREG(file_stat.st_mode):
+            yield Path(path), file_stat
+
+
+def gone_books(paths, batch_size=500):
+    """ (id, file) of books with files which don't exist. """
+    gone = [str(get_book_path(p)) for p in paths if not os.path.exists(p)]
+    for start in range(0, len(gone), batch_size):
+        chunk = gone[start:start+batch_size]
+        books = Book.objects.filter(file__in=chunk)
+        yield from books.values_list("id", "file")
+
+
+class WatchingWalk(LibraryWalk):
+    """ LibraryWalk which watches walked directories. """
+
+    def __init__(self, watcher, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.watcher = watcher
+
+    def visit_dir(self, path):
+        self.watcher.inotify.add_watch(path, dir_mask)
+
+
+class LibraryWatcher:
+    """ Updates database by inotify events in the library directory.
+
+    Events are collected until none come for delay seconds, or at most
+    max_delay seconds, then touched files and directory subtrees are
+    checked in one batch, like libscan does for the whole library.
+    """
+
+    def __init__(self, output, delay=2.0, max_delay=30.0, max_delete=None):
+        self.output = output
+        self.delay = delay
+        self.max_delay = max_delay
+        self.max_delete = max_delete
+        self.root = os.path.normpath(conf.WEBBOOKS_ROOT)
+        self.exclude = os.path.normpath(conf.WEBBOOKS_UPLOAD)
+        self.inotify = None
+        self.files = set()
+        self.trees = set()
+
+    def walk(self, top=None):
+        return WatchingWalk(self, self.root, self.exclude, top=top)
+
+    def start(self):
+        """ Watch the library and check files changed since the last scan. """
+        self.inotify = Inotify()
+        report = ScanReport(self.output)
+        walk = self.walk()
+        with BookImporter(on_error=report.error) as importer:
+            scan_lib_dir(changed_files(walk), importer, report)
+        save_dirs(walk.dirs)
+        self.clear_missing(report, walk)
+        fulltext.update_index(self.output)
+
+    def stop(self):
+        self.inotify.close()
+
+    def run(self):
+        while True:
+            if self.collect():
+                close_old_connections()
+                self.apply()
+
+    def clear_missing(self, report, walk):
+        try:
+            clear_missing(report, walk, self.max_delete)
+        except TooManyMissing as e:
+            self.output.write(f"error: {e}")
+
+    def collect(self, timeout=None):
+        """ Handle events until a pause, False if none came in timeout. """
+        events = self.inotify.read(timeout)
+        if not events:
+            return False
+        deadline = time.monotonic() + self.max_delay
+        while events:
+            for event in events:
+                self.handle(event)
+            wait = min(self.delay, deadline - time.monotonic())
+            if wait <= 0:
+                break
+            events = self.inotify.read(wait)
+        return True
+
+    def handle(self, event):
+        if event.mask & IN_Q_OVERFLOW:
+            # Events are lost somewhere, the whole library is checked
+            self.output.write("Event queue overflow, rescanning library")
+            self.trees.add(self.root)
+            return
+        if event.mask & IN_IGNORED:
+            self.inotify.paths.pop(event.wd, None)
+            return
+        directory = self.inotify.paths.get(event.wd)
+        if directory is None or not event.name:
+            return
+        path = os.path.join(directory, event.name)
+        if path == self.exclude:
+            return
+        if event.mask & IN_ISDIR:
+            if event.mask & IN_MOVED_FROM:
+                self.unwatch(path)
+            self.trees.add(path)
+        elif path.endswith((".fb2", ".fb2.zip")):
+            self.files.add(path)
+
+    def unwatch(self, path):
+        for wd, watched in list(self.inotify.paths.items()):
+            if is_under(watched, path):
+                self.inotify.remove_watch(wd)
+
+    def apply(self):
+        """ Check collected files and subtrees. """
+        trees, self.trees = outermost(self.trees), set()
+        files = [f for f in self.files
+            if not any(is_under(f, top) for top in trees)]
+        self.files = set()
+        walks = [self.walk(top) for top in trees]
+        report = ScanReport(self.output)
+        try:
+            with transaction.atomic(using=router.db_for_write(Book)):
+                with BookImporter(on_error=report.error) as importer:
+                    for walk in walks:
+                        scan_lib_dir(changed_files(walk, prefix=walk.prefix),
+                            importer, report)
+                    scan_lib_dir(existing_files(files), importer, report)
+                for walk in walks:
+                    self.clear_missing(report, walk)
+                delete_books(report, gone_books(files))
+            fulltext.update_index(self.output, hashes=report.hashes)
+        except Exception as e:
+            self.output.write(f"error: {e!r}, changes are checked on restart")
+
+
+class Command(BaseCommand):
+    help = "Watches the library directory and updates the database"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--delay", type=float, default=2.0,
+            help="Seconds without changes before they are applied")
+        parser.add_argument("--max-delay", type=float, default=30.0,
+            help="Apply changes at least this often while they continue")
+        parser.add_argument("--max-delete", type=int, default=1000,
+            help="Don't delete missing books if there are more of them,"
+            " negative for no limit (default 1000)")
+
+    def handle(self, *args, **options):
+        max_delete = options["max_delete"]
+        watcher = LibraryWatcher(self.stdout, options["delay"],
+            options["max_delay"], None if max_delete < 0 else max_delete)
+        self.stdout.write(f"Checking books in {conf.WEBBOOKS_ROOT}")
+        try:
+            watcher.start()
+        except OSError as e:
+            raise CommandError(f"Can't watch the library: {e}")
+        self.stdout.write("Watching for changes")
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.stop()
@@ -0,0 +1,129 @@
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import multiprocessing
+import time
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, connections
+
+from webbooks.models import *
+from webbooks.jobs import (claim_job, requeue_stale, run_job, run_job_id,
+    enqueue_rescan)
+
+
+class Worker:
+    """ Runs queued jobs, at most jobs at a time and one rescan at a time.
+
+    With jobs=1 they are run in this process, otherwise in a pool of
+    worker processes, while this one takes the jobs from the queue.
+    """
+
+    def __init__(self, output, jobs=1, poll=2.0, max_attempts=3,
+            retry_delay=60.0):
+        self.output = output
+        self.jobs = jobs
+        self.poll = poll
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.pool = None
+        self.running = {}
+
+    def next_job(self):
+        kinds = ["upload"]
+        if "rescan" not in self.running.values():
+            kinds.append("rescan")
+        return claim_job(kinds)
+
+    def run_here(self, job):
+        self.output.write(f"Running {job}")
+        status = run_job(job, self.max_attempts, self.retry_delay)
+        self.output.write(f"Job {job.id}: {status}")
+
+    def start(self, job):
+        self.output.write(f"Running {job}")
+        future = self.pool.submit(run_job_id, job.id, self.max_attempts,
+            self.retry_delay)
+        self.running[future] = job.kind
+        future.add_done_callback(lambda f: self.finished(job, f))
+
+    def finished(self, job, future):
+        try:
+            status = future.result()
+        except Exception as e:
+            status = f"error {e!r}"
+        self.output.write(f"Job {job.id}: {status}")
+
+    def run_due(self):
+        """ Start due jobs, False if there were none and none are running. """
+        for future in [f for f in self.running if f.done()]:
+            del self.running[future]
+        started = False
+        while len(self.running) < self.jobs:
+            close_old_connections()
+            job = self.next_job()
+            if job is None:
+                break
+            started = True
+            if self.pool:
+                self.start(job)
+            else:
+                self.run_here(job)
+        return started or bool(self.running)
+
+    def run(self, once=False):
+        """ Run jobs, until the queue has no due jobs if once. """
+        if self.jobs > 1:
+            # Clean processes, not forked with open database connections
+            connections.close_all()
+            self.pool = ProcessPoolExecutor(self.jobs,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=django.setup)
+        try:
+            while True:
+                if not self.run_due():
+                    if once:
+                        return
+                    time.sleep(self.poll)
+                elif self.running:
+                    wait(self.running, self.poll, FIRST_COMPLETED)
+        finally:
+            if self.pool:
+                self.pool.shutdown()
+
+
+class Command(BaseCommand):
+    help = "Runs queued jobs: uploaded books and library rescans"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--jobs", type=int, default=1,
+            help="Number of jobs run at the same time in worker processes")
+        parser.add_argument("--poll", type=float, default=2.0,
+            metavar="SECONDS", help="Queue check interval when idle")
+        parser.add_argument("--once", action="store_true",
+            help="Exit when there are no due jobs")
+        parser.add_argument("--max-attempts", type=int, default=3,
+            help="Failed jobs are retried until this number of attempts")
+        parser.add_argument("--retry-delay", type=float, default=60.0,
+            metavar="SECONDS", help="Delay before the first retry,"
+            " doubled for every next one")
+        parser.add_argument("--stale", type=float, default=3600.0,
+            metavar="SECONDS", help="Jobs running longer are assumed lost"
+            " by a stopped worker and queued again at start")
+        parser.add_argument("--rescan", nargs="?", const="", metavar="PATH",
+            help="Queue a rescan of the library, or of its subdirectory,"
+            " and exit")
+
+    def handle(self, *args, **options):
+        if options["rescan"] is not None:
+            job = enqueue_rescan(options["rescan"])
+            self.stdout.write(f"Queued job {job.id}")
+            return
+        if options["jobs"] < 1:
+            raise CommandError("--jobs should be at least 1.")
+        requeue_stale(options["stale"], options["max_attempts"])
+        worker = Worker(self.stdout, options["jobs"], options["poll"],
+            options["max_attempts"], options["retry_delay"])
+        try:
+            worker.run(options["once"])
+        except KeyboardInterrupt:
+            pass
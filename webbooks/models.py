@@ -6,8 +6,21 @@ from django.utils import timezone
 from . import conf
 
 
+def search_key(text, length=255):
+    """ Text folded for search: case insensitive, ё is found as е. """
+    return text.casefold().replace("ё", "е")[:length]
+
+
+def index_letter(key):
+    """ Upper case first letter of the search key, "#" if it's not a letter. """
+    first = key[:1]
+    return first.upper() if first.isalpha() else "#"
+
+
 class Genre(models.Model):
-    name = models.CharField(max_length=20)
+    name = models.CharField(max_length=20, unique=True)
+    # Number of books, kept up to date by counts.py
+    book_count = models.IntegerField(default=0, editable=False)
 
     def __str__(self):
         return self.name
@@ -15,7 +28,26 @@ class Genre(models.Model):
 
 
 class Author(models.Model):
-    name = models.CharField(max_length=80)
+    name = models.CharField(max_length=80, unique=True)
+    # Number of books, kept up to date by counts.py
+    book_count = models.IntegerField(default=0, editable=False)
+    # Folded name for search and sorting, and its index letter,
+    # filled on save
+    search_key = models.CharField(max_length=255, db_index=True, default="",
+        editable=False)
+    letter = models.CharField(max_length=1, default="", editable=False)
+    key_fields = ["search_key", "letter"]
+
+    class Meta:
+        indexes = [models.Index(fields=["letter", "search_key", "id"])]
+
+    def update_keys(self):
+        self.search_key = search_key(self.name)
+        self.letter = index_letter(self.search_key)
+
+    def save(self, *args, **kwargs):
+        self.update_keys()
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return self.name
@@ -23,7 +55,20 @@ class Author(models.Model):
 
 
 class Sequence(models.Model):
-    name = models.CharField(max_length=200)
+    name = models.CharField(max_length=200, unique=True)
+    # Number of books, kept up to date by counts.py
+    book_count = models.IntegerField(default=0, editable=False)
+    # Folded name for search, filled on save
+    search_key = models.CharField(max_length=255, db_index=True, default="",
+        editable=False)
+    key_fields = ["search_key"]
+
+    def update_keys(self):
+        self.search_key = search_key(self.name)
+
+    def save(self, *args, **kwargs):
+        self.update_keys()
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return self.name
@@ -38,8 +83,23 @@ class Book(models.Model):
     sequence = models.ForeignKey(Sequence, blank=True, null=True, on_delete=models.SET_NULL)
     sequence_number = models.IntegerField(blank=True, null=True)
     genres = models.ManyToManyField(Genre, blank=True)
-    file = models.CharField(max_length=512)
-    hash = models.CharField(max_length=32)
+    file = models.CharField(max_length=512, db_index=True)
+    hash = models.CharField(max_length=32, db_index=True)
+    # File stat at the last scan, unchanged files are not read again
+    file_size = models.BigIntegerField(blank=True, null=True)
+    file_mtime_ns = models.BigIntegerField(blank=True, null=True)
+    file_inode = models.BigIntegerField(blank=True, null=True)
+    # Folded title for search, filled on save
+    search_key = models.CharField(max_length=255, db_index=True, default="",
+        editable=False)
+    key_fields = ["search_key"]
+
+    def update_keys(self):
+        self.search_key = search_key(self.title)
+
+    def save(self, *args, **kwargs):
+        self.update_keys()
+        super().save(*args, **kwargs)
 
     def full_path(self):
         return Path(conf.WEBBOOKS_ROOT, self.file)
@@ -52,6 +112,147 @@ class Book(models.Model):
 
 
 
+class AuthorLetter(models.Model):
+    """ Number of authors by index letter, kept up to date on changes. """
+    letter = models.CharField(max_length=1, unique=True)
+    count = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.letter}: {self.count}"
+
+
+
+class DuplicateGroup(models.Model):
+    """ Books with the same hash, kept up to date on changes.
+
+    Wasted are the bytes of all the files but the smallest one.
+    """
+    hash = models.CharField(max_length=32, unique=True)
+    count = models.IntegerField()
+    wasted = models.BigIntegerField(default=0)
+
+    class Meta:
+        indexes = [models.Index(fields=["-wasted", "id"])]
+
+    def __str__(self):
+        return f"{self.hash}: {self.count}"
+
+
+
+class DuplicateTotals(models.Model):
+    """ Totals of all duplicate groups, one row kept up to date with them,
+    so the duplicates page doesn't sum the groups. """
+    groups = models.IntegerField(default=0)
+    books = models.IntegerField(default=0)
+    wasted = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.groups} groups, {self.books} books"
+
+
+
+class TextSignature(models.Model):
+    """ MinHash signature of book text, once for every content hash.
+
+    Signature is empty for books which can't be read. Similar texts are
+    in the cluster with the smallest signature id, similarity is the
+    largest one to another text of the cluster.
+    """
+    hash = models.CharField(max_length=32, unique=True)
+    signature = models.BinaryField(blank=True)
+    cluster = models.IntegerField(blank=True, null=True, db_index=True)
+    similarity = models.FloatField(blank=True, null=True)
+
+    def __str__(self):
+        return self.hash
+
+
+
+class SignatureBand(models.Model):
+    """ LSH band key of a signature, equal keys make similar candidates. """
+    signature = models.ForeignKey(TextSignature, on_delete=models.CASCADE)
+    key = models.BigIntegerField(db_index=True)
+
+
+
+class SimilarPair(models.Model):
+    """ Texts with estimated similarity over the threshold, first < second. """
+    first = models.ForeignKey(TextSignature, on_delete=models.CASCADE,
+        related_name="+")
+    second = models.ForeignKey(TextSignature, on_delete=models.CASCADE,
+        related_name="+")
+    similarity = models.FloatField()
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["first", "second"],
+            name="webbooks_similarpair_unique")]
+
+
+
+class LibraryDir(models.Model):
+    """ Library directory mtime at the last scan. """
+    path = models.CharField(max_length=512, unique=True)
+    mtime_ns = models.BigIntegerField()
+
+    def __str__(self):
+        return self.path
+
+
+
+class ChapterText(models.Model):
+    """ Chapter of the indexed book content, shared by books with the hash.
+
+    Text is in the full-text index table with the same row id.
+    Label is empty for the text before the first chapter.
+    """
+    hash = models.CharField(max_length=32, db_index=True)
+    label = models.CharField(max_length=20, blank=True)
+    number = models.CharField(max_length=50, blank=True)
+    title = models.TextField(blank=True)
+
+    def __str__(self):
+        return f"{self.hash} {self.label}"
+
+
+
+class Job(models.Model):
+    """ Background job, run by libworker.
+
+    Upload jobs add the uploaded file at path, named by name, rescan jobs
+    check the library subtree at path, relative to the root.
+    Failed jobs are queued again until attempts reach the limit.
+    """
+    kind = models.CharField(max_length=10)  # "upload" or "rescan"
+    # "queued", "running", "done" or "failed"
+    status = models.CharField(max_length=10, default="queued")
+    path = models.CharField(max_length=512, blank=True)
+    name = models.CharField(max_length=255, blank=True)
+    hash = models.CharField(max_length=32, blank=True)
+    book = models.ForeignKey(Book, blank=True, null=True, on_delete=models.SET_NULL)
+    # Upload result "created" or "exists", rescan log or the last error
+    message = models.TextField(blank=True)
+    attempts = models.IntegerField(default=0)
+    created = models.DateTimeField(default=timezone.now)
+    run_after = models.DateTimeField(default=timezone.now)
+    started = models.DateTimeField(blank=True, null=True)
+    finished = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "run_after"])]
+
+    def result_url(self):
+        """ Page to show when the upload job is done. """
+        if self.status != "done" or self.book_id is None:
+            return None
+        if self.message == "exists":
+            return reverse("webbooks:book_exists", args=[self.book_id])
+        return reverse("webbooks:book", args=[self.book_id])
+
+    def __str__(self):
+        return f"{self.kind} {self.name or self.path or '.'}"
+
+
+
 class Comment(models.Model):
     text = models.TextField()
     book = models.ForeignKey(Book, on_delete=models.CASCADE)
@@ -59,16 +260,21 @@ class Comment(models.Model):
     userid = models.IntegerField(blank=True, null=True)
     time = models.DateTimeField(default=timezone.now)
 
+    class Meta:
+        indexes = [models.Index(fields=["book", "time", "id"]),
+            models.Index(fields=["userid", "time", "id"])]
+
     def anchor(self):
         return f"cmt{self.pk}"
 
     def link(self):
-        url = reverse("webbooks:book", args=[self.book.pk])
-        return f"{url}#{self.anchor()}"
+        """ Book page with comments starting from this one. """
+        url = reverse("webbooks:book", args=[self.book_id])
+        return f"{url}?comments={self.pk}#{self.anchor()}"
 
     def user_link(self):
         url = reverse("webbooks:user_comments", args=[self.userid])
-        return f"{url}#{self.anchor()}"
+        return f"{url}?start={self.pk}#{self.anchor()}"
 
     def __str__(self):
         return self.text
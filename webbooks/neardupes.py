@@ -0,0 +1,366 @@
+""" Books with similar text, found by MinHash signatures and LSH.
+
+Book text is split into shingles of words, every shingle is hashed by
+num_perm hash functions, and the smallest values make the signature:
+the share of equal values of two signatures estimates the Jaccard
+similarity of their shingle sets. Signatures are split into bands, and
+texts with an equal band are compared, so similar texts are found
+without comparing all pairs. Texts are signed once for every content
+hash, like the full-text index.
+
+Signatures are computed with NumPy, which is an optional dependency,
+so it is imported when needed.
+"""
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+from pathlib import Path
+import re
+import zlib
+
+import django
+from django.db import connections, router, transaction
+from django.db.models import Exists, OuterRef
+
+from . import conf
+from .fb2book import StreamScanner
+from .fulltext import ChapterTextWriter, fold
+from .library import ordered_map
+from .models import *
+
+
+num_perm = 128
+bands = 16
+shingle_words = 5
+# Largest prime below 2**32: a*x + b of 32 bit values fits in 64 bits
+prime = 4294967291
+
+Cluster = namedtuple("Cluster", "id books")
+
+
+def seeds(name):
+    """ Hash function parameters, the same in all processes and runs. """
+    return [int.from_bytes(hashlib.sha256(f"{name}{i}".encode()).digest()[:8],
+        "little") % (prime - 1) + 1 for i in range(num_perm)]
+
+
+def book_text(full_path):
+    """ Text of the book, as rendered with decorations["text"]. """
+    writer = ChapterTextWriter()
+    StreamScanner(file=str(full_path), image_url="{name}").scan(writer)
+    return writer.get_result()
+
+
+def shingles(text):
+    """ Unique 32 bit hashes of word shingles of the text. """
+    import numpy as np
+    words = re.findall(r"\w+", fold(text).casefold())
+    if not words:
+        return np.zeros(0, dtype=np.uint64)
+    hashes = np.fromiter((zlib.crc32(word.encode()) for word in words),
+        dtype=np.uint64, count=len(words))
+    size = max(len(words) - shingle_words + 1, 1)
+    values = hashes[:size].copy()
+    for i in range(1, min(shingle_words, len(words))):
+        # Overflow wraps around, that's fine for hashing
+        values = values * np.uint64(1000003) + hashes[i:i+size]
+    values ^= values >> np.uint64(32)
+    return np.unique(values & np.uint64(0xffffffff))
+
+
+def minhash(values, chunk_size=4096):
+    """ Signature of the shingle hashes: uint32 array of num_perm values. """
+    import numpy as np
+    a = np.array(seeds("a"), dtype=np.uint64)[:, None]
+    b = np.array(seeds("b"), dtype=np.uint64)[:, None]
+    signature = np.full(num_perm, prime, dtype=np.uint64)
+    for start in range(0, len(values), chunk_size):
+        chunk = values[None, start:start+chunk_size]
+        np.minimum(signature, ((a * chunk + b) % np.uint64(prime)).min(axis=1),
+            out=signature)
+    return signature.astype("<u4")
+
+
+def from_bytes(data):
+    import numpy as np
+    return np.frombuffer(data, dtype="<u4")
+
+
+def band_keys(signature):
+    """ Keys of the signature bands, with the band number in the key. """
+    rows = num_perm // bands
+    data = signature.tobytes()
+    size = rows * signature.itemsize
+    return [int.from_bytes(hashlib.blake2b(bytes([band])
+        + data[band*size:(band+1)*size], digest_size=8).digest(),
+        "little", signed=True) for band in range(bands)]
+
+
+def similarity(first, second):
+    """ Estimated Jaccard similarity of texts with the signatures. """
+    return float((first == second).mean())
+
+
+def signature_task(item):
+    """ Sign the book text in a worker.
+
+    Texts which can't be parsed get an empty signature, books which
+    can't be read are given with OSError and are signed by the next run.
+    """
+    hash, full_path = item
+    try:
+        values = shingles(book_text(full_path))
+        signature = minhash(values) if len(values) else None
+        return hash, full_path, signature, None
+    except Exception as e:
+        return hash, full_path, None, e
+
+
+def index_db():
+    return router.db_for_write(TextSignature)
+
+
+def missing_books(using):
+    """ (hash, full path) of a book for every content not signed yet. """
+    signed = TextSignature.objects.using(using).filter(hash=OuterRef("hash"))
+    books = Book.objects.using(using).filter(~Exists(signed))
+    seen = set()
+    for hash, file in books.order_by("id").values_list("hash", "file") \
+            .iterator():
+        if hash not in seen:
+            seen.add(hash)
+            yield hash, Path(conf.WEBBOOKS_ROOT, file)
+
+
+def remove_stale(using):
+    """ Remove signatures of deleted books, returns their number. """
+    books = Book.objects.using(using).filter(hash=OuterRef("hash"))
+    stale = TextSignature.objects.using(using).filter(~Exists(books))
+    count = stale.count()
+    if count:
+        stale.delete()
+    return count
+
+
+def write_signatures(batch, using):
+    """ Save signatures and band keys, returns the new signature rows.
+
+    Books which couldn't be read are skipped, to be read again.
+    """
+    batch = [item for item in batch if not isinstance(item[3], OSError)]
+    rows = TextSignature.objects.using(using).bulk_create(
+        TextSignature(hash=hash, signature=b"" if signature is None
+            else signature.tobytes())
+        for hash, _, signature, _ in batch)
+    if any(row.pk is None for row in rows):
+        # Backend can't return ids of inserted rows
+        ids = dict(TextSignature.objects.using(using)
+            .filter(hash__in=[row.hash for row in rows])
+            .values_list("hash", "id"))
+        for row in rows:
+            row.pk = ids[row.hash]
+    SignatureBand.objects.using(using).bulk_create(
+        SignatureBand(signature=row, key=key)
+        for row, (_, _, signature, _) in zip(rows, batch)
+        if signature is not None for key in band_keys(signature))
+    return [row for row in rows if row.signature]
+
+
+def find_pairs(rows, threshold, using):
+    """ Save and return pairs of the new signatures with similar texts.
+
+    Candidates have an equal band key, their signatures are compared.
+    """
+    keys = {row.id: band_keys(from_bytes(row.signature)) for row in rows}
+    found = SignatureBand.objects.using(using).filter(key__in={key
+        for row_keys in keys.values() for key in row_keys})
+    by_key = {}
+    for key, id in found.values_list("key", "signature_id"):
+        by_key.setdefault(key, set()).add(id)
+    pairs = set()
+    for row in rows:
+        for key in keys[row.id]:
+            pairs.update((min(row.id, id), max(row.id, id))
+                for id in by_key.get(key, ()) if id != row.id)
+    ids = {id for pair in pairs for id in pair}
+    signatures = {row.id: from_bytes(row.signature) for row in
+        TextSignature.objects.using(using).filter(id__in=ids)
+            .only("id", "signature")}
+    similar = []
+    for first, second in pairs:
+        value = similarity(signatures[first], signatures[second])
+        if value >= threshold:
+            similar.append(SimilarPair(first_id=first, second_id=second,
+                similarity=value))
+    SimilarPair.objects.using(using).bulk_create(similar,
+        ignore_conflicts=True)
+    return similar
+
+
+def find_root(parents, id):
+    while parents[id] != id:
+        parents[id] = parents[parents[id]]
+        id = parents[id]
+    return id
+
+
+def join(parents, first, second):
+    """ Join sets of the ids, the smallest id is the root. """
+    for id in (first, second):
+        parents.setdefault(id, id)
+    first, second = find_root(parents, first), find_root(parents, second)
+    parents[max(first, second)] = min(first, second)
+
+
+def update_clusters(using):
+    """ Set clusters and similarities of signatures from similar pairs.
+
+    Returns the ids of clusters which are new or changed.
+    """
+    parents = {}
+    best = {}
+    for first, second, value in SimilarPair.objects.using(using) \
+            .values_list("first_id", "second_id", "similarity").iterator():
+        for id in (first, second):
+            best[id] = max(best.get(id, 0), value)
+        join(parents, first, second)
+    clusters = {id: find_root(parents, id) for id in parents}
+    saved = TextSignature.objects.using(using).filter(cluster__isnull=False)
+    old = {id: (cluster, value) for id, cluster, value in
+        saved.values_list("id", "cluster", "similarity").iterator()}
+    changed = {id: (cluster, best[id]) for id, cluster in clusters.items()
+        if old.get(id) != (cluster, best[id])}
+    removed = [id for id in old if id not in clusters]
+    with transaction.atomic(using=using):
+        for start in range(0, len(removed), 500):
+            TextSignature.objects.using(using).filter(
+                id__in=removed[start:start+500]).update(cluster=None,
+                similarity=None)
+        TextSignature.objects.using(using).bulk_update(
+            [TextSignature(id=id, cluster=cluster, similarity=value)
+                for id, (cluster, value) in changed.items()],
+            ["cluster", "similarity"], batch_size=500)
+    return {cluster for cluster, _ in changed.values()}
+
+
+def merge_clusters(pairs, using):
+    """ Add new similar pairs to the stored clusters and similarities.
+
+    Only the clusters of the paired signatures are read, and clusters
+    joined by the pairs get the smallest id of them, as update_clusters()
+    gives. Returns the ids of clusters which are new or changed.
+    """
+    ids = {id for pair in pairs for id in (pair.first_id, pair.second_id)}
+    saved = {}
+    for start in range(0, len(ids), 500):
+        saved.update((id, (cluster, value)) for id, cluster, value in
+            TextSignature.objects.using(using).filter(
+                id__in=sorted(ids)[start:start+500])
+            .values_list("id", "cluster", "similarity"))
+    parents = {}
+    best = {id: value or 0 for id, (_, value) in saved.items()}
+    for pair in pairs:
+        for id in (pair.first_id, pair.second_id):
+            best[id] = max(best[id], pair.similarity)
+            if saved[id][0] is not None:
+                join(parents, id, saved[id][0])
+        join(parents, pair.first_id, pair.second_id)
+    old = {cluster for cluster, _ in saved.values() if cluster is not None}
+    with transaction.atomic(using=using):
+        for cluster in old:
+            root = find_root(parents, cluster)
+            if root != cluster:
+                TextSignature.objects.using(using).filter(cluster=cluster) \
+                    .update(cluster=root)
+        TextSignature.objects.using(using).bulk_update(
+            [TextSignature(id=id, cluster=find_root(parents, id),
+                similarity=value) for id, value in best.items()],
+            ["cluster", "similarity"], batch_size=500)
+    return {find_root(parents, id) for id in best}
+
+
+def current_clusters(ids, using):
+    """ Clusters of the signatures with the ids.
+
+    A cluster of an earlier batch is its smallest signature, which is in
+    the joined cluster if a later batch joined it with another one.
+    """
+    ids = sorted(ids)
+    clusters = set()
+    for start in range(0, len(ids), 500):
+        clusters.update(TextSignature.objects.using(using)
+            .filter(id__in=ids[start:start+500])
+            .values_list("cluster", flat=True))
+    return clusters
+
+
+def update(output=None, jobs=1, threshold=0.8, batch_size=50):
+    """ Sign new books, find their similar texts and update clusters.
+
+    Pairs of the new books are added to the stored clusters with every
+    batch, which are found again from all pairs only if signatures were
+    removed.
+    Books are read by jobs worker processes if jobs > 1. Returns counts
+    of signed, removed, similar pairs and errors, and the ids of new or
+    changed clusters.
+    """
+    using = index_db()
+    counts = {"signed": 0, "removed": 0, "similar": 0, "errors": 0}
+    with transaction.atomic(using=using):
+        counts["removed"] = remove_stale(using)
+    books = missing_books(using)
+    merge = not counts["removed"]
+    clusters = set()
+    pool = None
+    if jobs > 1:
+        connections.close_all()
+        pool = ProcessPoolExecutor(jobs, initializer=django.setup)
+        results = ordered_map(pool, signature_task, books, jobs*4)
+    else:
+        results = map(signature_task, books)
+    try:
+        while True:
+            batch = [result for _, result in zip(range(batch_size), results)]
+            if not batch:
+                break
+            with transaction.atomic(using=using):
+                for hash, full_path, signature, error in batch:
+                    if error is not None:
+                        counts["errors"] += 1
+                        if output:
+                            output.write(f"error: {full_path}: {error!r}")
+                rows = write_signatures(batch, using)
+                pairs = find_pairs(rows, threshold, using)
+                if merge:
+                    clusters |= merge_clusters(pairs, using)
+            counts["similar"] += len(pairs)
+            counts["signed"] += sum(not isinstance(error, OSError)
+                for _, _, _, error in batch)
+    finally:
+        if pool:
+            pool.shutdown(cancel_futures=True)
+    if not merge:
+        return counts, update_clusters(using)
+    return counts, current_clusters(clusters, using)
+
+
+def clear(using=None):
+    TextSignature.objects.using(using or index_db()).all().delete()
+
+
+def cluster_books(ids):
+    """ Clusters with the ids and their books, with authors and similarity.
+
+    Books with the same content are in the cluster with the same
+    similarity.
+    """
+    signatures = TextSignature.objects.filter(cluster__in=ids) \
+        .values_list("hash", "cluster", "similarity")
+    found = {hash: (cluster, value) for hash, cluster, value in signatures}
+    books = {id: [] for id in ids}
+    for book in Book.objects.filter(hash__in=found).order_by("id") \
+            .prefetch_related("authors"):
+        cluster, book.similarity = found[book.hash]
+        books[cluster].append(book)
+    return [Cluster(id, books[id]) for id in ids]
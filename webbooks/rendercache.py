@@ -0,0 +1,330 @@
+""" Cache of rendered books, keyed by book file hash. """
+
+from bisect import bisect_right
+import functools
+import hashlib
+import os
+import pickle
+import tempfile
+from pathlib import Path
+
+from django.core.cache import caches
+
+from . import conf
+from .fb2book import BookProcessor, RENDERER_VERSION
+
+
+# Image links used by ReadView, relative to read<pk>/
+READER_IMAGES = "img/{name}"
+
+
+class RenderedBook:
+    """ Rendered book content with its toc and chapters.
+
+    Chapters are (label, number, title, offset) tuples. For paged reading
+    the content is split at chapters up to some depth, first child
+    chapters stay on their parent page.
+    """
+
+    def __init__(self, content, toc, chapters):
+        self.content = content
+        self.toc = toc
+        self.chapters = chapters
+
+    @staticmethod
+    def starts_page(number, depth):
+        parts = number.split(".")
+        return len(parts) <= depth and (len(parts) == 1 or parts[-1] != "1")
+
+    def pages(self, depth):
+        """ List of (label, offset) of page starts. """
+        pages = [(label, offset) for label,number,_,offset in self.chapters
+            if self.starts_page(number, depth)]
+        if pages:
+            pages[0] = (pages[0][0], 0)
+        return pages
+
+    def page_index(self, pages, offset):
+        return bisect_right([o for _,o in pages], offset) - 1
+
+    def toc_pages(self, depth):
+        """ Chapters as (label, number, title, page label). """
+        pages = self.pages(depth)
+        return [(label, number, title, pages[self.page_index(pages, offset)][0])
+            for label,number,title,offset in self.chapters]
+
+    def locate(self, label, depth):
+        """ Pages and the index of the page with the chapter, None if no
+        such chapter. """
+        offsets = {label: offset for label,_,_,offset in self.chapters}
+        if label not in offsets:
+            return None
+        pages = self.pages(depth)
+        return pages, self.page_index(pages, offsets[label])
+
+    def page_label(self, label, depth):
+        """ Label of the page with the chapter, None if no such chapter. """
+        found = self.locate(label, depth)
+        if found is None:
+            return None
+        pages, index = found
+        return pages[index][0]
+
+    def page_html(self, pages, index):
+        start = pages[index][1]
+        last = index+1 == len(pages)
+        end = len(self.content) if last else pages[index+1][1]
+        return self.content[start:end]
+
+    def page(self, label, depth, html=None):
+        """ Page with the chapter as a dict, None if no such chapter.
+
+        Page html is cut from the content, unless given.
+        """
+        found = self.locate(label, depth)
+        if found is None:
+            return None
+        pages, index = found
+        last = index+1 == len(pages)
+        return {
+            "label": pages[index][0],
+            "html": self.page_html(pages, index) if html is None else html,
+            "prev": pages[index-1][0] if index > 0 else None,
+            "next": None if last else pages[index+1][0],
+        }
+
+    def page_texts(self, depth):
+        """ List of (page label, html) of all pages. """
+        pages = self.pages(depth)
+        return [(label, self.page_html(pages, index))
+            for index,(label,_) in enumerate(pages)]
+
+    def without_content(self):
+        return RenderedBook("", self.toc, self.chapters)
+
+
+def variant_key(format, image_url):
+    variant = f"{format}|{image_url}|{RENDERER_VERSION}"
+    return hashlib.md5(variant.encode()).hexdigest()[:12]
+
+
+class DiskCache:
+    """ Pickled entries in a directory.
+
+    Reading an entry updates its mtime, least recently used entries
+    are removed when total size grows over max_size, down to the
+    low_water part of it, so a full cache isn't scanned on every write.
+    The total is counted by one scan and kept up to date on writes, other
+    processes writing to the directory are noticed by a scan every
+    rescan_every writes.
+    """
+
+    rescan_every = 1000
+    low_water = 0.9
+
+    def __init__(self, path, max_size):
+        self.path = Path(path)
+        self.max_size = max_size
+        self.size = None
+        self.writes = 0
+
+    def entry_path(self, hash, variant):
+        return self.path / f"{hash}-{variant}"
+
+    def contains(self, hash, variant):
+        return self.entry_path(hash, variant).exists()
+
+    def get(self, hash, variant):
+        path = self.entry_path(hash, variant)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+            os.utime(path)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+        return value
+
+    def set(self, hash, variant, value):
+        self.path.mkdir(parents=True, exist_ok=True)
+        if self.size is None:
+            self.size = sum(size for _, size, _ in self.entries())
+        with tempfile.NamedTemporaryFile(dir=self.path, prefix=".",
+                delete=False) as f:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        path = self.entry_path(hash, variant)
+        self.size += os.stat(f.name).st_size - file_size(path)
+        os.replace(f.name, path)
+        self.writes += 1
+        if self.size > self.max_size or self.writes >= self.rescan_every:
+            self.evict()
+
+    def invalidate(self, hash):
+        for path in self.path.glob(f"{hash}-*"):
+            if self.size is not None:
+                self.size -= file_size(path)
+            path.unlink(missing_ok=True)
+
+    def entries(self):
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if entry.is_file() and not entry.name.startswith("."):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    yield stat.st_mtime_ns, stat.st_size, entry.path
+
+    def evict(self):
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        if total > self.max_size:
+            for _, size, path in entries:
+                if total <= self.max_size * self.low_water:
+                    break
+                Path(path).unlink(missing_ok=True)
+                total -= size
+        self.size = total
+        self.writes = 0
+
+
+def file_size(path):
+    try:
+        return os.stat(path).st_size
+    except FileNotFoundError:
+        return 0
+
+
+class DjangoCache:
+    """ Entries in a Django cache, eviction is left to the cache backend.
+
+    A list of cached variants is kept per hash for invalidation.
+    """
+
+    prefix = "webbooks-render"
+
+    def __init__(self, alias):
+        self.cache = caches[alias]
+
+    def key(self, hash, variant=None):
+        if variant is None:
+            return f"{self.prefix}-{hash}"
+        return f"{self.prefix}-{hash}-{variant}"
+
+    def contains(self, hash, variant):
+        return self.cache.has_key(self.key(hash, variant))
+
+    def get(self, hash, variant):
+        return self.cache.get(self.key(hash, variant))
+
+    def set(self, hash, variant, value):
+        self.cache.set(self.key(hash, variant), value, timeout=None)
+        variants = self.cache.get(self.key(hash), [])
+        if variant not in variants:
+            self.cache.set(self.key(hash), variants+[variant], timeout=None)
+
+    def invalidate(self, hash):
+        variants = self.cache.get(self.key(hash), [])
+        keys = [self.key(hash, v) for v in variants] + [self.key(hash)]
+        self.cache.delete_many(keys)
+
+
+class NoCache:
+
+    def contains(self, hash, variant):
+        return False
+
+    def get(self, hash, variant):
+        return None
+
+    def set(self, hash, variant, value):
+        pass
+
+    def invalidate(self, hash):
+        pass
+
+
+@functools.lru_cache(maxsize=8)
+def disk_cache(path, max_size):
+    """ DiskCache shared by the process, with its size total. """
+    return DiskCache(path, max_size)
+
+
+def get_cache():
+    backend = conf.WEBBOOKS_RENDER_CACHE
+    if backend == "disk":
+        return disk_cache(conf.WEBBOOKS_RENDER_CACHE_DIR,
+            conf.WEBBOOKS_RENDER_CACHE_SIZE)
+    elif backend == "django":
+        return DjangoCache(conf.WEBBOOKS_RENDER_CACHE_ALIAS)
+    elif not backend:
+        return NoCache()
+    raise ValueError(f"Unknown render cache backend: {backend}")
+
+
+def render(full_path, format="html", image_url=None):
+    book = BookProcessor(file=full_path, mode="stream", image_url=image_url)
+    content, toc = book.get_content(format)
+    return RenderedBook(content, toc, book.get_chapters(format))
+
+
+def get_cached(hash, format="html", image_url=None):
+    """ Cached RenderedBook or None. """
+    return get_cache().get(hash, variant_key(format, image_url))
+
+
+def get_content(full_path, hash, format="html", image_url=None):
+    """ RenderedBook of the book file, from cache if possible. """
+    value = get_cached(hash, format, image_url)
+    if value is None:
+        value = render(full_path, format, image_url)
+        get_cache().set(hash, variant_key(format, image_url), value)
+    return value
+
+
+def prerender(full_path, hash, format="html", image_url=None, force=False):
+    """ Put rendered book into the cache, return True if rendered. """
+    cache = get_cache()
+    variant = variant_key(format, image_url)
+    if not force and cache.contains(hash, variant):
+        return False
+    cache.set(hash, variant, render(full_path, format, image_url))
+    return True
+
+
+def page_variant(depth, image_url, label=None):
+    """ Variant of the chapters of a book read by pages, or of a page. """
+    format = f"pages{depth}" if label is None else f"page{depth}|{label}"
+    return variant_key(format, image_url)
+
+
+def get_cached_page(hash, label, depth, image_url=None):
+    """ (RenderedBook without content, page dict) of the chapter from
+    the cache, None if not cached.
+
+    The page is None if the book has no such chapter.
+    """
+    cache = get_cache()
+    book = cache.get(hash, page_variant(depth, image_url))
+    if book is None:
+        return None
+    page_label = book.page_label(label, depth)
+    if page_label is None:
+        return book, None
+    html = cache.get(hash, page_variant(depth, image_url, page_label))
+    if html is None:
+        return None
+    return book, book.page(label, depth, html)
+
+
+def cache_pages(rendered, hash, depth, image_url=None):
+    """ Put the pages of RenderedBook into the cache one by one, so a page
+    is read without the whole book. """
+    cache = get_cache()
+    for label, html in rendered.page_texts(depth):
+        cache.set(hash, page_variant(depth, image_url, label), html)
+    # Written last, so pages are looked up only when all are written
+    cache.set(hash, page_variant(depth, image_url), rendered.without_content())
+
+
+def invalidate(hash):
+    get_cache().invalidate(hash)
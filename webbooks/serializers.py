@@ -1,7 +1,7 @@
 from django.db import models
 from rest_framework import serializers
 
-from webbooks.models import Genre,Author,Sequence,Book,Comment
+from webbooks.models import Genre,Author,Sequence,Book,Comment,DuplicateGroup
 
 
 
@@ -46,3 +46,15 @@ class FullBookSerializer(serializers.ModelSerializer):
         fields = ['id', 'title', 'authors', 'genres', 'date',
             'annotation', 'sequence', 'sequence_number', 'file', 'hash']
         depth = 1
+
+
+class DuplicateGroupSerializer(ScopedSerializer):
+    books = serializers.SerializerMethodField()
+
+    class Meta:
+        model = DuplicateGroup
+        fields = ['url', 'id', 'hash', 'count', 'wasted', 'books']
+
+    def get_books(self, group):
+        return [{'id': book.id, 'title': book.title, 'file': book.file,
+            'file_size': book.file_size} for book in group.books]
@@ -1,8 +1,13 @@
+import functools
 import hashlib
+import os
 from pathlib import Path
 
-from .fb2book import BookProcessor
-from . import conf
+from django.db import connections, router, transaction
+from django.db.models import Count, Min
+
+from .fb2book import BookProcessor,BinaryIndex
+from . import conf, counts, rendercache
 from .models import *
 
 
@@ -10,9 +15,9 @@ def file_hash(file):
     is_file_like = all(hasattr(file, attr)
         for attr in ('seek', 'close', 'read', 'write'))
     if not is_file_like:
-        file = open(file, "rb")
-    hasher = hashlib.file_digest(file, "md5")
-    return hasher.hexdigest()
+        with open(file, "rb") as f:
+            return hashlib.file_digest(f, "md5").hexdigest()
+    return hashlib.file_digest(file, "md5").hexdigest()
 
 
 def get_default_path(book_path):
@@ -41,8 +46,30 @@ def find_by_hash(book_hash, values=None):
         return records[0]
 
 
+def group_books(groups):
+    """ Set books of the duplicate groups, with authors, in one query. """
+    books = Book.objects.filter(hash__in=[group.hash for group in groups]) \
+        .order_by("id").prefetch_related("authors")
+    by_hash = {}
+    for book in books:
+        by_hash.setdefault(book.hash, []).append(book)
+    for group in groups:
+        group.books = by_hash.get(group.hash, [])
+    return groups
+
+
+@functools.lru_cache(maxsize=32)
+def binary_index(full_path, hash):
+    """ Cached BinaryIndex, hash in the key drops changed books. """
+    return BinaryIndex(full_path)
+
+
+def author_names(names):
+    return sorted(names) if names else ["Unknown"]
+
+
 def set_authors(book, names):
-    names = sorted(names) if names else ["Unknown"]
+    names = author_names(names)
     authors = [Author.objects.get_or_create(name=n)[0] for n in names]
     book.authors.set(authors)
 
@@ -68,47 +95,300 @@ def fill_extra_info(book, metadata):
     set_genres(book, metadata.genres)
 
 
-def add_book(full_path, hash=None, id=None):
-    content = BookProcessor(file=full_path)
+def read_metadata(full_path):
+    content = BookProcessor(file=full_path, mode="metadata")
     metadata = content.get_metadata()
+    metadata.tree = None
+    return metadata
+
+
+def new_metadata(full_path, hash):
+    """ Metadata of the book, None if its content is in the library. """
+    if find_by_hash(hash):
+        return None
+    return read_metadata(full_path)
+
+
+def read_book_file(full_path):
+    """ Hash of a book file, and its metadata if the content is new.
+
+    The file is hashed by chunks, then only the <description> of new
+    content is parsed: moved books are found by hash without it, even
+    if it is broken, and check_book_file() reads it if it is needed.
+    Result can be sent from a worker process to check_book_file().
+    """
+    hash = file_hash(full_path)
+    return hash, new_metadata(full_path, hash)
+
+
+def stat_signature(stat):
+    """ Book fields which tell if the file was changed. """
+    return {
+        "file_size": stat.st_size,
+        "file_mtime_ns": stat.st_mtime_ns,
+        "file_inode": stat.st_ino,
+    }
+
+
+def update_signature(book, signature):
+    changed = {k: v for k,v in signature.items() if getattr(book, k) != v}
+    if changed:
+        for field, value in changed.items():
+            setattr(book, field, value)
+        Book.objects.filter(id=book.id).update(**changed)
+        if "file_size" in changed:
+            counts.update_groups([book.hash])
+
+
+def add_book(full_path, hash=None, id=None, metadata=None, stat=None):
+    if stat is None:
+        stat = os.stat(full_path)
+    if metadata is None:
+        metadata = read_metadata(full_path)
     if hash is None:
         hash = file_hash(full_path)
     book_path = get_book_path(full_path)
-    book = Book(title=metadata.title, file=book_path, hash=hash)
+    book = Book(title=metadata.title, file=book_path, hash=hash,
+        **stat_signature(stat))
     if id is not None:
         book.id = id
     fill_extra_info(book, metadata)
     return book
 
 
-def check_book_file(full_path):
-    """ Check and update if file in the library is changed. """
-    hash = file_hash(full_path)
+def merge_names(model, ids):
+    """ Replaces Author, Genre or Sequence rows ids[1:] with ids[0] in
+    books and deletes them.
+
+    Only ids, names and links are used, so it works on a database made
+    before the names were unique, to merge duplicates before migrate.
+    """
+    keep, extras = ids[0], list(ids[1:])
+    if model is Sequence:
+        Book.objects.filter(sequence_id__in=extras).update(sequence_id=keep)
+    else:
+        field = "author_id" if model is Author else "genre_id"
+        through = getattr(Book, model._meta.model_name+"s").through
+        for extra in extras:
+            linked = through.objects.filter(**{field: keep}).values("book_id")
+            links = through.objects.filter(**{field: extra})
+            links.filter(book_id__in=linked).delete()
+            links.update(**{field: keep})
+    using = router.db_for_write(model)
+    with connections[using].cursor() as cursor:
+        table = connections[using].ops.quote_name(model._meta.db_table)
+        marks = ",".join(["%s"]*len(extras))
+        cursor.execute(f"DELETE FROM {table} WHERE id IN ({marks})", extras)
+
+
+def merge_duplicate_names(model):
+    """ Merges rows of the model with the same name into the first one.
+
+    Returns the number of rows deleted.
+    """
+    groups = (model.objects.values("name")
+        .annotate(keep=Min("id"), count=Count("id")).filter(count__gt=1))
+    merged = 0
+    with transaction.atomic(using=router.db_for_write(model)):
+        for group in groups:
+            extras = (model.objects.filter(name=group["name"])
+                .exclude(id=group["keep"]).values_list("id", flat=True))
+            extras = list(extras)
+            merge_names(model, [group["keep"]] + extras)
+            merged += len(extras)
+    return merged
+
+
+class NameCache:
+    """ Ids of Author, Genre or Sequence rows by name.
+
+    Missing rows are created in bulk. Ids of rows created in a rolled
+    back transaction are wrong, so clear() the cache after a rollback.
+    """
+
+    chunk_size = 500
+
+    def __init__(self, model):
+        self.model = model
+        self.ids = {}
+
+    def clear(self):
+        self.ids.clear()
+
+    def load(self, names):
+        names = list(names)
+        for start in range(0, len(names), self.chunk_size):
+            chunk = names[start:start+self.chunk_size]
+            rows = self.model.objects.filter(name__in=chunk)
+            self.ids.update(rows.values_list("name", "id"))
+
+    def get_ids(self, names):
+        """ Ids of the names, in the same order. """
+        missing = set(names) - self.ids.keys()
+        if missing:
+            self.load(missing)
+            new = missing - self.ids.keys()
+            if new:
+                rows = [self.model(name=name) for name in new]
+                if hasattr(self.model, "update_keys"):
+                    # Bulk inserts don't call save()
+                    for row in rows:
+                        row.update_keys()
+                self.model.objects.bulk_create(rows,
+                    batch_size=self.chunk_size, ignore_conflicts=True)
+                if self.model is Author:
+                    counts.authors_added(rows)
+                self.load(new)
+        return [self.ids[name] for name in names]
+
+
+class BookImporter:
+    """ Adds new books to the database in batches.
+
+    Books are written every batch_size added books, and by flush(),
+    each batch in one transaction with bulk inserts. If a batch fails,
+    its books are written one by one, and on_error(full_path, error)
+    is called for failed books, or the error is raised if not given.
+    Use as a context manager to flush at exit, even on errors.
+    """
+
+    def __init__(self, batch_size=500, on_error=None):
+        self.batch_size = batch_size
+        self.on_error = on_error
+        self.authors = NameCache(Author)
+        self.genres = NameCache(Genre)
+        self.sequences = NameCache(Sequence)
+        self.pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def add(self, full_path, hash, metadata, stat):
+        """ Book for the file, saved later. """
+        book = Book(title=metadata.title, file=get_book_path(full_path),
+            hash=hash, **stat_signature(stat))
+        book.update_keys()
+        for field in ('date','annotation', 'sequence_number'):
+            setattr(book, field, getattr(metadata, field, ""))
+        self.pending.append((full_path, book, metadata))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        return book
+
+    def flush(self):
+        pending, self.pending = self.pending, []
+        if not pending:
+            return
+        try:
+            self.write(pending)
+        except Exception:
+            self.clear_caches()
+            for item in pending:
+                self.write_single(item)
+
+    def write_single(self, item):
+        full_path, book, _ = item
+        try:
+            self.write([item])
+        except Exception as e:
+            self.clear_caches()
+            book.pk = None
+            if self.on_error is None:
+                raise
+            self.on_error(full_path, e)
+
+    def clear_caches(self):
+        for cache in (self.authors, self.genres, self.sequences):
+            cache.clear()
+
+    def write(self, pending):
+        with transaction.atomic(using=router.db_for_write(Book)):
+            for _, book, _ in pending:
+                book.pk = None
+            self.write_books(pending)
+
+    def write_books(self, pending):
+        sequences = [meta.sequence for _,_,meta in pending if meta.sequence]
+        sequence_ids = dict(zip(sequences, self.sequences.get_ids(sequences)))
+        for _, book, metadata in pending:
+            book.sequence_id = sequence_ids.get(metadata.sequence)
+        books = [book for _,book,_ in pending]
+        Book.objects.bulk_create(books)
+        if any(book.pk is None for book in books):
+            # Backend can't return ids of inserted rows
+            files = [str(book.file) for book in books]
+            ids = dict(Book.objects.filter(file__in=files)
+                .values_list("file", "id"))
+            for book in books:
+                book.pk = ids[str(book.file)]
+        links = []
+        for _, book, metadata in pending:
+            names = author_names(metadata.authors)
+            links += [Book.authors.through(book_id=book.pk, author_id=id)
+                for id in self.authors.get_ids(names)]
+        Book.authors.through.objects.bulk_create(links, ignore_conflicts=True)
+        links = []
+        for _, book, metadata in pending:
+            links += [Book.genres.through(book_id=book.pk, genre_id=id)
+                for id in self.genres.get_ids(metadata.genres)]
+        Book.genres.through.objects.bulk_create(links, ignore_conflicts=True)
+        counts.books_inserted(book.pk for book in books)
+
+
+def check_book_file(full_path, hash=None, metadata=None, stat=None,
+        importer=None):
+    """ Check and update if file in the library is changed.
+
+    Hash, metadata and stat are read from the file if not given.
+    New books are added by the importer if given, saved later. Updated
+    books have the hash of the replaced content in replaced_hash.
+    """
+    if stat is None:
+        stat = os.stat(full_path)
+    if hash is None:
+        hash, metadata = read_book_file(full_path)
     book_path = get_book_path(full_path)
     found_book = find_by_path(book_path)
     if found_book:
         if found_book.hash == hash:
+            update_signature(found_book, stat_signature(stat))
             return found_book, "exists"
         # todo: Use old info as default. Maybe discard new info?
-        book = add_book(full_path, hash, id=found_book.id)
+        book = add_book(full_path, hash, id=found_book.id, metadata=metadata,
+            stat=stat)
+        book.replaced_hash = found_book.hash
+        rendercache.invalidate(found_book.hash)
         return book, "updated"
     found_book = find_by_hash(hash)
     if found_book:
         if not found_book.full_path().is_file():
             found_book.file = book_path
+            for field, value in stat_signature(stat).items():
+                setattr(found_book, field, value)
             found_book.save()
             return found_book, "moved"
-    book = add_book(full_path, hash)
+    if importer is not None:
+        if metadata is None:
+            metadata = read_metadata(full_path)
+        return importer.add(full_path, hash, metadata, stat), "created"
+    book = add_book(full_path, hash, metadata=metadata, stat=stat)
     return book, "created"
 
 
-def add_book_file(full_path):
-    """ Add uploaded file to library. """
-    hash = file_hash(full_path)
+def add_book_file(full_path, hash=None, name=None):
+    """ Add uploaded file to library.
+
+    File is named by name if given, hash is computed if not given.
+    """
+    if hash is None:
+        hash = file_hash(full_path)
     found_book = find_by_hash(hash)
     if found_book:
         return found_book, "exists"
-    new_path = get_default_path(full_path)
+    new_path = get_default_path(name or full_path)
     book_path = get_book_path(new_path)
     found_book = find_by_path(book_path)
     if found_book:
@@ -117,3 +397,11 @@ def add_book_file(full_path):
     Path(full_path).replace(new_path)
     book = add_book(new_path, hash)
     return book, "created"
+
+
+def add_uploaded_book(full_path, hash, name):
+    """ Add the uploaded temporary file, removing it if it is not added. """
+    book, result = add_book_file(full_path, hash, name)
+    if result != "created":
+        Path(full_path).unlink(missing_ok=True)
+    return book, result
@@ -0,0 +1,86 @@
+// Load book comments by pages when they are scrolled into view.
+(function() {
+    const comments = document.getElementById("comments");
+    let loading = false;
+
+    function link(className, href, text) {
+        const a = document.createElement("a");
+        a.className = className;
+        a.href = href;
+        a.textContent = text;
+        return a;
+    }
+
+    function add(comment) {
+        comments.appendChild(document.createElement("hr"));
+        const div = document.createElement("div");
+        div.className = "comment";
+        const head = document.createElement("p");
+        head.className = "comment-head";
+        head.id = comment.anchor;
+        head.appendChild(link("comment-user", comment.user_url, comment.username));
+        head.append(" ");
+        head.appendChild(link("comment-time", comment.url, comment.time));
+        const text = document.createElement("p");
+        text.className = "comment-text";
+        text.textContent = comment.text;
+        div.append(head, text);
+        comments.appendChild(div);
+    }
+
+    function message(text) {
+        const p = document.createElement("p");
+        p.textContent = text;
+        comments.appendChild(p);
+        return p;
+    }
+
+    function show(data, first) {
+        if (first) {
+            message(data.comments.length ? "Comments:" : "No comments yet.");
+        }
+        data.comments.forEach(add);
+        if (first && window.location.hash) {
+            const target = document.getElementById(window.location.hash.slice(1));
+            if (target) {
+                target.scrollIntoView();
+            }
+        }
+        if (data.next) {
+            const more = document.createElement("button");
+            more.textContent = "More comments";
+            more.addEventListener("click", () => {
+                more.remove();
+                load(data.next, false);
+            });
+            comments.appendChild(more);
+        }
+    }
+
+    function load(url, first) {
+        fetch(url)
+            .then(response => response.ok ? response.json() : null)
+            .catch(() => null)
+            .then(data => data ? show(data, first)
+                : message("Comments can't be loaded."));
+    }
+
+    function start() {
+        if (!loading) {
+            loading = true;
+            load(comments.dataset.url, true);
+        }
+    }
+
+    if (window.location.hash.startsWith("#cmt")
+            || !("IntersectionObserver" in window)) {
+        start();
+    } else {
+        new IntersectionObserver((entries, observer) => {
+            if (entries.some(entry => entry.isIntersecting)) {
+                observer.disconnect();
+                start();
+            }
+        }, {rootMargin: "200px"}).observe(comments);
+    }
+})();
@@ -0,0 +1,33 @@
+// Poll the upload job and open the book when it is added.
+(function() {
+    const job = document.getElementById("job");
+    const interval = 1000;
+
+    function failed(error) {
+        job.textContent = "";
+        const message = document.createElement("strong");
+        message.textContent = "Upload failed: " + error;
+        const p = document.createElement("p");
+        p.appendChild(message);
+        job.appendChild(p);
+    }
+
+    function poll() {
+        fetch(job.dataset.statusUrl)
+            .then(response => response.ok ? response.json() : null)
+            .catch(() => null)
+            .then(data => {
+                if (data && data.url) {
+                    window.location = data.url;
+                } else if (data && data.status === "failed") {
+                    failed(data.error);
+                } else {
+                    setTimeout(poll, interval);
+                }
+            });
+    }
+
+    if (!job.querySelector("strong")) {
+        setTimeout(poll, interval);
+    }
+})();
@@ -0,0 +1,61 @@
+// Prefetch the next chapter and show chapters without page reload.
+(function() {
+    const chapter = document.getElementById("chapter");
+    const loaded = {};
+
+    function load(label) {
+        if (!(label in loaded)) {
+            loaded[label] = fetch(label + ".json")
+                .then(response => response.ok ? response.json() : null)
+                .catch(() => null);
+        }
+        return loaded[label];
+    }
+
+    function setLinks(selector, label) {
+        for (const link of document.querySelectorAll(selector)) {
+            link.setAttribute("href", label || "");
+            link.hidden = !label;
+        }
+    }
+
+    function show(page) {
+        chapter.innerHTML = page.html;
+        chapter.dataset.label = page.label;
+        chapter.dataset.prev = page.prev || "";
+        chapter.dataset.next = page.next || "";
+        setLinks(".prev-chapter", page.prev);
+        setLinks(".next-chapter", page.next);
+        window.scrollTo(0, 0);
+        if (page.next) {
+            load(page.next);
+        }
+    }
+
+    function open(label, link) {
+        load(label).then(page => {
+            if (!page) {
+                window.location = link.href;
+                return;
+            }
+            show(page);
+            history.pushState({label: page.label}, "", page.label);
+        });
+    }
+
+    document.addEventListener("click", event => {
+        const link = event.target.closest(".prev-chapter, .next-chapter");
+        if (link) {
+            event.preventDefault();
+            open(link.getAttribute("href"), link);
+        }
+    });
+
+    window.addEventListener("popstate", () => {
+        window.location.reload();
+    });
+
+    if (chapter.dataset.next) {
+        load(chapter.dataset.next);
+    }
+})();
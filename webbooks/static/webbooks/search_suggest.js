@@ -0,0 +1,50 @@
+// Fill search suggestions while typing, open the chosen one.
+(function() {
+    const input = document.getElementById("search_query");
+    const list = document.getElementById("search_suggestions");
+    const delay = 150;
+    let urls = {};
+    let timer = null;
+    let last = null;
+
+    function show(data) {
+        list.textContent = "";
+        urls = {};
+        for (const item of [...data.books, ...data.authors, ...data.sequences]) {
+            const option = document.createElement("option");
+            option.value = item.name;
+            list.appendChild(option);
+            if (item.url && !(item.name in urls)) {
+                urls[item.name] = item.url;
+            }
+        }
+    }
+
+    function update() {
+        const query = input.value.trim();
+        if (!query || query === last) {
+            return;
+        }
+        last = query;
+        const url = input.dataset.suggestUrl + "?q=" + encodeURIComponent(query);
+        fetch(url)
+            .then(response => response.ok ? response.json() : null)
+            .catch(() => null)
+            .then(data => {
+                if (data && query === last) {
+                    show(data);
+                }
+            });
+    }
+
+    input.addEventListener("input", function() {
+        clearTimeout(timer);
+        timer = setTimeout(update, delay);
+    });
+
+    input.addEventListener("change", function() {
+        if (input.value in urls) {
+            window.location = urls[input.value];
+        }
+    });
+})();
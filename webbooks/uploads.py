@@ -0,0 +1,176 @@
+""" Upload handler which hashes and checks books while they are received. """
+
+import codecs
+import hashlib
+import io
+from pathlib import Path
+import struct
+import tempfile
+import zipfile
+
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import (FileUploadHandler, SkipFile,
+    StopFutureHandlers)
+
+from . import conf
+from .services import find_by_hash
+
+
+zip_header = struct.Struct("<4sHHHHHIIIHH")
+
+
+def zip_members(data):
+    """ Names of zip members with local headers in data.
+
+    Second value tells if these are all the members.
+    """
+    names = []
+    position = 0
+    while data.startswith(b"PK\x03\x04", position):
+        if position + zip_header.size > len(data):
+            return names, False
+        (_, _, flags, _, _, _, _, size, _, name_size,
+            extra_size) = zip_header.unpack_from(data, position)
+        start = position + zip_header.size
+        if start + name_size > len(data):
+            return names, False
+        names.append(data[start:start+name_size].decode("utf-8", "replace"))
+        if flags & 0x08 or size == 0xFFFFFFFF:
+            # Size is in the data descriptor or zip64 extra field
+            return names, False
+        position = start + name_size + extra_size + size
+    complete = data.startswith((b"PK\x01\x02", b"PK\x05\x06"), position)
+    return names, complete
+
+
+def check_book_start(name, data):
+    """ Error message if the file can't be a book by its start. """
+    if name.endswith(".fb2.zip"):
+        if not data.startswith(b"PK\x03\x04"):
+            return "The file is not a zip archive."
+        names, complete = zip_members(data)
+        if complete and not any(n.endswith(".fb2") for n in names):
+            return "No .fb2 file inside the zip archive."
+    elif name.endswith(".fb2"):
+        if data.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+            return None
+        start = data.removeprefix(codecs.BOM_UTF8).lstrip()
+        if not start.startswith(b"<"):
+            return "The file is not an fb2 book."
+    else:
+        return "Book file name should end with .fb2 or .fb2.zip"
+    return None
+
+
+def check_received_book(path, name):
+    """ Error message if the received file can't be a book. """
+    if name.endswith(".fb2.zip"):
+        try:
+            with zipfile.ZipFile(path) as archive:
+                names = archive.namelist()
+        except zipfile.BadZipFile:
+            return "The file is not a zip archive."
+        if not any(n.endswith(".fb2") for n in names):
+            return "No .fb2 file inside the zip archive."
+    return None
+
+
+class UploadedBook(UploadedFile):
+    """ Book saved in the upload directory, with its md5 hash.
+
+    If a book with the same hash exists, it is given as duplicate
+    and the file is not saved. The file is removed at the end of the
+    request, unless kept is set.
+    """
+
+    def __init__(self, file, name, size, hash, duplicate=None):
+        super().__init__(file, name, "application/octet-stream", size)
+        self.hash = hash
+        self.duplicate = duplicate
+        self.kept = False
+
+    def temporary_file_path(self):
+        return self.file.name
+
+
+class BookUploadHandler(FileUploadHandler):
+    """ Receives the book file field, hashing and checking it on the fly.
+
+    Files which are not books are rejected by the first chunk, or by the
+    zip directory at the end, and the error message is kept in error.
+    Install it first, as it stops other handlers from saving the file,
+    and call cleanup() when the request is done.
+    """
+
+    field_name = "book_file"
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.active = False
+        self.file = None
+        self.book = None
+        self.error = None
+
+    def new_file(self, field_name, *args, **kwargs):
+        super().new_file(field_name, *args, **kwargs)
+        self.active = field_name == self.field_name
+        if not self.active:
+            return
+        upload_dir = Path(conf.WEBBOOKS_UPLOAD)
+        upload_dir.mkdir(parents=True, exist_ok=True)
+        self.file = tempfile.NamedTemporaryFile(dir=upload_dir,
+            prefix=".upload-", delete=False)
+        self.hasher = hashlib.md5()
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        if not self.active:
+            return raw_data
+        if start == 0:
+            self.reject(check_book_start(self.file_name, raw_data))
+        self.hasher.update(raw_data)
+        self.file.write(raw_data)
+        return None
+
+    def file_complete(self, file_size):
+        if not self.active:
+            return None
+        self.active = False
+        self.file.flush()
+        if file_size == 0:
+            self.error = "The file is empty."
+        else:
+            self.error = check_received_book(self.file.name, self.file_name)
+        if self.error:
+            # Other handlers have no file, so one is returned anyway
+            self.discard()
+            return UploadedBook(io.BytesIO(), self.file_name, file_size, None)
+        hash = self.hasher.hexdigest()
+        duplicate = find_by_hash(hash)
+        if duplicate:
+            self.discard()
+            return UploadedBook(io.BytesIO(), self.file_name, file_size, hash,
+                duplicate)
+        self.file.seek(0)
+        self.book = UploadedBook(self.file, self.file_name, file_size, hash)
+        return self.book
+
+    def upload_interrupted(self):
+        if self.active:
+            self.discard()
+
+    def cleanup(self):
+        """ Remove the file if the request failed or didn't add it. """
+        if self.file and not (self.book and self.book.kept):
+            self.discard()
+
+    def reject(self, error):
+        if error:
+            self.error = error
+            self.active = False
+            self.discard()
+            raise SkipFile()
+
+    def discard(self):
+        self.file.close()
+        Path(self.file.name).unlink(missing_ok=True)
@@ -13,19 +13,36 @@ router.register("genres", apiviews.GenreViewSet)
 router.register("sequences", apiviews.SequenceViewSet)
 router.register("books", apiviews.BookViewSet)
 router.register("fullbooks", apiviews.FullBookViewSet, basename="fullbook")
+router.register("duplicates", apiviews.DuplicateGroupViewSet)
+router.register("search", apiviews.SearchViewSet, basename="search")
+router.register("textsearch", apiviews.TextSearchViewSet, basename="textsearch")
 
 
 urlpatterns = [
     path("", views.index, name="index"),
     path("authors/", views.IndexView.as_view(), name="authors"),
     path("duplicates/", views.DuplicatesView.as_view(), name="duplicates"),
+    path("duplicates/near/", views.NearDuplicatesView.as_view(),
+        name="near_duplicates"),
     path("author<int:pk>/", views.AuthorView.as_view(), name="author"),
     path("book<int:pk>/", views.BookView.as_view(), name="book"),
     path("read<int:pk>/", views.ReadView.as_view(), name="read"),
+    path("read<int:pk>/img/<str:name>", views.book_image, name="book_image"),
+    path("read<int:pk>/<slug:label>", views.ReadChapterView.as_view(),
+        name="read_chapter"),
+    path("read<int:pk>/<slug:label>.json", views.read_chapter_json,
+        name="read_chapter_json"),
     path("user<int:pk>/", views.UserCommentsView.as_view(), name="user_comments"),
     path("book<int:pk>/comment", views.post_comment, name="comment"),
+    path("book<int:pk>/comments.json", views.comments_json,
+        name="comments_json"),
     path("book<int:pk>/download", views.download_book, name="download_book"),
     path("upload_book", views.upload_book, name="upload_book"),
     path("book_exists<int:pk>", views.BookExistsView.as_view(), name="book_exists"),
+    path("search/", views.search, name="search"),
+    path("search/suggest", views.search_suggest, name="search_suggest"),
+    path("search/text", views.search_text, name="search_text"),
+    path("job<int:pk>/", views.JobView.as_view(), name="job"),
+    path("job<int:pk>/status", views.job_status, name="job_status"),
     path("api/", include(router.urls)),
 ]
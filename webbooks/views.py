@@ -1,16 +1,24 @@
+from itertools import chain
+
 from django.contrib.auth.models import User
-from django.http import HttpResponse, HttpResponseRedirect, FileResponse
+from django.http import (HttpResponse, HttpResponseRedirect, FileResponse,
+    Http404, JsonResponse, StreamingHttpResponse)
 from django.shortcuts import render, get_object_or_404
+from django.template.loader import render_to_string
 from django.urls import reverse
+from django.utils.formats import localize
+from django.utils.timezone import template_localtime
 from django.views import generic
-from django.views.decorators.http import require_POST
-from django.db.models import Count,OuterRef,Subquery
-from django.db.models.functions import Coalesce
+from django.views.decorators.cache import cache_control
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from django.views.decorators.http import require_POST, etag
+from django.db.models import Q
 
-from . import conf
-from .fb2book import BookProcessor
+from . import catalog, conf, fulltext, jobs, neardupes, rendercache
+from .fb2book import BookParser, BookProcessor
 from .models import *
-from .services import file_hash,add_book_file
+from .services import file_hash,add_uploaded_book,binary_index,group_books
+from .uploads import BookUploadHandler
 
 
 #def index(request):
@@ -22,9 +30,45 @@ def index(request):
 
 
 class IndexView(generic.ListView):
+    """ Authors of a letter, or all, by pages after the ?after= author id.
+
+    Pages are read by the (letter, search_key, id) index, letter and book
+    counts are stored, so a page doesn't depend on the number of authors.
+    """
+    template_name = "webbooks/author_list.html"
+    context_object_name = "author_list"
+    page_size = 100
 
     def get_queryset(self):
-        return Author.objects.annotate(book_count=Count("book")).order_by("name")
+        authors = Author.objects.order_by("search_key", "id")
+        self.letter = self.request.GET.get("letter", "")[:1].upper()
+        if self.letter:
+            authors = authors.filter(letter=self.letter)
+        after = self.request.GET.get("after", "")
+        last = None
+        if after.isdigit():
+            last = Author.objects.filter(id=after) \
+                .values_list("search_key", "id").first()
+        if last:
+            key, id = last
+            authors = authors.filter(Q(search_key__gt=key)
+                | Q(search_key=key, id__gt=id))
+        page = list(authors[:self.page_size + 1])
+        self.has_next = len(page) > self.page_size
+        return page[:self.page_size]
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        letters = list(AuthorLetter.objects.filter(count__gt=0)
+            .order_by("letter"))
+        context["letters"] = letters
+        context["letter"] = self.letter
+        context["total"] = sum(row.count for row in letters
+            if row.letter == self.letter or not self.letter)
+        page = context["author_list"]
+        if self.has_next:
+            context["next_after"] = page[-1].id
+        return context
 
 
 def group_by(sequence, getkey):
@@ -57,46 +101,226 @@ class AuthorView(generic.DetailView):
         context = super().get_context_data(**kwargs)
         author = self.object
         books = author.book_set.select_related("sequence").all()
-        context['book_count'] = len(books)
+        context['book_count'] = author.book_count
         context['grouped_books'] = by_sequence(books)
         return context
 
 
 def book_authors(book):
-    """ Correctly get book authors with book count. """
-    # This gives wrong book_count:
-    #authors = book.authors.all().annotate(book_count=Count("book"))
-    ids = book.authors.values("id")
-    authors = Author.objects.filter(id__in=ids).annotate(book_count=Count("book"))
-    return authors
+    """ Book authors, with stored book_count. """
+    return book.authors.all()
 
 
 class BookView(generic.DetailView):
-    model = Book
+    """ Book page, its comments are loaded by comments_json when seen. """
+    queryset = Book.objects.prefetch_related("genres")
     template_name = "webbooks/book.html"
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         book = self.object
         context['authors'] = book_authors(book)
-        context['comments'] = Comment.objects.filter(book=book)
+        url = reverse("webbooks:comments_json", args=[book.pk])
+        start = self.request.GET.get("comments", "")
+        if start.isdigit():
+            url += f"?start={start}"
+        context['comments_url'] = url
         return context
 
 
+def slices(text, size=64*1024):
+    for start in range(0, len(text), size):
+        yield text[start:start+size]
+
+
+def stream_book_text(book):
+    """ Iterator of book toc and text for ReadView.
+
+    Cached books are sent from the cache. Books bigger than
+    WEBBOOKS_STREAM_SIZE, uncompressed, are not cached here, their text
+    is sent while rendered and the toc is added at the end. The file is
+    opened before the response starts, so a missing book is a 404 page.
+    """
+    full_path = book.full_path()
+    images = rendercache.READER_IMAGES
+    rendered = rendercache.get_cached(book.hash, image_url=images)
+    if rendered is None:
+        try:
+            size = BookParser.content_size(full_path)
+            handle = BookParser.open(full_path)
+        except FileNotFoundError:
+            raise Http404("Book file is missing.")
+        if size <= conf.WEBBOOKS_STREAM_SIZE:
+            with handle:
+                rendered = rendercache.get_content(handle, book.hash,
+                    image_url=images)
+    if rendered is not None:
+        return chain([rendered.toc], slices(rendered.content))
+    return stream_rendered(handle, images)
+
+
+def stream_rendered(handle, images):
+    try:
+        raw_book = BookProcessor(file=handle, mode="stream",
+            image_url=images)
+        yield from raw_book.iter_content()
+        yield render_to_string("webbooks/late_toc.html",
+            {"toc": raw_book.get_toc()})
+    finally:
+        handle.close()
+
+
 class ReadView(generic.DetailView):
+    """ Whole book, the page is streamed around the book text. """
     model = Book
     template_name = "webbooks/read.html"
+    text_marker = "<!-- webbooks:text -->"
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         book = self.object
         context['authors'] = book_authors(book)
-        raw_book = BookProcessor(file=book.full_path())
-        text,toc = raw_book.get_content()
-        context['text'] = toc + text
+        context['text'] = self.text_marker
+        return context
+
+    def render_to_response(self, context, **response_kwargs):
+        page = render_to_string(self.template_name, context, self.request)
+        header, footer = page.split(self.text_marker)
+        content = chain([header], stream_book_text(self.object), [footer])
+        return StreamingHttpResponse(content)
+
+
+def chapter_page(book, label):
+    """ RenderedBook, maybe without content, and the page with the chapter.
+
+    Pages are cached one by one, so a page is read without the whole book.
+    As in ReadView, books bigger than WEBBOOKS_STREAM_SIZE are not cached
+    on reading, unless the whole book is in the cache already.
+    """
+    depth = conf.WEBBOOKS_CHAPTER_DEPTH
+    images = rendercache.READER_IMAGES
+    found = rendercache.get_cached_page(book.hash, label, depth, images)
+    if found is None:
+        rendered = rendercache.get_cached(book.hash, image_url=images)
+        keep = rendered is not None
+        if rendered is None:
+            full_path = book.full_path()
+            try:
+                size = BookParser.content_size(full_path)
+            except FileNotFoundError:
+                raise Http404("Book file is missing.")
+            keep = size <= conf.WEBBOOKS_STREAM_SIZE
+            rendered = rendercache.render(full_path, image_url=images)
+        if keep:
+            rendercache.cache_pages(rendered, book.hash, depth, images)
+        found = rendered, rendered.page(label, depth)
+    rendered, page = found
+    if page is None:
+        raise Http404("No such chapter.")
+    return rendered, page
+
+
+class ReadChapterView(generic.DetailView):
+    """ Book page with a single chapter, other chapters are linked. """
+    model = Book
+    template_name = "webbooks/read_chapter.html"
+
+    def get(self, request, *args, **kwargs):
+        self.object = book = self.get_object()
+        label = kwargs["label"]
+        self.rendered, self.page = chapter_page(book, label)
+        if self.page["label"] != label:
+            url = reverse("webbooks:read_chapter",
+                args=[book.pk, self.page["label"]])
+            return HttpResponseRedirect(f"{url}#{label}")
+        context = self.get_context_data(object=book)
+        return self.render_to_response(context)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['authors'] = book_authors(self.object)
+        context['page'] = self.page
+        depth = conf.WEBBOOKS_CHAPTER_DEPTH
+        context['chapters'] = self.rendered.toc_pages(depth)
         return context
 
 
+def read_chapter_json(request, pk, label):
+    book = get_object_or_404(Book, pk=pk)
+    rendered, page = chapter_page(book, label)
+    return JsonResponse(page)
+
+
+# Types of images sent as they are, others are downloads, so a book
+# can't have html or svg with scripts shown from the site
+image_types = {"image/jpeg": "image/jpeg", "image/jpg": "image/jpeg",
+    "image/png": "image/png", "image/gif": "image/gif",
+    "image/webp": "image/webp"}
+
+
+def book_image_etag(request, pk, name):
+    hash = Book.objects.filter(pk=pk).values_list("hash", flat=True).first()
+    return f"{hash}-{name}" if hash else None
+
+
+@cache_control(public=True, max_age=365*24*3600)
+@etag(book_image_etag)
+def book_image(request, pk, name):
+    book = get_object_or_404(Book, pk=pk)
+    index = binary_index(str(book.full_path()), book.hash)
+    data, content_type = index.read(name)
+    if data is None:
+        raise Http404("No such image in the book.")
+    content_type = image_types.get((content_type or "").strip().lower())
+    if content_type:
+        response = HttpResponse(data, content_type=content_type)
+    else:
+        response = HttpResponse(data, content_type="application/octet-stream")
+        response["Content-Disposition"] = "attachment"
+    response["X-Content-Type-Options"] = "nosniff"
+    return response
+
+
+def comment_page(comments, start=""):
+    """ Page of comments, newest first, from the ?start= comment id.
+
+    Returns the comments and the id starting the next page, or None.
+    Pages are read by the (book or userid, time, id) indexes, so a page
+    doesn't depend on the number of comments.
+    """
+    comments = comments.order_by("-time", "-id")
+    first = None
+    if start.isdigit():
+        first = Comment.objects.filter(id=start) \
+            .values_list("time", "id").first()
+    if first:
+        time, id = first
+        comments = comments.filter(Q(time__lt=time) | Q(time=time, id__lte=id))
+    size = conf.WEBBOOKS_COMMENTS_PAGE
+    page = list(comments[:size + 1])
+    next_start = page[size].id if len(page) > size else None
+    return page[:size], next_start
+
+
+def comments_json(request, pk):
+    """ Page of book comments, with the url of the next one or null. """
+    comments, next_start = comment_page(Comment.objects.filter(book_id=pk),
+        request.GET.get("start", ""))
+    next_url = None
+    if next_start:
+        url = reverse("webbooks:comments_json", args=[pk])
+        next_url = f"{url}?start={next_start}"
+    data = {
+        "comments": [{"id": comment.id, "anchor": comment.anchor(),
+            "username": comment.username, "user_url": comment.user_link(),
+            "url": comment.link(), "text": comment.text,
+            "time": localize(template_localtime(comment.time))}
+            for comment in comments],
+        "next": next_url,
+    }
+    return JsonResponse(data)
+
+
 class UserCommentsView(generic.DetailView):
     model = User
     template_name = "webbooks/user_comments.html"
@@ -104,7 +328,9 @@ class UserCommentsView(generic.DetailView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         user = self.object
-        context['comments'] = Comment.objects.filter(userid=user.pk)
+        comments = Comment.objects.filter(userid=user.pk)
+        context['comments'], context['next_start'] = comment_page(comments,
+            self.request.GET.get("start", ""))
         return context
 
 
@@ -142,19 +368,25 @@ class BookExistsView(generic.DetailView):
     template_name = "webbooks/book_exists.html"
 
 
-def save_uploaded_book(uploaded_file):
-    upload_dir = Path(conf.WEBBOOKS_UPLOAD)
-    upload_dir.mkdir(parents=True, exist_ok=True)
-    full_path = upload_dir / uploaded_file.name
-    with open(full_path, "wb") as f:
-        for chunk in uploaded_file.chunks():
-            f.write(chunk)
-    return full_path
-
-
 def handle_uploaded_book(file):
-    full_path = save_uploaded_book(file)
-    book, result = add_book_file(full_path)
+    """ Add UploadedBook from BookUploadHandler to the library.
+
+    With background uploads it is queued for libworker, and the job page
+    is shown until it is added.
+    """
+    if file.duplicate:
+        book, result = file.duplicate, "exists"
+    else:
+        file.close()
+        full_path = file.temporary_file_path()
+        if conf.WEBBOOKS_BACKGROUND_UPLOADS:
+            job = jobs.enqueue_upload(full_path, file.hash, file.name)
+            file.kept = True
+            url = reverse("webbooks:job", args=[job.id])
+            return HttpResponseRedirect(url)
+        book, result = add_uploaded_book(full_path, file.hash, file.name)
+        if result == "created":
+            fulltext.index_book(book)
     if result == "created":
         url = reverse("webbooks:book", args=[book.id])
         return HttpResponseRedirect(url)
@@ -163,26 +395,165 @@ def handle_uploaded_book(file):
         return HttpResponseRedirect(url)
 
 
+class JobView(generic.DetailView):
+    """ Upload processing page, redirects to the book when it is added. """
+    model = Job
+    template_name = "webbooks/job.html"
+
+    def get(self, request, *args, **kwargs):
+        self.object = self.get_object()
+        url = self.object.result_url()
+        if url:
+            return HttpResponseRedirect(url)
+        return self.render_to_response(self.get_context_data())
+
+
+def job_status(request, pk):
+    job = get_object_or_404(Job, pk=pk)
+    data = {"status": job.status, "url": job.result_url()}
+    if job.status == "failed":
+        data["error"] = job.message
+    return JsonResponse(data)
+
+
+@csrf_exempt
 def upload_book(request):
+    # Upload handlers can't be changed after the CSRF check reads POST
+    handler = BookUploadHandler(request)
+    request.upload_handlers.insert(0, handler)
+    try:
+        return upload_book_checked(request, handler)
+    finally:
+        # Added books are moved already, failed CSRF check leaves the file
+        handler.cleanup()
+
+
+@csrf_protect
+def upload_book_checked(request, handler):
     context = {}
     if request.method == "POST":
         file = request.FILES.get("book_file", None)
-        if file:
+        if handler.error:
+            context["error_message"] = handler.error
+        elif file:
             return handle_uploaded_book(file)
-        context["error_message"] = "No file uploaded"
+        else:
+            context["error_message"] = "No file uploaded"
     return render(request, "webbooks/upload_book.html", context)
 
 
-def find_field_dupes(field):
-    dupes = Book.objects.values(field).annotate(field_count=Count(field)) \
-        .order_by().filter(field_count__gt=1)
-    return [o[field] for o in dupes]
-
-
 class DuplicatesView(generic.ListView):
+    """ Groups of books with the same hash, most wasted bytes first.
+
+    Groups are stored and read by pages after the ?after= group id,
+    with the books of the page in one query. Totals of all groups are
+    stored too.
+    """
     template_name = "webbooks/book_list.html"
-    context_object_name = "book_list"
+    context_object_name = "group_list"
+    page_size = 50
 
     def get_queryset(self):
-        hashes = find_field_dupes("hash")
-        return Book.objects.filter(hash__in=hashes).order_by("hash")
+        groups = DuplicateGroup.objects.order_by("-wasted", "id")
+        after = self.request.GET.get("after", "")
+        last = None
+        if after.isdigit():
+            last = DuplicateGroup.objects.filter(id=after) \
+                .values_list("wasted", "id").first()
+        if last:
+            wasted, id = last
+            groups = groups.filter(Q(wasted__lt=wasted)
+                | Q(wasted=wasted, id__gt=id))
+        page = list(groups[:self.page_size + 1])
+        self.has_next = len(page) > self.page_size
+        return group_books(page[:self.page_size])
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["totals"] = DuplicateTotals.objects.first() \
+            or DuplicateTotals()
+        page = context["group_list"]
+        if self.has_next:
+            context["next_after"] = page[-1].id
+        return context
+
+
+class NearDuplicatesView(generic.ListView):
+    """ Clusters of books with similar text, found by libdupes.
+
+    Clusters are read by pages after the ?after= cluster id.
+    """
+    template_name = "webbooks/near_duplicates.html"
+    context_object_name = "cluster_list"
+    page_size = 50
+
+    def get_queryset(self):
+        clusters = TextSignature.objects.filter(cluster__isnull=False) \
+            .order_by("cluster").values_list("cluster", flat=True).distinct()
+        after = self.request.GET.get("after", "")
+        if after.isdigit():
+            clusters = clusters.filter(cluster__gt=after)
+        ids = list(clusters[:self.page_size + 1])
+        self.has_next = len(ids) > self.page_size
+        return neardupes.cluster_books(ids[:self.page_size])
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        page = context["cluster_list"]
+        if self.has_next:
+            context["next_after"] = page[-1].id
+        return context
+
+
+def search_text(request):
+    """ Full-text search in book contents, by pages of hits. """
+    page_size = 20
+    query = request.GET.get("q", "").strip()
+    try:
+        page = max(int(request.GET.get("page", 1)), 1)
+    except ValueError:
+        page = 1
+    hits = []
+    if query:
+        hits = fulltext.search(query, page_size + 1, (page - 1) * page_size)
+    context = {
+        "query": query,
+        "hits": hits[:page_size],
+        "page": page,
+        "has_next": len(hits) > page_size,
+        "available": fulltext.is_available(),
+    }
+    return render(request, "webbooks/search_text.html", context)
+
+
+def search(request):
+    """ Search of books, authors and sequences by words of names. """
+    query = request.GET.get("q", "").strip()
+    context = {"query": query}
+    if query:
+        context["books"] = catalog.search(query, "book")
+        context["authors"] = catalog.search(query, "author")
+        context["sequences"] = catalog.search(query, "sequence")
+    return render(request, "webbooks/search.html", context)
+
+
+def search_suggest(request):
+    """ Typeahead: names and urls of the top matches of every kind. """
+    query = request.GET.get("q", "")
+    try:
+        limit = min(max(int(request.GET.get("limit", 10)), 1), 50)
+    except ValueError:
+        limit = 10
+    found = catalog.suggest(query, limit)
+    data = {
+        "books": [{"id": book.id, "name": book.title,
+            "url": reverse("webbooks:book", args=[book.id])}
+            for book in found["book"]],
+        "authors": [{"id": author.id, "name": author.name,
+            "url": reverse("webbooks:author", args=[author.id])}
+            for author in found["author"]],
+        "sequences": [{"id": sequence.id, "name": sequence.name}
+            for sequence in found["sequence"]],
+    }
+    return JsonResponse(data)
+